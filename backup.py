@@ -21,45 +21,186 @@
 from __future__ import with_statement
 from contextlib import contextmanager
 
-import sys, commands, os, subprocess, pickle, datetime
+import sys, os, re, subprocess, time
 
-import config, lock
+import config, lock, scheduler, pump, state, selection, prescan, status, metrics, tracing, lvm, hooks, policy, windows, resources, restore, verify, tuning, junk, failures
+# CheckMount used to live here, existing configs import it from backup
+from hooks import CheckMount
 
 class Backup( config.ConfigBase ):
     def __init__( self, conf ):
         config.ConfigBase.__init__( self, conf )
-
+        self.slots = scheduler.SlotPool( self.max_parallel, self.max_per_host )
+        self.maintenance_slots = scheduler.SlotPool( self.maintenance_parallel, self.max_per_host )
+        self.status_slots = scheduler.SlotPool( self.status_parallel, self.max_per_host )
+        self.output_log = None
+        if ( self.config.has_key( 'output_log' ) ):
+            self.output_log = file( self.config['output_log'], 'a' )
+        self.state = state.StateStore( self.state_file )
+        self.metrics = metrics.Metrics( self.config.get( 'metrics_jsonl' ), self.config.get( 'metrics_prom' ) )
+        self.tracer = tracing.Tracer()
+        # the open run journal cycle, see ProcessBackups
+        self.cycle = None
+        # lvm.SnapshotManager for the LVM targets of the run, see ProcessBackups
+        self.snapshots = None
+        # hooks.MountTable, read at the start of each run
+        self.mounts = None
+        # policy.FullPolicy, the full backup decisions for the run
+        self.policy = None
+        # pauses the targets' duplicity processes outside their windows
+        self.windows = windows.WindowGuard( self )
+        # lowers the priority of the running processes, or pauses them, when the host is busy
+        self.throttle = None
+        if ( len( [ k for k in resources.throttle_keys if self.config.has_key( k ) ] ) != 0 ):
+            self.throttle = resources.Throttle( self )
+            self.windows.holds.append( self.throttle )
+
+    # per target data file kept next to the state store
+    def TargetFile( self, target, kind ):
+        return os.path.join( os.path.dirname( os.path.abspath( self.state_file ) ), 'dupinanny_%s_%s' % ( kind, re.sub( r'[^\w.-]', '_', target.key ) ) )
+
+    # a line oriented pump for duplicity's output, tees to the console and the optional log file
+    # the 'fatal_patterns' from the config terminate duplicity as soon as they show up
+    # for a target, the processes get its resource limits, and are paused with its window or the throttle
+    def OutputPump( self, prefix, target = None ):
+        sinks = [ sys.stdout ]
+        if ( not self.output_log is None ):
+            sinks.append( self.output_log )
+        out = pump.OutputPump( sinks, prefix = prefix, tracer = self.tracer )
+        if ( not target is None ):
+            resources.Limits( self, target ).Apply( out )
+        if ( not target is None and ( not self.windows.Window( target ) is None or not self.throttle is None ) ):
+            out.group = True
+            out.guard = self.windows
+            out.target = target
+            # the run the pauses are recorded against
+            out.run_id = None
+        if ( self.config.has_key( 'fatal_patterns' ) ):
+            for f in self.config['fatal_patterns']:
+                out.addPattern( f, fatal = True )
+        return out
+
+    # subprocess.check_call, with a span in the trace
+    def CheckCall( self, cmd, target = None ):
+        print repr( cmd )
+        with self.tracer.Span( ' '.join( [ os.path.basename( cmd[0] ) ] + cmd[1:2] ), 'subprocess', cmd = ' '.join( cmd ), target = target ) as args:
+            ret = subprocess.call( cmd )
+            args['exit'] = ret
+        if ( ret != 0 ):
+            raise subprocess.CalledProcessError( ret, cmd )
+
+    # with 'lock_granularity' : 'destination', there is no global lock, each target takes its own lock when it starts
+    # so invocations working on separate sets of targets don't get in each other's way
     @contextmanager
     def ManageLock( self ):
+        if ( self.lock_granularity == 'destination' ):
+            yield
+            return
         filelock = lock.lock( self.lockfile, 'dupinanny backup' )
-        filelock.acquire( wait = None, expire = None )
-        yield
-        filelock.release()
+        with self.tracer.Span( 'lock wait', 'lock', lockfile = self.lockfile ):
+            filelock.acquire( wait = self.lock_wait, expire = None )
+        try:
+            yield
+        finally:
+            filelock.release()
+
+    @contextmanager
+    def TargetLock( self, target ):
+        if ( self.lock_granularity != 'destination' ):
+            yield
+            return
+        filelock = lock.lock( '%s.%s' % ( self.lockfile, re.sub( r'[^\w.-]', '_', target.key ) ), 'dupinanny backup %s' % target.destination )
+        with self.tracer.Span( 'lock wait', 'lock', lockfile = filelock.lockfile, target = target.root ):
+            filelock.acquire( wait = self.lock_wait, expire = None )
+        try:
+            yield
+        finally:
+            filelock.release()
 
     def Prepare( self ):
         if ( self.dupi.has_key( 'prepare' ) ):
-            for p in self.dupi['prepare']:
-                p.Prepare( self )
+            hooks.HookRunner( self, 'prepare' ).Run( self.dupi['prepare'] )
 
     def Posthook( self ):
         if ( self.dupi.has_key( 'posthook' ) ):
-            for p in self.dupi['posthook']:
-                p.Posthook( self )
-
-    def ProcessBackups( self ):
-        backup_time_filename = os.path.join( os.path.dirname( self.lockfile ), 'dupinnany_backup_info.pickle' )
-        if ( not self.dry_run and self.config.has_key( 'backup_every' ) and os.path.exists( backup_time_filename ) ):
-            # check last backup information, early out if we haven't reached that point yet
-            backup_time_file = file( backup_time_filename )
-            last_backup = pickle.load( backup_time_file )
-            backup_time_file.close()
-            delta = datetime.datetime.now() - last_backup
-            if ( delta.days < self.config['backup_every'] ):
-                print( 'Last backup is %d days old, no new backup needed.' % delta.days )
-                return
+            hooks.HookRunner( self, 'posthook' ).Run( self.dupi['posthook'] )
 
+    # the targets to process, in the order they should be started
+    # skips the targets completed in the given cycle, and the ones that have not reached their backup_every point
+    def PendingTargets( self, cycle ):
         if ( not self.dupi.has_key( 'items' ) ):
             raise Exception( 'no backups defined (\'items\' entry in the DupiConfig dictionary)' )
+        done = set()
+        if ( not cycle is None ):
+            done = self.state.CycleDone( cycle )
+            if ( len( done ) != 0 ):
+                print 'resuming backup cycle %d, %d targets already completed' % ( cycle, len( done ) )
+        items = []
+        for b in self.dupi['items']:
+            if ( b.key in done ):
+                print '%s: already completed in this cycle.' % b.root
+                continue
+            if ( b.Due( self ) ):
+                items.append( b )
+        return self.OrderTargets( items )
+
+    # with 'order' : 'history' in the config, use the recorded durations:
+    # longest first when running in parallel so the long jobs don't end up last, shortest first otherwise
+    # targets without history are treated as the longest
+    def OrderTargets( self, items ):
+        if ( self.config.get( 'order', 'config' ) != 'history' ):
+            return items
+        def key( b ):
+            d = b.PredictDuration( self, b.PlannedType( self ) )
+            if ( d is None ):
+                return float( 'inf' )
+            return d
+        return sorted( items, key = key, reverse = ( self.max_parallel > 1 ) )
+
+    # the full backup decisions are made once per run, for all the targets together
+    def Policy( self ):
+        if ( self.policy is None ):
+            self.policy = policy.FullPolicy( self, self.dupi.get( 'items', [] ) )
+        return self.policy
+
+    def PrintPlan( self ):
+        items = self.PendingTargets( self.state.CurrentCycle() )
+        jobs = []
+        known = []
+        for b in items:
+            backup_type = b.PlannedType( self )
+            d = b.PredictDuration( self, backup_type )
+            if ( not d is None ):
+                known.append( d )
+            jobs.append( [ b, backup_type, d ] )
+        # guess the average for the targets without history
+        guess = 0.0
+        if ( len( known ) != 0 ):
+            guess = sum( known ) / len( known )
+        plan = scheduler.simulate( self.max_parallel, self.max_per_host, [ ( j[0].root, scheduler.destinationHost( j[0].destination ), j[2] or guess ) for j in jobs ] )
+        now = time.time()
+        print '###########################################################################'
+        print 'plan: %d targets, max_parallel %d, order %s' % ( len( items ), self.max_parallel, self.config.get( 'order', 'config' ) )
+        print '###########################################################################'
+        for ( j, ( key, start, end ) ) in zip( jobs, plan ):
+            estimate = ''
+            if ( j[2] is None ):
+                estimate = ' (no history)'
+            print '%s - %s %-11s %s%s' % ( time.strftime( '%a %H:%M', time.localtime( now + start ) ), time.strftime( '%a %H:%M', time.localtime( now + end ) ), j[1], key, estimate )
+        if ( len( plan ) != 0 ):
+            print 'predicted finish: %s' % time.ctime( now + max( [ p[2] for p in plan ] ) )
+
+    def ProcessBackups( self ):
+        # resume the current cycle: skip the targets that completed in an earlier, interrupted invocation
+        self.cycle = None
+        if ( not self.dry_run ):
+            self.cycle = self.state.OpenCycle( self.new_cycle )
+        items = self.PendingTargets( self.cycle )
+        if ( len( items ) == 0 ):
+            print 'No backup target is due, no new backup needed.'
+            if ( not self.cycle is None ):
+                self.state.CloseCycle( self.cycle )
+            return
 
         # setup first so we can flag 'full backup'
         # and do the cleanup and status summary at the end too
@@ -68,54 +209,205 @@ class Backup( config.ConfigBase ):
         print 'setup'
         print '###########################################################################'
         
-        for b in self.dupi['items']:
-            b.Setup( self )
+        for b in items:
+            with self.tracer.Span( 'setup', 'setup', target = b.root ):
+                b.Setup( self )
             
-        for b in self.dupi['items']:
+        # all the LVM snapshots are taken together, before the first backup starts
+        self.snapshots = lvm.SnapshotManager( self, [ b for b in items if isinstance( b, LVMBackupTarget ) ] )
+        try:
+            with self.tracer.Span( 'snapshots', 'lvm' ):
+                self.snapshots.Create()
+            jobs = []
+            targets = {}
+            for b in items:
+                jobs.append( ( b.root, scheduler.destinationHost( b.destination ), b.Start ) )
+                targets[ b.root ] = b
+            # the targets that can't run in their window are left for the next invocation
+            # with 'stop_on_failure', a failed target keeps the ones that haven't started from running
+            runner = scheduler.Scheduler( self.slots, 'run', stop_on_failure = self.config.get( 'stop_on_failure', False ), admit = lambda key : targets[ key ].WindowCheck() )
+            results = runner.Run( jobs )
+        finally:
+            self.snapshots.ReleaseAll()
+        runner.Summary( results )
+
+        ok = [ b for ( b, r ) in zip( items, results ) if r.status == 'ok' ]
+        # a stage that fails for some targets doesn't keep the next ones from running, it's all reported at the end
+        unmaintained = []
+        if ( self.maintenance == 'deferred' ):
+            unmaintained = self.MaintenanceStage( ok )
+
+        unfinished = self.FinishStage( ok )
+
+        unverified = self.VerifyStage( ok )
+
+        failed = [ ( r.key, failures.Kind( r ) ) for r in results if r.status == 'failed' ]
+        skipped = [ r for r in results if r.status == 'skipped' ]
+        if ( len( skipped ) != 0 ):
+            print 'not run, left for the next run: %s' % ', '.join( [ '%s (%s)' % ( r.key, r.error or 'stopped' ) for r in skipped ] )
+        elif ( len( failed ) == 0 and len( unmaintained ) == 0 and not self.cycle is None ):
+            # the targets whose maintenance failed are not journaled as done, the cycle stays open to get back to them
+            self.state.CloseCycle( self.cycle )
+
+        messages = self.StageMessages( 'backup', failed ) + self.StageMessages( 'maintenance', unmaintained ) + self.StageMessages( 'collection-status', unfinished ) + self.VerifyMessages( unverified )
+        if ( len( messages ) != 0 ):
+            raise failures.RunFailed( failures.ExitStatus( [ kind for ( key, kind ) in failed + unmaintained + unfinished + unverified ] ), '; '.join( messages ) )
+
+    # one target through all the stages on its own, for the daemon (the caller holds the slot)
+    def RunTarget( self, b ):
+        with self.tracer.Span( 'setup', 'setup', target = b.root ):
+            b.Setup( self )
+        snapshots = lvm.SnapshotManager( self, [ b ] if isinstance( b, LVMBackupTarget ) else [] )
+        try:
+            with self.tracer.Span( 'snapshots', 'lvm' ):
+                snapshots.Create()
+            b.Start()
+        finally:
+            snapshots.ReleaseAll()
+        if ( self.maintenance == 'deferred' ):
+            b.TracedMaintain()
+        if ( self.state.CachedStatus( b.destination, self.status_ttl ) is None ):
+            b.TracedRefreshStatus()
+        with self.tracer.Span( 'finish', 'finish', target = b.root ):
+            b.Finish()
+        unverified = self.VerifyStage( [ b ] )
+        if ( len( unverified ) != 0 ):
+            raise failures.BackupFailure( unverified[0][1], '; '.join( self.VerifyMessages( unverified ) ) )
+
+    # sampled verification of the targets, returns ( key, kind ) for the ones that failed it, see verify.Verifier.Run
+    def VerifyStage( self, items ):
+        with self.tracer.Span( 'verify', 'verify' ):
+            return verify.Verifier( self ).Run( items )
+
+    # ( key, kind ) of the targets that failed a stage, as one message
+    def StageMessages( self, stage, failed ):
+        if ( len( failed ) == 0 ):
+            return []
+        return [ '%s failed: %s' % ( stage, ', '.join( [ '%s (%s)' % ( key, kind ) for ( key, kind ) in failed ] ) ) ]
+
+    # the differences found apart from the verifications that didn't go through
+    def VerifyMessages( self, unverified ):
+        messages = []
+        corrupt = [ key for ( key, kind ) in unverified if kind == 'corrupt' ]
+        if ( len( corrupt ) != 0 ):
+            messages.append( 'verification found differences: %s' % ', '.join( corrupt ) )
+        broken = [ '%s (%s)' % ( key, kind ) for ( key, kind ) in unverified if kind != 'corrupt' ]
+        if ( len( broken ) != 0 ):
+            messages.append( 'verification failed: %s' % ', '.join( broken ) )
+        return messages
+
+    # collection-status for all the targets, the ones without a recent enough cached status are refreshed in parallel
+    # returns ( key, kind ) for the ones that have no status
+    def FinishStage( self, items ):
+        refresh = {}
+        stale = [ b for b in items if self.state.CachedStatus( b.destination, self.status_ttl ) is None ]
+        if ( len( stale ) != 0 ):
+            jobs = [ ( b.root, scheduler.destinationHost( b.destination ), b.TracedRefreshStatus ) for b in stale ]
+            runner = scheduler.Scheduler( self.status_slots, 'status', stop_on_failure = False )
+            for r in runner.Run( jobs ):
+                if ( r.status == 'failed' ):
+                    refresh[ r.key ] = failures.Kind( r )
+        failed = []
+        for b in items:
             print '###########################################################################'
-            print 'run %s' % b.root
+            print 'finish %s' % b.root
             print '###########################################################################'
-            b.Run()
-
+            if ( self.state.CachedStatus( b.destination, None ) is None ):
+                print 'no collection status available'
+                failed.append( ( b.root, refresh.get( b.root, 'failed' ) ) )
+                continue
+            with self.tracer.Span( 'finish', 'finish', target = b.root ):
+                b.Finish()
+        return failed
+
+    # cleanup and remove-older-than for all the targets, once the backups are done
+    # has its own concurrency limit, and a time budget after which nothing new starts and what's running is terminated
+    # returns ( key, kind ) for the targets it failed for
+    def MaintenanceStage( self, items ):
+        if ( len( items ) == 0 ):
+            return []
+        deadline = None
+        if ( not self.maintenance_budget is None ):
+            deadline = time.time() + self.maintenance_budget
+        def maintain( b ):
+            if ( b.TracedMaintain( deadline ) ):
+                b.MarkDone()
+        jobs = []
+        for b in items:
+            jobs.append( ( b.root, scheduler.destinationHost( b.destination ), lambda b = b : maintain( b ) ) )
+        runner = scheduler.Scheduler( self.maintenance_slots, 'maintenance', stop_on_failure = False, deadline = deadline )
+        results = runner.Run( jobs )
+        runner.Summary( results )
+        return [ ( r.key, failures.Kind( r ) ) for r in results if r.status == 'failed' ]
+
+    def PrintHistory( self ):
+        if ( not self.dupi.has_key( 'items' ) ):
+            raise Exception( 'no backups defined (\'items\' entry in the DupiConfig dictionary)' )
         for b in self.dupi['items']:
             print '###########################################################################'
-            print 'finish %s' % b.root
+            print 'history %s %s' % ( b.root, b.destination )
             print '###########################################################################'
-            b.Finish()
-
-        if ( not self.dry_run ):
-            # write out a global flag to mark the time of the last successful backup run
-            # place this in the same folder as the pid file
-            backup_time_file = file( backup_time_filename, 'w' )
-            pickle.dump( datetime.datetime.now(), backup_time_file )
-            backup_time_file.close()
+            for r in b.History( self ):
+                duration = ''
+                if ( not r['duration'] is None ):
+                    duration = '%.1fs' % r['duration']
+                bytes_sent = ''
+                if ( not r['bytes_sent'] is None ):
+                    bytes_sent = '%d bytes' % r['bytes_sent']
+                paused = ''
+                if ( r['paused'] ):
+                    paused = ' (paused %.1fs)' % r['paused']
+                print '%s %-11s %-7s %10s %s%s' % ( time.strftime( '%Y-%m-%d %H:%M:%S', time.localtime( r['started'] ) ), r['backup_type'], r['status'], duration, bytes_sent, paused )
 
     def Run( self ):
-        with self.ManageLock():
-            self.Prepare()
-            self.ProcessBackups()
-            self.Posthook()
-
-class CheckMount( object ):
-    def __init__( self, directory ):
-        self.directory = directory
-                  
-    def Prepare( self, backup ):
-        print 'CheckMount.Prepare'
-        cmd = 'cat /etc/mtab | grep "%s"' % self.directory
-        print cmd
-        ( status, output ) = commands.getstatusoutput( cmd )
-        if ( status != 0 ):
-            print repr( ( status, output ) )
-            cmd = 'mount "%s"' % self.directory
-            print cmd
-            ( status, output ) = commands.getstatusoutput( cmd )
-            print repr( ( status, output ) )
-            if ( status != 0 ):
-                raise Exception( 'CheckMount: %s is not mounted' % self.directory )
+        if ( self.daemon_status ):
+            import daemon
+            daemon.PrintStatus( self.daemon_socket )
+            return
+        if ( self.history ):
+            self.PrintHistory()
+            return
+        if ( len( self.restore_paths ) != 0 ):
+            restore.Restore( self ).Run( self.restore_paths )
+            return
+        if ( self.verify_only ):
+            with self.ManageLock():
+                for b in self.dupi['items']:
+                    b.backup = self
+                unverified = self.VerifyStage( self.dupi['items'] )
+                if ( len( unverified ) != 0 ):
+                    raise failures.RunFailed( failures.ExitStatus( [ kind for ( key, kind ) in unverified ] ), '; '.join( self.VerifyMessages( unverified ) ) )
+            return
+        if ( self.plan ):
+            self.PrintPlan()
+            return
+        if ( self.show_status ):
+            for b in self.dupi['items']:
+                b.backup = self
+            unfinished = self.FinishStage( self.dupi['items'] )
+            if ( len( unfinished ) != 0 ):
+                raise failures.RunFailed( failures.ExitStatus( [ kind for ( key, kind ) in unfinished ] ), '; '.join( self.StageMessages( 'collection-status', unfinished ) ) )
+            return
+        # shared by the hooks and the snapshots for the whole run
+        self.mounts = hooks.MountTable()
+        self.policy = None
+        try:
+            with self.ManageLock():
+                self.Prepare()
+                try:
+                    self.ProcessBackups()
+                finally:
+                    self.metrics.WriteProm( self, self.dupi.get( 'items', [] ) )
+                self.Posthook()
+        finally:
+            self.windows.ResumeAll()
+            self.tracer.Slowest()
+            if ( not self.trace_file is None ):
+                self.tracer.Export( self.trace_file )
+                print 'trace written to %s' % self.trace_file
 
 class BackupTarget( object ):
-    def __init__( self, root, destination, exclude = [], shortFilenames = False , include = [] ):
+    def __init__( self, root, destination, exclude = [], shortFilenames = False , include = [], backup_every = None, full_every = None, prescan = None, full_max_chain = None, full_max_ratio = None, schedule = None, window = None, nice = None, ionice = None, cpu_affinity = None, cgroup_memory = None, cgroup_cpu = None, verify_days = None, volsize = None, junk = None, retries = None ):
         self.root = root
         self.destination = destination
         self.exclude = exclude
@@ -123,6 +415,117 @@ class BackupTarget( object ):
         self.backup = None
         self.shortFilenames = shortFilenames
         self.fullFileFlag = os.path.normpath( '%s.full' % root.replace( '/', '_' ) )
+        # per target overrides for the backup_every and full_every config values
+        self.backup_every = backup_every
+        self.full_every = full_every
+        self.full_max_chain = full_max_chain
+        self.full_max_ratio = full_max_ratio
+        # when the daemon starts the target: a cron expression, or an interval ( seconds, or '6h', '2d' .. )
+        self.schedule = schedule
+        # when its duplicity processes may run, see windows.py
+        self.window = window
+        # what its duplicity processes may use, see resources.py
+        self.nice = nice
+        self.ionice = ionice
+        self.cpu_affinity = cpu_affinity
+        self.cgroup_memory = cgroup_memory
+        self.cgroup_cpu = cgroup_cpu
+        # check the whole target over that many nights, see verify.py
+        self.verify_days = verify_days
+        # --volsize in MB, or 'auto', see tuning.py
+        self.volsize = volsize
+        # leave out the cache directories found in the tree, see junk.py
+        self.junk = junk
+        # how many times a transient failure is retried, see failures.py
+        self.retries = retries
+        # see TempDir
+        self.chosen_tempdir = None
+        # walk the tree before an incremental, and skip duplicity if nothing changed since the last backup
+        self.prescan = prescan
+        # identifies the target in the state store
+        self.key = destination
+
+    # per target setting, falls back to the config value
+    def Setting( self, backup, name, default = None ):
+        value = getattr( self, name, None )
+        if ( value is None and backup.config.has_key( name ) ):
+            value = backup.config[ name ]
+        if ( value is None ):
+            value = default
+        return value
+
+    # where duplicity puts its temporary files, and whether it needs to be told explicitly
+    # during a backup, the place tuning.PickTempDir found with enough room
+    def TempDir( self ):
+        if ( not self.chosen_tempdir is None ):
+            return self.chosen_tempdir
+        return self.DefaultTempDir()
+
+    def DefaultTempDir( self ):
+        if ( self.backup.config.has_key( 'tempdir' ) ):
+            return ( self.backup.config['tempdir'], True )
+        tempdir = '/tmp'
+        try:
+            tempdir = os.environ['TEMP']
+        except:
+            pass
+        return ( tempdir, False )
+
+    # the configured excludes, and the cache directories found by the last discovery
+    def Excludes( self, discover = False ):
+        return list( self.exclude ) + junk.JunkFinder( self.backup, self ).Paths( discover )
+
+    # the files duplicity will pick up for this target, for the code that walks the tree itself
+    def Selection( self ):
+        exclude = self.Excludes()
+        ( tempdir, explicit ) = self.TempDir()
+        if ( tempdir.find( self.root ) != -1 ):
+            exclude.append( tempdir )
+        one_filesystem = '--exclude-other-filesystems' in self.backup.config.get( 'duplicity_args', [] )
+        return selection.Selection( self.root, exclude, self.include, one_filesystem )
+
+    def History( self, backup, limit = 30 ):
+        return backup.state.History( self.key, limit )
+
+    # check the last successful backup of this target against backup_every
+    def Due( self, backup ):
+        every = self.Setting( backup, 'backup_every' )
+        if ( backup.dry_run or every is None ):
+            return True
+        last = backup.state.LastRun( self.key, status = 'ok' )
+        if ( last is None ):
+            return True
+        days = int( ( time.time() - last['finished'] ) / ( 24 * 3600 ) )
+        if ( days < every ):
+            print '%s: last backup is %d days old, no new backup needed.' % ( self.root, days )
+            return False
+        return True
+
+    # average duration of the last successful runs of that type, None without history
+    # the time spent paused outside the window doesn't count
+    def PredictDuration( self, backup, backup_type, runs = 5 ):
+        durations = [ r['duration'] - ( r['paused'] or 0 ) for r in backup.state.History( self.key, runs, status = 'ok', backup_type = backup_type ) ]
+        if ( len( durations ) == 0 ):
+            return None
+        return sum( durations ) / len( durations )
+
+    # what Setup and Run will decide, without touching the full backup indicator file
+    def PlannedType( self, backup ):
+        self.backup = backup
+        if ( backup.full or os.path.exists( self.fullFileFlag ) or self.FullDue() ):
+            return 'full'
+        return 'incremental'
+
+    # None if the target can start now, otherwise why it has to wait for its window
+    def WindowCheck( self ):
+        check = self.backup.windows.Check( self, self.PredictDuration( self.backup, self.PlannedType( self.backup ) ) )
+        if ( check is None ):
+            return None
+        return check[0]
+
+    # the full backup policy's decision, see policy.py
+    def FullDue( self ):
+        return self.backup.Policy().Full( self )
 
     def Setup( self, backup ):
         self.backup = backup
@@ -130,6 +533,15 @@ class BackupTarget( object ):
 
         if ( self.backup.full ):
             subprocess.check_call( [ 'touch', self.fullFileFlag ] )
+        else:
+            decision = self.backup.Policy().Decision( self )
+            if ( len( decision.details ) != 0 ):
+                print 'full backup policy: %s' % ', '.join( decision.details )
+            if ( decision.full ):
+                print 'full backup needed: %s' % decision.reason
+                subprocess.check_call( [ 'touch', self.fullFileFlag ] )
+            elif ( not decision.reason is None ):
+                print decision.reason
 
         if ( os.path.exists( self.fullFileFlag ) ):
             full = 'full backup enabled'
@@ -137,6 +549,23 @@ class BackupTarget( object ):
             full = 'not present'	
         print 'full backup indicator file: %s - %s' % ( repr( self.fullFileFlag ), full )
 
+    # entry point for the scheduler
+    def Start( self ):
+        print '###########################################################################'
+        print 'run %s' % self.root
+        print '###########################################################################'
+        with self.backup.tracer.Span( 'run', 'run', target = self.root ):
+            with self.backup.TargetLock( self ):
+                self.Run()
+        # with deferred maintenance the target is journaled once its maintenance went through, see Backup.MaintenanceStage
+        if ( self.backup.maintenance != 'deferred' ):
+            self.MarkDone()
+
+    # backup and maintenance went through, journal it so a resumed cycle skips this target
+    def MarkDone( self ):
+        if ( not self.backup.cycle is None ):
+            self.backup.state.MarkDone( self.backup.cycle, self.key )
+
     def Run( self, recursed = False ):
 
         # we do it that way so a full backup that fails keeps getting retried until it works
@@ -148,7 +577,12 @@ class BackupTarget( object ):
             os.environ['PASSPHRASE'] = self.backup.config['password']
 
         option_string = []
-        for e in self.exclude:
+        with self.backup.tracer.Span( 'junk', 'junk', target = self.root ):
+            excludes = self.Excludes( discover = not self.backup.dry_run )
+        ( filelist, excludes ) = junk.JunkFinder( self.backup, self ).Filelist( excludes )
+        if ( not filelist is None ):
+            option_string.append( '--exclude-filelist=%s' % filelist )
+        for e in excludes:
             option_string.append( '--exclude=%s' % e )
         for e in self.include:
             option_string.append( '--include=%s' % e )
@@ -157,14 +591,97 @@ class BackupTarget( object ):
         if ( self.backup.config.has_key('duplicity_args') ):
             option_string += self.backup.config['duplicity_args']
 
-        tempdir = '/tmp'
-        try:
-            tempdir = os.environ['TEMP']
-        except:
-            pass
-        if ( self.backup.config.has_key('tempdir') ):
-            tempdir = self.backup.config['tempdir']
-            # need to make it explicit then
+        # the temporary directory picked for the last backup may not have the room anymore
+        self.chosen_tempdir = None
+
+        scanner = None
+        changed = True
+        if ( not self.backup.dry_run and self.Setting( self.backup, 'prescan', False ) ):
+            # scan for full backups too, so the index is in sync once it's done
+            scanner = prescan.ChangeScanner( self.Selection(), self.backup.TargetFile( self, 'prescan' ) )
+            start = time.time()
+            with self.backup.tracer.Span( 'prescan', 'prescan', target = self.root ):
+                changed = scanner.Changed()
+            self.backup.metrics.Record( self, 'prescan', time.time() - start )
+            print '%s: change scan took %.1fs, %s' % ( self.root, time.time() - start, { True : 'changes found', False : 'no changes' }[ changed ] )
+
+        if ( changed or backup_type == 'full' ):
+            cmd = self.command( backup_type, option_string )
+
+        if ( not changed and backup_type == 'incremental' ):
+            print '%s: nothing changed since the last backup, skipping duplicity' % self.root
+            run_id = self.backup.state.StartRun( self.key, 'unchanged' )
+            self.backup.state.FinishRun( run_id, 'ok', 0 )
+        elif ( not self.backup.dry_run ):
+            attempt = 0
+            while ( True ):
+                out = self.backup.OutputPump( self.root, self )
+                classifier = failures.Classifier( self.backup, out )
+                stats = metrics.BackupStatistics()
+                stats.Attach( out )
+                run_id = self.backup.state.StartRun( self.key, backup_type )
+                if ( not out.guard is None ):
+                    out.run_id = run_id
+                start = time.time()
+                try:
+                    try:
+                        ret = out.Run( cmd )
+                    finally:
+                        # whatever happened, the destination may have changed
+                        self.backup.state.InvalidateStatus( self.destination )
+                except:
+                    self.backup.state.FinishRun( run_id, 'failed' )
+                    self.backup.metrics.Record( self, 'backup', time.time() - start, 'failed', backup_type )
+                    raise
+                if ( ret == 0 ):
+                    self.backup.state.FinishRun( run_id, 'ok', stats.get( 'TotalDestinationSizeChange' ), stats.values )
+                    self.backup.metrics.Record( self, 'backup', time.time() - start, 'ok', backup_type, stats )
+                    break
+                self.backup.state.FinishRun( run_id, 'failed', stats = stats.values )
+                self.backup.metrics.Record( self, 'backup', time.time() - start, 'failed', backup_type, stats )
+                failure = classifier.Failure( ret )
+                if ( failure.kind == 'full' ):
+                    print 'no incremental found, forcing full backup'
+                    if ( recursed ):
+                        raise failures.BackupFailure( 'full', 'already recursed while forcing full backup' )
+                    subprocess.check_call( [ 'touch', self.fullFileFlag ] )
+                    self.Run( recursed = True )
+                    return
+                if ( failure.kind != 'transient' or attempt >= self.Setting( self.backup, 'retries', 3 ) ):
+                    raise failure
+                # don't go on past the window, the next run will pick it up
+                closed = self.backup.windows.Check( self, None )
+                if ( not closed is None ):
+                    raise failures.BackupFailure( 'transient', '%s, not retrying: %s' % ( str( failure ), closed[0] ) )
+                delay = failures.Backoff( self.backup, self, attempt )
+                attempt += 1
+                print '%s: %s, retry %d in %.0fs' % ( self.root, str( failure ), attempt, delay )
+                with self.backup.tracer.Span( 'retry wait', 'retry', target = self.root ):
+                    time.sleep( delay )
+
+            if ( not scanner is None ):
+                scanner.Commit()
+
+	    # clear the full flag if needed
+            if ( backup_type == 'full' ):
+                os.unlink( self.fullFileFlag )
+
+        if ( self.backup.maintenance == 'inline' ):
+            self.Maintain()
+
+    # the duplicity command line of the backup, with its --volsize and temporary directory
+    def command( self, backup_type, option_string ):
+        option_string = list( option_string )
+        ( volsize, why ) = tuning.VolumeSize( self.backup, self )
+        if ( not volsize is None ):
+            print '%s: --volsize %d (%s)' % ( self.root, volsize, why )
+            option_string += [ '--volsize', str( volsize ) ]
+
+        # make sure there is room for the volumes before we get going
+        if ( not self.backup.dry_run ):
+            self.chosen_tempdir = tuning.PickTempDir( self.backup, self, volsize )
+        ( tempdir, explicit ) = self.TempDir()
+        if ( explicit ):
             option_string += [ '--tempdir', tempdir ]
 
         # avoid a bad recursion problem in 5.0.2 - make sure to skip the tempdir
@@ -181,34 +698,55 @@ class BackupTarget( object ):
         cmd.append( self.root )
         cmd.append( self.destination )
         print repr( cmd )
-
-        if ( not self.backup.dry_run ):
-            p = subprocess.Popen( cmd, stdin = None, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, shell = False )
-            # p.communicate is nice, but I want to print output as we go
-            # NOTE: using a tee class would be a better way to do this clearly
-            failed_incremental = False
-            ret = None
-            while ( ret is None ):
-                out = p.stdout.read()
-                if ( len( out ) != 0 ):
-                    sys.stdout.write( out )
-                    if ( out.find( 'Old signatures not found and incremental specified' ) != -1 ):
-                        failed_incremental = True
-                ret = p.poll()
-                print repr( ret )
-            if ( ret != 0 ):
-                if ( failed_incremental ):
-                    print 'no incremental found, forcing full backup'
-                    if ( recursed ):
-                        raise Exception( 'already recursed while forcing full backup' )
-                    subprocess.check_call( [ 'touch', self.fullFileFlag ] )
-                    self.Run( recursed = True )
-                    return
-                raise Exception( 'backup failed' )
-
-	    # clear the full flag if needed
-            if ( backup_type == 'full' ):
-                os.unlink( self.fullFileFlag )
+        return cmd
+
+    # run a command through the output pump, raises if it fails
+    # returns False if it was terminated because it ran out of time
+    # with a phase name, the duration goes to the metrics
+    def Call( self, cmd, timeout = None, phase = None ):
+        out = self.backup.OutputPump( self.root, self )
+        start = time.time()
+        ret = out.Run( cmd, timeout = timeout )
+        if ( not phase is None ):
+            result = 'ok'
+            if ( out.timedout ):
+                result = 'timeout'
+            elif ( ret != 0 ):
+                result = 'failed'
+            self.backup.metrics.Record( self, phase, time.time() - start, result )
+        if ( out.timedout ):
+            return False
+        if ( ret != 0 ):
+            raise Exception( '%s failed with exit code %d' % ( repr( cmd ), ret ) )
+        return True
+
+    # maintenance can be skipped if nothing was written to the destination since the last pass,
+    # unless the last pass is older than maintenance_every days (remove-older-than has work to do as time goes by)
+    def MaintenanceDue( self ):
+        if ( self.backup.cleanup or self.backup.force_remove_older or self.backup.dry_run ):
+            return True
+        last = self.backup.state.LastMaintenance( self.key )
+        if ( last is None ):
+            return True
+        if ( time.time() - last >= self.Setting( self.backup, 'maintenance_every', 1 ) * 24 * 3600 ):
+            return True
+        wrote = self.backup.state.LastWrite( self.key )
+        return ( not wrote is None and wrote['finished'] > last )
+
+    def TracedMaintain( self, deadline = None ):
+        with self.backup.tracer.Span( 'maintenance', 'maintenance', target = self.root ):
+            return self.Maintain( deadline )
+
+    # cleanup and remove-older-than on the destination
+    # deadline is a time.time() value, commands still running by then are terminated and False is returned
+    def Maintain( self, deadline = None ):
+        if ( not self.MaintenanceDue() ):
+            print '%s: no change on the destination since the last maintenance, skipping' % self.root
+            return True
+
+        timeout = None
+        if ( not deadline is None ):
+            timeout = deadline - time.time()
 
         option_string = [ '--extra-clean' ]
         if ( self.shortFilenames ):
@@ -216,13 +754,19 @@ class BackupTarget( object ):
         if ( self.backup.config.has_key('duplicity_args') ):
             option_string += self.backup.config['duplicity_args']
 
+        ran = False
         cmd = [ self.backup.duplicity, 'cleanup' ]
         cmd += option_string
         cmd.append( '--force' )
         cmd.append( self.destination )
         print( repr( cmd ) )
         if ( self.backup.cleanup or not self.backup.dry_run ):
-            subprocess.check_call( cmd )
+            ran = True
+            # about to change the destination
+            self.backup.state.InvalidateStatus( self.destination )
+            if ( not self.Call( cmd, timeout, 'cleanup' ) ):
+                print '%s: maintenance ran out of time' % self.root
+                return False
 
         if ( self.backup.remove_older != 0 ):
             cmd = [ self.backup.duplicity, 'remove-older-than', '%dD' % self.backup.remove_older, '--force' ]
@@ -230,9 +774,20 @@ class BackupTarget( object ):
             cmd.append( self.destination )
             print( repr( cmd ) )
             if ( self.backup.force_remove_older or not self.backup.dry_run ):
-                subprocess.check_call( cmd )
-
-    def Finish( self ):
+                if ( not deadline is None ):
+                    timeout = deadline - time.time()
+                ran = True
+                self.backup.state.InvalidateStatus( self.destination )
+                if ( not self.Call( cmd, timeout, 'remove-older' ) ):
+                    print '%s: maintenance ran out of time' % self.root
+                    return False
+
+        if ( ran ):
+            self.backup.state.MarkMaintained( self.key )
+        return True
+
+    # run collection-status and cache its output
+    def RefreshStatus( self ):
         option_string = []
         if ( self.shortFilenames ):
             option_string.append( '--short-filenames' )
@@ -242,40 +797,75 @@ class BackupTarget( object ):
         cmd += option_string
         cmd.append( self.destination )
         print( repr( cmd ) )
-        subprocess.check_call( cmd )
+        buf = pump.LineBuffer()
+        out = pump.OutputPump( [ buf ], timestamps = False, tracer = self.backup.tracer, label = self.root )
+        start = time.time()
+        ret = out.Run( cmd )
+        self.backup.metrics.Record( self, 'status', time.time() - start, { True : 'ok', False : 'failed' }[ ret == 0 ] )
+        if ( ret != 0 ):
+            sys.stdout.write( buf.Text() )
+            raise Exception( 'collection-status failed' )
+        self.backup.state.StoreStatus( self.destination, buf.Text() )
+
+    def TracedRefreshStatus( self ):
+        with self.backup.tracer.Span( 'status', 'status', target = self.root ):
+            self.RefreshStatus()
+
+    # parsed collection-status and the time it was fetched, from the cache if it's recent enough
+    def Status( self ):
+        cached = self.backup.state.CachedStatus( self.destination, self.backup.status_ttl )
+        if ( cached is None ):
+            self.RefreshStatus()
+            cached = self.backup.state.CachedStatus( self.destination, None )
+        ( fetched, output ) = cached
+        return ( status.CollectionStatus( output ), fetched )
+
+    def Finish( self ):
+        ( model, fetched ) = self.Status()
+        sys.stdout.write( model.output )
+        print '%s (as of %s)' % ( model.Summary(), time.ctime( fetched ) )
 
+# the snapshots are handled by lvm.SnapshotManager, for all the LVM targets of the run at once
+# snapsize is the size of the first snapshot, once there is some history the size is computed from it
+# (use 'auto' to start from a fifth of the origin)
 class LVMBackupTarget( BackupTarget ):
-    def __init__( self, root, destination, lvmpath, snapsize, snapshot_name, snapshot_path, exclude = [], shortFilenames = False ):
-        BackupTarget.__init__( self, root, destination, exclude = exclude, shortFilenames = shortFilenames )
+    # the other keyword arguments of BackupTarget (include, window ..) are passed on
+    def __init__( self, root, destination, lvmpath, snapsize, snapshot_name, snapshot_path, exclude = [], shortFilenames = False, **kwargs ):
+        BackupTarget.__init__( self, root, destination, exclude = exclude, shortFilenames = shortFilenames, **kwargs )
         self.lvmpath = lvmpath
         self.snapsize = snapsize
         self.snapshot_name = snapshot_name
         self.snapshot_path = snapshot_path
+        # the lvm.SnapshotManager in charge of the snapshot
+        self.snapshots = None
         # otherwrite the parent class's name to avoid collisions
         self.fullFileFlag = os.path.normpath( '%s.full' % lvmpath.replace( '/', '_' ) )
 
     def Run( self, recursed = False ):
-        # create snapshot
-        if ( not recursed ): # only done once at top level, recursed is the path for 'try again with a full backup'
-            cmd = [ 'lvcreate', '-s', '-L', self.snapsize, '-n', self.snapshot_name, self.lvmpath ]
-            print cmd
-            subprocess.check_call( cmd )
-            cmd = [ 'mount', '-t', 'auto', self.snapshot_path, self.root ]
-            print cmd
-            subprocess.check_call( cmd )
+        if ( recursed ): # recursed is the path for 'try again with a full backup', the snapshot is still there
+            BackupTarget.Run( self, recursed = recursed )
+            return
+        self.snapshots.Ready( self )
+        valid = True
         try:
             BackupTarget.Run( self, recursed = recursed )
         finally:
-            if ( not recursed ): # only done once at top level, recursed is the path for 'try again with a full backup'            
-                # release snapshot - making sure to do that in a cleanup handler so we release the snap no matter what
-                cmd = [ 'umount', self.root ]
-                print cmd
-                subprocess.check_call( cmd )
-                cmd = [ 'lvremove', '-f', self.snapshot_path ]
-                print cmd
-                subprocess.check_call( cmd )
+            # release the snapshot no matter what, and right away rather than at the end of the run
+            valid = self.snapshots.Release( self )
+        if ( not valid ):
+            raise Exception( 'snapshot %s overflowed during the backup, it has to be done again' % self.snapshot_path )
 
 if ( __name__ == '__main__' ):
     import config
+    # the targets, hooks and stages running in parallel all print
+    pump.SerializeOutput()
     backup = config.readConfig( sys.argv )
-    backup['backup'].Run()
+    if ( backup['backup'].daemon ):
+        import daemon
+        daemon.Daemon( backup ).Run()
+    else:
+        try:
+            backup['backup'].Run()
+        except failures.RunFailed, e:
+            print str( e )
+            sys.exit( e.status )
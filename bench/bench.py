@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# benchmarks of dupinanny's own overhead, against fakeduplicity.py instead of a real backend
+# each run writes a synthetic config in a scratch directory and runs backup.py on it in a child process,
+# the numbers come from the child's resource usage and from its trace (see tracing.py):
+#   wall           total run time
+#   cpu            user + system time of dupinanny itself, the fake duplicity processes are not included
+#   subprocess     time spent waiting on duplicity, summed over all the targets
+#   overhead       wall time minus the time the same jobs take in scheduler.simulate, in the same order
+#   ideal          the makespan with the longest jobs first, what the ordering could get at best
+#   lock_wait      time spent waiting on the locks
+#   maxrss         peak resident memory of the dupinanny process, KB
+#
+# ./bench.py                          run all the scenarios, results go to bench-<date>.json
+# ./bench.py --only scale,output      run some of them
+# ./bench.py --compare old.json       run, then compare with an earlier result file
+# ./bench.py --compare old.json new.json
+
+from __future__ import with_statement
+
+import os, sys, time, json, shutil, tempfile, threading, subprocess, resource, platform, pprint
+from optparse import OptionParser
+
+bench_dir = os.path.dirname( os.path.abspath( __file__ ) )
+top_dir = os.path.dirname( bench_dir )
+sys.path.insert( 0, top_dir )
+
+import scheduler, lock
+
+# name, description, list of runs
+# each run: targets, max_parallel, max_per_host, hosts, order, the fake duplicity environment,
+# warmup runs to build up history first, lock hold time
+def scenarios():
+    ret = []
+    ret.append( ( 'scale', 'per target cost of the orchestration, serial runs', [ { 'targets' : n } for n in [ 1, 10, 100, 500 ] ] ) )
+    runs = []
+    for parallel in [ 1, 2, 4, 8 ]:
+        for order in [ 'config', 'history' ]:
+            runs.append( { 'targets' : 40, 'max_parallel' : parallel, 'order' : order, 'warmup' : 1, 'env' : { 'FAKEDUP_DURATION' : '0.1', 'FAKEDUP_SKEW' : '10' } } )
+    ret.append( ( 'parallel', 'parallelism and ordering, with a few long targets among many short ones', runs ) )
+    ret.append( ( 'hosts', 'per host limit, 4 destination hosts', [ { 'targets' : 40, 'max_parallel' : 8, 'max_per_host' : m, 'hosts' : 4, 'env' : { 'FAKEDUP_DURATION' : '0.1' } } for m in [ None, 1, 2 ] ] ) )
+    runs = []
+    for ( lines, size ) in [ ( 0, 80 ), ( 10000, 80 ), ( 100000, 200 ) ]:
+        runs.append( { 'targets' : 4, 'max_parallel' : 4, 'env' : { 'FAKEDUP_LINES' : str( lines ), 'FAKEDUP_LINE_SIZE' : str( size ), 'FAKEDUP_BURST' : '1' } } )
+    runs.append( { 'targets' : 1, 'env' : { 'FAKEDUP_LINES' : '1', 'FAKEDUP_LINE_SIZE' : str( 32 * 1024 * 1024 ), 'FAKEDUP_BURST' : '1' } } )
+    ret.append( ( 'output', 'memory use of the output handling, up to 20MB of output per target and a 32MB line', runs ) )
+    ret.append( ( 'lock', 'waiting for the global lock held by another process', [ { 'targets' : 4, 'hold_lock' : h } for h in [ 0, 2 ] ] ) )
+    ret.append( ( 'nosig', 'incrementals failing on missing signatures and retried as full', [ { 'targets' : 10, 'env' : { 'FAKEDUP_NOSIG' : '.' } } ] ) )
+    return ret
+
+def writeConfig( work, run ):
+    items = []
+    for i in range( run['targets'] ):
+        root = os.path.join( work, 'src', 't%03d' % i )
+        if ( not os.path.exists( root ) ):
+            os.makedirs( root )
+        items.append( 'BackupTarget( %s, %s )' % ( repr( root ), repr( 'rsync://@host%d::t%03d' % ( i % run.get( 'hosts', 1 ), i ) ) ) )
+    config = { 'lockfile' : os.path.join( work, 'dupinanny.lock' ), 'duplicity' : os.path.join( bench_dir, 'fakeduplicity.py' ), 'max_parallel' : run.get( 'max_parallel', 1 ), 'order' : run.get( 'order', 'config' ), 'lock_wait' : 600 }
+    if ( not run.get( 'max_per_host' ) is None ):
+        config['max_per_host'] = run['max_per_host']
+    path = os.path.join( work, 'bench.cfg' )
+    handle = file( path, 'w' )
+    handle.write( 'from backup import BackupTarget\n' )
+    handle.write( 'DupiConfig = {}\n' )
+    handle.write( 'DupiConfig[\'config\'] = %s\n' % pprint.pformat( config ) )
+    handle.write( 'DupiConfig[\'items\'] = [\n    %s,\n]\n' % ',\n    '.join( items ) )
+    handle.close()
+    return path
+
+# runs in the child process: one dupinanny run, the resource usage goes to the result file
+def child( config_file, trace_file, result_file ):
+    import config, pump
+    pump.SerializeOutput()
+    dupi = config.readConfig( [ '--config', config_file, '--new-cycle', '--trace', trace_file ] )
+    start = time.time()
+    status = 'ok'
+    try:
+        dupi['backup'].Run()
+    except Exception, e:
+        status = str( e )
+    usage = resource.getrusage( resource.RUSAGE_SELF )
+    handle = file( result_file, 'w' )
+    json.dump( { 'wall' : time.time() - start, 'cpu' : usage.ru_utime + usage.ru_stime, 'maxrss' : usage.ru_maxrss, 'status' : status }, handle )
+    handle.close()
+
+# one dupinanny run of the given config, with its output sent to a log file like it would from cron
+def runOnce( work, config_file, env, hold_lock = 0 ):
+    trace_file = os.path.join( work, 'trace.json' )
+    result_file = os.path.join( work, 'result.json' )
+    holder = None
+    if ( hold_lock > 0 ):
+        holder = lock.lock( os.path.join( work, 'dupinanny.lock' ), 'bench holding the lock' )
+        holder.acquire()
+        threading.Timer( hold_lock, holder.release ).start()
+    log = file( os.path.join( work, 'output.log' ), 'a' )
+    try:
+        ret = subprocess.call( [ sys.executable, os.path.abspath( __file__ ), '--child', config_file, trace_file, result_file ], cwd = work, env = env, stdout = log, stderr = subprocess.STDOUT )
+    finally:
+        log.close()
+    if ( ret != 0 ):
+        raise Exception( 'benchmark run failed with exit code %d, see %s' % ( ret, os.path.join( work, 'output.log' ) ) )
+    handle = file( result_file )
+    result = json.load( handle )
+    handle.close()
+    handle = file( trace_file )
+    spans = [ e for e in json.load( handle )['traceEvents'] if e['ph'] == 'X' ]
+    handle.close()
+    return ( result, spans )
+
+def analyze( run, result, spans ):
+    subprocesses = [ s for s in spans if s['cat'] == 'subprocess' ]
+    result['subprocess'] = sum( [ s['dur'] for s in subprocesses ] ) / 1e6
+    result['subprocesses'] = len( subprocesses )
+    result['lock_wait'] = sum( [ s['dur'] for s in spans if s['cat'] == 'lock' ] ) / 1e6
+    # the backup stage as dupinanny ran it, against what the scheduler would have done with the same durations
+    runs = sorted( [ s for s in spans if s['cat'] == 'run' ], key = lambda s : s['ts'] )
+    if ( len( runs ) != 0 ):
+        busy = {}
+        for s in subprocesses:
+            if ( s['name'].split()[1] in [ 'incremental', 'full' ] ):
+                busy[ s['args']['target'] ] = busy.get( s['args']['target'], 0 ) + s['dur'] / 1e6
+        hosts = max( run.get( 'hosts', 1 ), 1 )
+        jobs = [ ( s['args']['target'], 'host%d' % ( int( s['args']['target'][-3:] ) % hosts ), busy.get( s['args']['target'], 0 ) ) for s in runs ]
+        stage = ( max( [ s['ts'] + s['dur'] for s in runs ] ) - runs[0]['ts'] ) / 1e6
+        actual = max( [ p[2] for p in scheduler.simulate( run.get( 'max_parallel', 1 ), run.get( 'max_per_host' ), jobs ) ] )
+        ideal = max( [ p[2] for p in scheduler.simulate( run.get( 'max_parallel', 1 ), run.get( 'max_per_host' ), sorted( jobs, key = lambda j : -j[2] ) ) ] )
+        result['backup_stage'] = stage
+        result['overhead'] = stage - actual
+        result['ideal'] = ideal
+    return result
+
+def runScenario( name, description, runs, repeat, keep ):
+    print '###########################################################################'
+    print '%s: %s' % ( name, description )
+    print '###########################################################################'
+    ret = []
+    for run in runs:
+        work = tempfile.mkdtemp( prefix = 'dupinanny-bench-' )
+        try:
+            config_file = writeConfig( work, run )
+            env = dict( os.environ )
+            env.update( run.get( 'env', {} ) )
+            for i in range( run.get( 'warmup', 0 ) ):
+                runOnce( work, config_file, env )
+            samples = []
+            for i in range( repeat ):
+                ( result, spans ) = runOnce( work, config_file, env, run.get( 'hold_lock', 0 ) )
+                samples.append( analyze( run, result, spans ) )
+        finally:
+            if ( keep ):
+                print 'kept %s' % work
+            else:
+                shutil.rmtree( work )
+        # the best of the repeats, the others only had more noise
+        best = min( samples, key = lambda s : s['wall'] )
+        ret.append( { 'run' : run, 'result' : best, 'samples' : samples } )
+        print '%-50s %s' % ( describe( run ), format( best ) )
+    return ret
+
+def describe( run ):
+    ret = '%d targets, parallel %d' % ( run['targets'], run.get( 'max_parallel', 1 ) )
+    if ( not run.get( 'max_per_host' ) is None ):
+        ret += ', per host %d' % run['max_per_host']
+    if ( run.get( 'order', 'config' ) != 'config' ):
+        ret += ', order %s' % run['order']
+    if ( run.get( 'hold_lock', 0 ) != 0 ):
+        ret += ', lock held %ds' % run['hold_lock']
+    env = run.get( 'env', {} )
+    if ( env.has_key( 'FAKEDUP_LINES' ) ):
+        ret += ', %s lines of %s' % ( env['FAKEDUP_LINES'], env['FAKEDUP_LINE_SIZE'] )
+    return ret
+
+def format( r ):
+    ret = 'wall %6.2fs cpu %5.2fs sub %6.2fs lock %5.2fs rss %6dK' % ( r['wall'], r['cpu'], r['subprocess'], r['lock_wait'], r['maxrss'] )
+    if ( r.has_key( 'overhead' ) ):
+        ret += ' overhead %5.2fs ideal %6.2fs' % ( r['overhead'], r['ideal'] )
+    if ( r['status'] != 'ok' ):
+        ret += ' (%s)' % r['status']
+    return ret
+
+def compare( old, new ):
+    print '###########################################################################'
+    print 'compared with %s' % old['started']
+    print '###########################################################################'
+    for ( name, scenario ) in sorted( new['scenarios'].items() ):
+        if ( not old['scenarios'].has_key( name ) ):
+            continue
+        before = dict( [ ( json.dumps( r['run'], sort_keys = True ), r['result'] ) for r in old['scenarios'][ name ]['runs'] ] )
+        for r in scenario['runs']:
+            b = before.get( json.dumps( r['run'], sort_keys = True ) )
+            if ( b is None ):
+                continue
+            changes = []
+            for k in [ 'wall', 'cpu', 'overhead', 'lock_wait', 'maxrss' ]:
+                if ( not b.has_key( k ) or not r['result'].has_key( k ) ):
+                    continue
+                if ( b[k] == 0 ):
+                    changes.append( '%s %s -> %s' % ( k, b[k], r['result'][k] ) )
+                else:
+                    changes.append( '%s %+.0f%%' % ( k, ( float( r['result'][k] ) / b[k] - 1 ) * 100 ) )
+            print '%-8s %-50s %s' % ( name, describe( r['run'] ), ' '.join( changes ) )
+
+def load( path ):
+    handle = file( path )
+    ret = json.load( handle )
+    handle.close()
+    return ret
+
+if ( __name__ == '__main__' ):
+    if ( len( sys.argv ) > 1 and sys.argv[1] == '--child' ):
+        child( *sys.argv[2:5] )
+        sys.exit( 0 )
+
+    parser = OptionParser( usage = '%prog [options] [old results [new results]]' )
+    parser.add_option( '--only', action = 'store', type = 'string', dest = 'only', default = None, help = 'comma separated list of the scenarios to run' )
+    parser.add_option( '--repeat', action = 'store', type = 'int', dest = 'repeat', default = 1, help = 'run each configuration this many times and keep the fastest' )
+    parser.add_option( '--output', action = 'store', type = 'string', dest = 'output', default = None, help = 'write the results to this file (default bench-<date>.json)' )
+    parser.add_option( '--compare', action = 'store_true', dest = 'compare', help = 'compare with an earlier result file given as argument, without a second file the scenarios are run first' )
+    parser.add_option( '--keep', action = 'store_true', dest = 'keep', help = 'keep the scratch directories (config, output log, trace)' )
+    ( options, args ) = parser.parse_args()
+
+    if ( options.compare and len( args ) == 2 ):
+        compare( load( args[0] ), load( args[1] ) )
+        sys.exit( 0 )
+
+    results = { 'started' : time.strftime( '%Y-%m-%d %H:%M:%S' ), 'host' : platform.node(), 'python' : platform.python_version(), 'repeat' : options.repeat, 'scenarios' : {} }
+    for ( name, description, runs ) in scenarios():
+        if ( not options.only is None and not name in options.only.split( ',' ) ):
+            continue
+        results['scenarios'][ name ] = { 'description' : description, 'runs' : runScenario( name, description, runs, options.repeat, options.keep ) }
+
+    output = options.output
+    if ( output is None ):
+        output = 'bench-%s.json' % time.strftime( '%Y%m%d-%H%M%S' )
+    handle = file( output, 'w' )
+    json.dump( results, handle, indent = 1, sort_keys = True )
+    handle.close()
+    print 'results written to %s' % output
+
+    if ( options.compare and len( args ) == 1 ):
+        compare( load( args[0] ), results )
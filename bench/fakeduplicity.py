@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# stand-in for the duplicity executable, point 'duplicity' in the config at it
+# it does no backup at all, it only behaves like duplicity as far as dupinanny can tell:
+# run time, amount and pace of the output, exit code, statistics block, collection-status
+# everything is set through the environment:
+#   FAKEDUP_DURATION   seconds an incremental takes (default 0.05)
+#   FAKEDUP_FULL       how many times longer a full takes (default 4)
+#   FAKEDUP_SKEW       the duration of each target is scaled by a factor between 1 and SKEW,
+#                      fixed for a given destination, a few long targets and many short ones (default 1)
+#   FAKEDUP_LINES      lines printed by a backup, spread over its duration (default 20)
+#   FAKEDUP_LINE_SIZE  length of those lines (default 80)
+#   FAKEDUP_BURST      set to print all the lines at once at the start instead
+#   FAKEDUP_FAIL       regex, the backups (and verifies) of the matching destinations exit with FAKEDUP_EXIT (default 1)
+#   FAKEDUP_FAIL_LINE  the last line they print, to test the failure classification (default 'fake failure for <destination>')
+#   FAKEDUP_FAIL_TIMES they only fail that many times, then work (counted in FAKEDUP_FAIL_COUNT, a file)
+#   FAKEDUP_NOSIG      regex, the incrementals of the matching destinations fail with 'Old signatures not found'
+#   FAKEDUP_OTHER      seconds taken by the other commands (cleanup, collection-status ..) (default 0.01)
+#   FAKEDUP_FAIL_OTHER regex on '<command> <destination>', the matching other commands print an error and exit with 1
+#   FAKEDUP_CORRUPT    regex, verify finds a difference in every file of the matching destinations
+
+import os, sys, re, time, zlib
+
+def env( name, default ):
+    return type( default )( os.environ.get( 'FAKEDUP_%s' % name, default ) )
+
+def matches( name, destination ):
+    pattern = os.environ.get( 'FAKEDUP_%s' % name )
+    return ( not pattern is None and not re.search( pattern, destination ) is None )
+
+def skew( destination ):
+    # quadratic, so most targets stay close to the base duration
+    x = ( zlib.crc32( destination ) & 0xffff ) / float( 0xffff )
+    return 1 + ( env( 'SKEW', 1.0 ) - 1 ) * x * x
+
+def out( line ):
+    sys.stdout.write( line + '\n' )
+    sys.stdout.flush()
+
+def statistics( start, end, destination ):
+    size = ( zlib.crc32( destination ) & 0xfffff ) * 1024
+    out( '--------------[ Backup Statistics ]--------------' )
+    out( 'StartTime %.2f (%s)' % ( start, time.ctime( start ) ) )
+    out( 'EndTime %.2f (%s)' % ( end, time.ctime( end ) ) )
+    out( 'ElapsedTime %.2f (%.2f seconds)' % ( end - start, end - start ) )
+    out( 'SourceFiles %d' % ( size / 65536 + 1 ) )
+    out( 'SourceFileSize %d' % size )
+    out( 'NewFiles 1' )
+    out( 'NewFileSize 4096' )
+    out( 'DeletedFiles 0' )
+    out( 'ChangedFiles 1' )
+    out( 'ChangedFileSize %d' % ( size / 10 ) )
+    out( 'ChangedDeltaSize 0' )
+    out( 'DeltaEntries 2' )
+    out( 'RawDeltaSize %d' % ( size / 20 ) )
+    out( 'TotalDestinationSizeChange %d' % ( size / 40 ) )
+    out( 'Errors 0' )
+    out( '-------------------------------------------------' )
+
+def failAgain( destination ):
+    if ( not os.environ.has_key( 'FAKEDUP_FAIL_TIMES' ) ):
+        return True
+    path = '%s.%x' % ( os.environ['FAKEDUP_FAIL_COUNT'], zlib.crc32( destination ) & 0xffffffff )
+    count = 0
+    if ( os.path.exists( path ) ):
+        count = int( file( path ).read() )
+    file( path, 'w' ).write( str( count + 1 ) )
+    return ( count < env( 'FAIL_TIMES', 0 ) )
+
+def backup( backup_type, destination ):
+    start = time.time()
+    if ( backup_type == 'incremental' and matches( 'NOSIG', destination ) ):
+        out( 'Local and Remote metadata are synchronized, no sync needed.' )
+        out( 'Old signatures not found and incremental specified' )
+        return 1
+    duration = env( 'DURATION', 0.05 ) * skew( destination )
+    if ( backup_type == 'full' ):
+        duration *= env( 'FULL', 4.0 )
+    lines = env( 'LINES', 20 )
+    line = 'A ' + 'x' * max( env( 'LINE_SIZE', 80 ) - 2, 0 )
+    if ( lines == 0 or os.environ.has_key( 'FAKEDUP_BURST' ) ):
+        for i in xrange( lines ):
+            out( line )
+        time.sleep( duration )
+    else:
+        for i in xrange( lines ):
+            out( line )
+            # keep to the schedule, however long the writes took
+            delay = start + duration * ( i + 1 ) / lines - time.time()
+            if ( delay > 0 ):
+                time.sleep( delay )
+    if ( matches( 'FAIL', destination ) and failAgain( destination ) ):
+        out( os.environ.get( 'FAKEDUP_FAIL_LINE', 'fake failure for %s' % destination ) )
+        return env( 'EXIT', 1 )
+    statistics( start, time.time(), destination )
+    return 0
+
+# compares the files of the include filelist, if there is one
+def verify( destination ):
+    files = 0
+    if ( '--include-filelist' in sys.argv ):
+        handle = file( sys.argv[ sys.argv.index( '--include-filelist' ) + 1 ] )
+        files = len( [ l for l in handle if l.strip() != '' ] )
+        handle.close()
+    if ( matches( 'FAIL', destination ) ):
+        out( os.environ.get( 'FAKEDUP_FAIL_LINE', 'fake failure for %s' % destination ) )
+        return env( 'EXIT', 1 )
+    differences = 0
+    if ( matches( 'CORRUPT', destination ) ):
+        differences = files
+    out( 'Verify complete: %d files compared, %d differences found.' % ( files, differences ) )
+    return int( differences != 0 )
+
+def collectionStatus():
+    now = time.time()
+    full = time.ctime( now - 3 * 24 * 3600 )
+    out( 'Last full backup date: %s' % full )
+    out( 'Collection Status' )
+    out( '-----------------' )
+    out( 'Found primary backup chain with matching signature chain:' )
+    out( '-------------------------' )
+    out( 'Chain start time: %s' % full )
+    out( 'Chain end time: %s' % time.ctime( now ) )
+    out( 'Number of contained backup sets: 2' )
+    out( 'Total number of contained volumes: 2' )
+    out( ' Type of backup set:                            Time:      Num volumes:' )
+    out( '                Full         %s                 1' % full )
+    out( '         Incremental         %s                 1' % time.ctime( now ) )
+    out( '-------------------------' )
+    out( 'No orphaned or incomplete backup sets found.' )
+
+if ( __name__ == '__main__' ):
+    args = [ a for a in sys.argv[1:] if not a.startswith( '-' ) ]
+    if ( len( args ) == 0 ):
+        out( 'usage: fakeduplicity.py command [options] [source] destination' )
+        sys.exit( 2 )
+    command = args[0]
+    # the destination is always last, the tempdir argument is the only option that takes a value
+    destination = args[-1]
+    if ( command in [ 'incremental', 'full' ] ):
+        sys.exit( backup( command, destination ) )
+    time.sleep( env( 'OTHER', 0.01 ) )
+    if ( matches( 'FAIL_OTHER', '%s %s' % ( command, destination ) ) ):
+        out( 'fake %s failure for %s' % ( command, destination ) )
+        sys.exit( 1 )
+    if ( command == 'verify' ):
+        # verify and restore take the url first, then the local path
+        sys.exit( verify( args[-2] ) )
+    if ( command == 'collection-status' ):
+        collectionStatus()
+    sys.exit( 0 )
@@ -48,6 +48,109 @@ class ConfigBase:
         except:
             pass        
 
+        # how many backup targets may run at the same time, and how many of those may go to the same destination host
+        self.max_parallel = 1
+        try:
+            self.max_parallel = self.config['max_parallel']
+        except:
+            pass
+
+        self.max_per_host = None
+        try:
+            self.max_per_host = self.config['max_per_host']
+        except:
+            pass
+
+        # 'global' takes one lock for the whole run, 'destination' a lock per target
+        self.lock_granularity = 'global'
+        try:
+            self.lock_granularity = self.config['lock_granularity']
+        except:
+            pass
+
+        # how long to wait on a busy lock: None to abort right away, 0 to wait forever, or a number of seconds
+        self.lock_wait = None
+        try:
+            self.lock_wait = self.config['lock_wait']
+        except:
+            pass
+
+        # how many prepare (or posthook) hooks run at the same time, hooks with the same hook_group attribute run one at a time
+        # one by default: the hooks run in the order they are listed, as they always did
+        self.hook_parallel = 1
+        try:
+            self.hook_parallel = self.config['hook_parallel']
+        except:
+            pass
+
+        # seconds a hook gets to run, unless it has a timeout attribute of its own. None (the default) for no limit
+        self.hook_timeout = None
+        try:
+            self.hook_timeout = self.config['hook_timeout']
+        except:
+            pass
+
+        # 'deferred' runs cleanup and remove-older-than for all targets once the backups are done, 'inline' right after each backup
+        self.maintenance = 'deferred'
+        try:
+            self.maintenance = self.config['maintenance']
+        except:
+            pass
+
+        self.maintenance_parallel = self.max_parallel
+        try:
+            self.maintenance_parallel = self.config['maintenance_parallel']
+        except:
+            pass
+
+        # seconds, None for no limit
+        self.maintenance_budget = None
+        try:
+            self.maintenance_budget = self.config['maintenance_budget']
+        except:
+            pass
+
+        # how long a cached collection-status stays good, in seconds (it's dropped whenever we write to the destination)
+        self.status_ttl = 24 * 3600
+        try:
+            self.status_ttl = self.config['status_ttl']
+        except:
+            pass
+
+        self.status_parallel = self.max_parallel
+        try:
+            self.status_parallel = self.config['status_parallel']
+        except:
+            pass
+
+        # Chrome trace event file for the phases of the run, None to not write one
+        self.trace_file = None
+        try:
+            self.trace_file = self.config['trace_file']
+        except:
+            pass
+
+        # the daemon's status socket, next to the lock file by default
+        self.daemon_socket = os.path.join( os.path.dirname( self.lockfile ), 'dupinanny.sock' )
+        try:
+            self.daemon_socket = self.config['daemon_socket']
+        except:
+            pass
+
+        # seconds before the daemon tries again after a failure
+        self.daemon_retry = 3600
+        try:
+            self.daemon_retry = self.config['daemon_retry']
+        except:
+            pass
+
+        # per target run history, next to the lock file by default
+        self.state_file = os.path.join( os.path.dirname( self.lockfile ), 'dupinanny_state.sqlite' )
+        try:
+            self.state_file = self.config['state_file']
+        except:
+            pass
+
     def commandLineOverrides( self, options ):
         if ( options.dry_run ):
             self.dry_run = options.dry_run
@@ -70,6 +173,28 @@ class ConfigBase:
         if ( self.full ):
             print '*** FLAGING FULL BACKUP ***'
 
+        self.history = options.history
+        self.plan = options.plan
+        self.show_status = options.status
+
+        if ( not options.trace_file is None ):
+            self.trace_file = options.trace_file
+
+        self.new_cycle = options.new_cycle
+        if ( self.new_cycle ):
+            print '*** STARTING A NEW BACKUP CYCLE ***'
+
+        self.restore_paths = options.restore_paths
+        self.restore_to = options.restore_to
+        self.restore_time = options.restore_time
+
+        self.verify_only = options.verify
+
+        self.daemon = options.daemon
+        self.daemon_status = options.daemon_status
+        # kept for the daemon's config reloads
+        self.options = options
+
 def readConfig( cmdargs ):
 
     parser = OptionParser()
@@ -78,8 +203,23 @@ def readConfig( cmdargs ):
     parser.add_option( '--remove-older', action = 'store', type = 'int', dest = 'remove_older', default = None, help = 'run remove_old only, with the given value. implies --dry-run (set the value in the config to customize for each run and do other operations)' )
     parser.add_option( '--config', action = 'store', type = 'string', dest = 'configFile', default = 'config.cfg.example', help = 'use this config file' )
     parser.add_option( '--full', action = 'store_true', dest = 'full', help = 'force a full backup. will retry for each backup target if necessary until full backups are done' )
+    parser.add_option( '--new-cycle', action = 'store_true', dest = 'new_cycle', help = 'start a new backup cycle, instead of resuming with the targets that did not complete in the last one' )
+    parser.add_option( '--trace', action = 'store', type = 'string', dest = 'trace_file', default = None, help = 'write a trace of the run\'s phases and subprocesses to this file (Chrome trace event format)' )
+    parser.add_option( '--status', action = 'store_true', dest = 'status', help = 'print the collection status of each backup target, from the cache when it is recent enough, and exit' )
+    parser.add_option( '--plan', action = 'store_true', dest = 'plan', help = 'print the targets that would run, in order, with their predicted start and finish times and exit' )
+    parser.add_option( '--history', action = 'store_true', dest = 'history', help = 'print the last runs of each backup target and exit' )
+    parser.add_option( '--daemon', action = 'store_true', dest = 'daemon', help = 'keep running, start each backup target on its own schedule. SIGHUP reloads the config' )
+    parser.add_option( '--daemon-status', action = 'store_true', dest = 'daemon_status', help = 'print the status of the running daemon and exit' )
+    parser.add_option( '--restore', action = 'append', type = 'string', dest = 'restore_paths', default = [], help = 'restore this path from the backup target that holds it (can be given several times), see --restore-to' )
+    parser.add_option( '--restore-to', action = 'store', type = 'string', dest = 'restore_to', default = None, help = 'directory the restored paths are written to, under their original path' )
+    parser.add_option( '--time', action = 'store', type = 'string', dest = 'restore_time', default = None, help = 'restore from the backup as of this time (duplicity time format: 3D, 2010-01-12 ..)' )
+    parser.add_option( '--verify', action = 'store_true', dest = 'verify', help = 'run tonight\'s sampled verification of each backup target (see \'verify_days\') and exit' )
     ( options, args ) = parser.parse_args( cmdargs )
-    
+
+    return loadConfig( options )
+
+# read the config file and set up the backup object, the daemon calls this again to reload
+def loadConfig( options ):
     globals = {}
     locals = {}
     try:
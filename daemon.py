@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# --daemon: load the config once and start each target when its schedule says so
+# a target's schedule is a cron expression ('0 3 * * *', '@daily' ..) or an interval ( 6 * 3600, '6h', '2d' ),
+# from its schedule argument or the 'schedule' config value, one backup every backup_every days (1 by default) otherwise
+# the targets share the max_parallel / max_per_host slots. the prepare hooks run before a target starts
+# when nothing else is running, the posthooks once everything is done
+# a target that can't run in its window (see windows.py) waits for the next one
+# SIGHUP reloads the config (once the running targets are done), SIGTERM waits for them and exits
+# the status is served as JSON on a UNIX socket ('daemon_socket', see --daemon-status)
+
+from __future__ import with_statement
+
+import os, re, time, json, socket, signal, datetime, threading, traceback
+
+import config, scheduler, hooks, tracing
+
+# fields: minute, hour, day of month, month, day of week (0 or 7 is sunday)
+class CronSchedule( object ):
+    nicknames = { '@hourly' : '0 * * * *', '@daily' : '0 0 * * *', '@midnight' : '0 0 * * *', '@weekly' : '0 0 * * 0', '@monthly' : '0 0 1 * *', '@yearly' : '0 0 1 1 *', '@annually' : '0 0 1 1 *' }
+    ranges = [ ( 0, 59 ), ( 0, 23 ), ( 1, 31 ), ( 1, 12 ), ( 0, 7 ) ]
+
+    def __init__( self, expression ):
+        self.expression = expression
+        fields = self.nicknames.get( expression, expression ).split()
+        if ( len( fields ) != 5 ):
+            raise Exception( 'bad cron expression %s' % repr( expression ) )
+        ( self.minutes, self.hours, self.days, self.months, self.weekdays ) = [ self.parseField( f, r ) for ( f, r ) in zip( fields, self.ranges ) ]
+        if ( 7 in self.weekdays ):
+            self.weekdays.add( 0 )
+        # like cron: when both the day of month and the day of week are restricted, either one matches
+        self.any_day = ( fields[2] != '*' and fields[4] != '*' )
+
+    def parseField( self, field, limits ):
+        ( low, high ) = limits
+        ret = set()
+        for part in field.split( ',' ):
+            m = re.match( r'^(\*|(\d+)(-(\d+))?)(/(\d+))?$', part )
+            if ( m is None ):
+                raise Exception( 'bad cron field %s' % repr( field ) )
+            if ( m.group( 1 ) == '*' ):
+                ( first, last ) = ( low, high )
+            else:
+                first = int( m.group( 2 ) )
+                last = first
+                if ( not m.group( 4 ) is None ):
+                    last = int( m.group( 4 ) )
+                elif ( not m.group( 6 ) is None ):
+                    last = high
+            if ( first < low or last > high or first > last ):
+                raise Exception( 'cron field %s out of range' % repr( field ) )
+            step = int( m.group( 6 ) or 1 )
+            ret.update( range( first, last + 1, step ) )
+        return ret
+
+    def dayMatches( self, d ):
+        dom = d.day in self.days
+        dow = ( d.isoweekday() % 7 ) in self.weekdays
+        if ( self.any_day ):
+            return dom or dow
+        return dom and dow
+
+    # first matching minute strictly after the given time
+    def Next( self, after ):
+        t = datetime.datetime.fromtimestamp( after ).replace( second = 0, microsecond = 0 ) + datetime.timedelta( minutes = 1 )
+        limit = t + datetime.timedelta( days = 5 * 366 )
+        while ( t < limit ):
+            if ( not t.month in self.months ):
+                t = ( t.replace( day = 1, hour = 0, minute = 0 ) + datetime.timedelta( days = 32 ) ).replace( day = 1 )
+                continue
+            if ( not self.dayMatches( t ) ):
+                t = t.replace( hour = 0, minute = 0 ) + datetime.timedelta( days = 1 )
+                continue
+            if ( not t.hour in self.hours ):
+                t = t.replace( minute = 0 ) + datetime.timedelta( hours = 1 )
+                continue
+            if ( not t.minute in self.minutes ):
+                t += datetime.timedelta( minutes = 1 )
+                continue
+            return time.mktime( t.timetuple() )
+        raise Exception( 'cron expression %s never matches' % repr( self.expression ) )
+
+    def __str__( self ):
+        return self.expression
+
+class IntervalSchedule( object ):
+    units = { 's' : 1, 'm' : 60, 'h' : 3600, 'd' : 24 * 3600, 'w' : 7 * 24 * 3600 }
+
+    def __init__( self, interval ):
+        self.interval = interval
+
+    def Next( self, after ):
+        return after + self.interval
+
+    def __str__( self ):
+        for u in [ 'w', 'd', 'h', 'm' ]:
+            if ( self.interval >= self.units[ u ] and self.interval % self.units[ u ] == 0 ):
+                return 'every %d%s' % ( self.interval / self.units[ u ], u )
+        return 'every %gs' % self.interval
+
+# a number of seconds, '90m', '6h', '2d' .. or a cron expression
+def parseSchedule( value ):
+    if ( isinstance( value, ( int, long, float ) ) ):
+        return IntervalSchedule( value )
+    m = re.match( r'^\s*(\d+(\.\d+)?)\s*([smhdw])\s*$', value )
+    if ( not m is None ):
+        return IntervalSchedule( float( m.group( 1 ) ) * IntervalSchedule.units[ m.group( 3 ) ] )
+    return CronSchedule( value.strip() )
+
+class Daemon( object ):
+    def __init__( self, dupi ):
+        self.dupi = dupi
+        self.backup = dupi['backup']
+        self.started = time.time()
+        self.reload = False
+        self.stopping = False
+        # a batch is the time between the first target starting and the last one finishing, the hooks run around it
+        self.busy = False
+        self.lock = threading.Lock()
+        # target key -> target, schedule, next start, job start ( None when idle ), last outcome
+        self.targets = {}
+        self.plan()
+
+    def schedule( self, t ):
+        value = t.Setting( self.backup, 'schedule' )
+        if ( value is None ):
+            return IntervalSchedule( ( t.Setting( self.backup, 'backup_every' ) or 1 ) * 24 * 3600 )
+        return parseSchedule( value )
+
+    # the next start of each target, a missed start (daemon down, config reloaded ..) is caught up right away
+    def plan( self ):
+        now = time.time()
+        targets = {}
+        for t in self.dupi.get( 'items', [] ):
+            t.backup = self.backup
+            sched = self.schedule( t )
+            last = self.backup.state.LastRun( t.key, status = 'ok' )
+            if ( last is None ):
+                if ( isinstance( sched, IntervalSchedule ) ):
+                    next = now
+                else:
+                    next = sched.Next( now )
+            else:
+                next = max( sched.Next( last['started'] ), now )
+            targets[ t.key ] = { 'target' : t, 'schedule' : sched, 'next' : next, 'started' : None, 'last' : None }
+            print '%s: %s, next start %s' % ( t.root, sched, time.ctime( next ) )
+        with self.lock:
+            for ( key, entry ) in targets.items():
+                if ( self.targets.has_key( key ) ):
+                    entry['last'] = self.targets[ key ]['last']
+            self.targets = targets
+
+    def Reload( self ):
+        self.reload = False
+        print '###########################################################################'
+        print 'reloading %s' % self.backup.options.configFile
+        print '###########################################################################'
+        try:
+            dupi = config.loadConfig( self.backup.options )
+        except:
+            traceback.print_exc()
+            print 'config reload failed, keeping the current one'
+            return
+        old = self.backup
+        self.dupi = dupi
+        self.backup = dupi['backup']
+        # the slots are the new ones, nothing is running so there's nothing to carry over
+        old.state.close()
+        if ( not old.output_log is None ):
+            old.output_log.close()
+        self.plan()
+
+    def signal( self, signum, frame ):
+        if ( signum == signal.SIGHUP ):
+            self.reload = True
+            return
+        if ( self.stopping ):
+            print 'stopping now'
+            os._exit( 1 )
+        print 'stopping once the running targets are done (again to stop now)'
+        self.stopping = True
+
+    def running( self ):
+        return [ e for e in self.targets.values() if not e['started'] is None ]
+
+    def job( self, entry, host ):
+        t = entry['target']
+        outcome = 'ok'
+        error = None
+        try:
+            try:
+                self.backup.RunTarget( t )
+            except Exception, e:
+                outcome = 'failed'
+                error = str( e )
+                print '%s failed:' % t.root
+                traceback.print_exc()
+        finally:
+            now = time.time()
+            with self.lock:
+                entry['last'] = { 'status' : outcome, 'started' : entry['started'], 'finished' : now, 'error' : error }
+                if ( isinstance( entry['schedule'], IntervalSchedule ) ):
+                    # keep the cadence from the start times
+                    entry['next'] = max( entry['schedule'].Next( entry['started'] ), now )
+                else:
+                    entry['next'] = entry['schedule'].Next( now )
+                if ( outcome != 'ok' ):
+                    entry['next'] = min( entry['next'], now + self.backup.daemon_retry )
+                entry['started'] = None
+            print '%s: %s, next start %s' % ( t.root, outcome, time.ctime( entry['next'] ) )
+            pool = self.backup.slots
+            with pool.cond:
+                pool.give( host )
+                pool.cond.notifyAll()
+
+    # the window check, a target that can't start now is put off until its window opens
+    def admit( self, entry ):
+        t = entry['target']
+        check = self.backup.windows.Check( t, t.PredictDuration( self.backup, t.PlannedType( self.backup ) ) )
+        if ( check is None ):
+            return True
+        ( reason, next ) = check
+        if ( next is None ):
+            # a window that never opens, check again later in case the config changes
+            next = time.time() + self.backup.daemon_retry
+        with self.lock:
+            entry['next'] = max( next, time.time() + 1 )
+        print '%s: %s, next start %s' % ( t.root, reason, time.ctime( entry['next'] ) )
+        return False
+
+    def startBatch( self ):
+        self.backup.mounts = hooks.MountTable()
+        # full backup decisions are made again for each batch
+        self.backup.policy = None
+        try:
+            self.backup.Prepare()
+        except Exception, e:
+            print 'prepare failed, retrying in %ds: %s' % ( self.backup.daemon_retry, str( e ) )
+            with self.lock:
+                for entry in self.targets.values():
+                    entry['next'] = max( entry['next'], time.time() + self.backup.daemon_retry )
+            return False
+        self.busy = True
+        return True
+
+    def endBatch( self ):
+        self.busy = False
+        try:
+            self.backup.Posthook()
+        except Exception, e:
+            print 'posthook failed: %s' % str( e )
+        self.backup.metrics.WriteProm( self.backup, self.dupi.get( 'items', [] ) )
+        self.backup.tracer.Slowest()
+        if ( not self.backup.trace_file is None ):
+            self.backup.tracer.Export( self.backup.trace_file )
+        # start over, spans would pile up otherwise
+        self.backup.tracer = tracing.Tracer()
+
+    def loop( self ):
+        while ( True ):
+            running = len( self.running() )
+            if ( running == 0 ):
+                if ( self.busy ):
+                    self.endBatch()
+                if ( self.stopping ):
+                    return
+                if ( self.reload ):
+                    self.Reload()
+            now = time.time()
+            with self.lock:
+                due = sorted( [ e for e in self.targets.values() if e['started'] is None and e['next'] <= now ], key = lambda e : e['next'] )
+            due = [ e for e in due if self.admit( e ) ]
+            # nothing new while waiting to stop or to reload
+            if ( len( due ) != 0 and not self.stopping and not self.reload ):
+                if ( self.busy or self.startBatch() ):
+                    pool = self.backup.slots
+                    with pool.cond:
+                        for e in due:
+                            host = scheduler.destinationHost( e['target'].destination )
+                            if ( not pool.available( host ) ):
+                                continue
+                            pool.take( host )
+                            e['started'] = time.time()
+                            t = threading.Thread( target = self.job, args = ( e, host ), name = 'run %s' % e['target'].root )
+                            t.setDaemon( True )
+                            t.start()
+            with self.lock:
+                idle = [ e['next'] for e in self.targets.values() if e['started'] is None ]
+            wait = 60
+            if ( len( idle ) != 0 ):
+                wait = min( max( min( idle ) - time.time(), 0.5 ), 60 )
+            pool = self.backup.slots
+            with pool.cond:
+                # a finishing job wakes us up
+                pool.cond.wait( wait )
+
+    def Status( self ):
+        with self.lock:
+            targets = []
+            for e in sorted( self.targets.values(), key = lambda e : e['target'].root ):
+                state = 'idle'
+                if ( not e['started'] is None ):
+                    state = 'running'
+                    if ( self.backup.windows.Paused( e['target'] ) ):
+                        state = 'paused'
+                targets.append( { 'root' : e['target'].root, 'destination' : e['target'].destination, 'schedule' : str( e['schedule'] ), 'state' : state, 'started' : e['started'], 'next' : e['next'], 'last' : e['last'] } )
+        return { 'pid' : os.getpid(), 'started' : self.started, 'config' : self.backup.options.configFile, 'reload_pending' : self.reload, 'stopping' : self.stopping, 'max_parallel' : self.backup.max_parallel, 'targets' : targets }
+
+    def serve( self, server ):
+        while ( True ):
+            ( conn, address ) = server.accept()
+            try:
+                conn.sendall( json.dumps( self.Status(), sort_keys = True ) + '\n' )
+            except Exception, e:
+                print 'status socket: %s' % str( e )
+            conn.close()
+
+    def listen( self ):
+        path = self.backup.daemon_socket
+        if ( os.path.exists( path ) ):
+            probe = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+            try:
+                probe.connect( path )
+                raise Exception( 'a daemon is already listening on %s' % path )
+            except socket.error:
+                # left over from a daemon that's gone
+                os.unlink( path )
+            finally:
+                probe.close()
+        server = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        server.bind( path )
+        os.chmod( path, 0600 )
+        server.listen( 5 )
+        t = threading.Thread( target = self.serve, args = ( server, ), name = 'status socket' )
+        t.setDaemon( True )
+        t.start()
+        return path
+
+    def Run( self ):
+        if ( self.backup.full ):
+            print '--full is ignored in daemon mode'
+            self.backup.full = False
+        for s in [ signal.SIGHUP, signal.SIGTERM, signal.SIGINT ]:
+            signal.signal( s, self.signal )
+        # the lock is held for the life of the daemon (with 'lock_granularity' : 'destination', each target locks its own)
+        with self.backup.ManageLock():
+            path = self.listen()
+            print 'daemon running, pid %d, status on %s' % ( os.getpid(), path )
+            try:
+                self.loop()
+            finally:
+                self.backup.windows.ResumeAll()
+                os.unlink( path )
+        print 'daemon stopped'
+
+# --daemon-status
+def PrintStatus( path ):
+    client = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    try:
+        client.connect( path )
+    except socket.error, e:
+        raise Exception( 'no daemon listening on %s: %s' % ( path, str( e ) ) )
+    data = ''
+    while ( True ):
+        chunk = client.recv( 65536 )
+        if ( len( chunk ) == 0 ):
+            break
+        data += chunk
+    client.close()
+    status = json.loads( data )
+    print 'daemon pid %d, up since %s, config %s' % ( status['pid'], time.ctime( status['started'] ), status['config'] )
+    if ( status['reload_pending'] ):
+        print 'config reload pending'
+    if ( status['stopping'] ):
+        print 'stopping'
+    for t in status['targets']:
+        last = 'never ran'
+        if ( not t['last'] is None ):
+            last = 'last %s %s' % ( t['last']['status'], time.strftime( '%a %H:%M', time.localtime( t['last']['finished'] ) ) )
+        if ( t['state'] in [ 'running', 'paused' ] ):
+            state = '%s since %s' % ( t['state'], time.strftime( '%a %H:%M', time.localtime( t['started'] ) ) )
+        else:
+            state = 'next %s' % time.strftime( '%a %H:%M', time.localtime( t['next'] ) )
+        print '%-30s %-20s %-24s %s' % ( t['root'], t['schedule'], state, last )
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# what went wrong with a duplicity backup, from its output:
+# 'full'      - there is nothing to build an incremental on, a full backup is needed
+# 'transient' - the connection dropped, the backend is throttling .. running it again should do,
+#               duplicity picks up an interrupted backup where it stopped
+# 'fatal'     - bad credentials, no space left .. running it again won't help
+# a failure that matches none of the patterns is 'failed', and is not retried either
+# 'failure_patterns' in the config adds to the built in patterns: { 'transient' : [ r'regex' .. ], 'fatal' : [ .. ] }
+# the 'fatal_patterns' that terminate duplicity classify as 'fatal'
+# the transient failures are retried 'retries' times, after 'retry_delay' seconds doubling each time up to 'retry_max_delay',
+# with some jitter so the targets that failed together don't all go back at the same time
+
+import random
+
+kinds = [ 'full', 'fatal', 'transient' ]
+
+default_patterns = {
+    'full' : [
+        r'Old signatures not found and incremental specified',
+    ],
+    'fatal' : [
+        r'GPGError',
+        r'gpg: decryption failed',
+        r'[Bb]ad passphrase',
+        r'No space left on device',
+        r'Disk quota exceeded',
+        r'Host key verification failed',
+        r'Permission denied \(publickey',
+        r'AccessDenied|InvalidAccessKeyId|SignatureDoesNotMatch|NoSuchBucket',
+        r'@ERROR: auth failed',
+    ],
+    'transient' : [
+        r'Connection (reset by peer|timed out|refused|closed)',
+        r'Broken pipe',
+        r'Network is unreachable|No route to host',
+        r'Temporary failure in name resolution',
+        r'rsync error: (error in socket IO|timeout|error in rsync protocol data stream)',
+        r'SSLError|ssl\.SSL',
+        r'SlowDown|RequestTimeout|ServiceUnavailable|Throttling|RequestLimitExceeded',
+        r'Giving up after \d+ attempts',
+        r'HTTP Error 5\d\d',
+    ],
+}
+
+# the exit status of a run: the worst of what happened to its targets
+# (1 is left for errors that stopped the run itself, python's exit status for an uncaught exception)
+exit_status = { 'ok' : 0, 'transient' : 2, 'failed' : 3, 'full' : 3, 'fatal' : 3, 'corrupt' : 4 }
+
+class BackupFailure( Exception ):
+    def __init__( self, kind, message ):
+        Exception.__init__( self, message )
+        self.kind = kind
+
+# raised at the end of a run where some targets failed, the exit status goes with it
+class RunFailed( Exception ):
+    def __init__( self, status, message ):
+        Exception.__init__( self, message )
+        self.status = status
+
+# the kind of failure of a scheduler.JobResult
+def Kind( result ):
+    return getattr( result.error, 'kind', 'failed' )
+
+def ExitStatus( kinds ):
+    return max( [ 0 ] + [ exit_status.get( k, exit_status['failed'] ) for k in kinds ] )
+
+# watches the output of one duplicity run
+class Classifier( object ):
+    def __init__( self, backup, out ):
+        self.out = out
+        # ( kind, line ) in the order they showed up
+        self.matches = []
+        extra = backup.config.get( 'failure_patterns', {} )
+        for kind in kinds:
+            for p in default_patterns[ kind ] + extra.get( kind, [] ):
+                out.addPattern( p, lambda m, kind = kind : self.matches.append( ( kind, m.string.rstrip( '\n' ) ) ) )
+
+    # the failure of the run that exited with ret
+    def Failure( self, ret ):
+        if ( not self.out.fatal is None ):
+            return BackupFailure( 'fatal', 'backup failed: %s' % self.out.fatal )
+        for kind in kinds:
+            lines = [ line for ( k, line ) in self.matches if k == kind ]
+            if ( len( lines ) != 0 ):
+                return BackupFailure( kind, 'backup failed (%s): %s' % ( kind, lines[0] ) )
+        return BackupFailure( 'failed', 'backup failed with exit code %d' % ret )
+
+# seconds to wait before retry number attempt (from 0)
+def Backoff( backup, target, attempt ):
+    delay = min( target.Setting( backup, 'retry_delay', 60 ) * 2 ** attempt, target.Setting( backup, 'retry_max_delay', 1800 ) )
+    return random.uniform( delay / 2.0, delay )
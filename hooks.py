@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# the 'prepare' and 'posthook' steps
+# hooks run one at a time in the order they are listed, unless 'hook_parallel' lets them run concurrently:
+# then the ones that share a hook_group attribute still run one at a time, in the order they are listed.
+# a hook with a timeout (its timeout attribute, or 'hook_timeout' when it is set) that runs over is abandoned
+# and counts as failed, so a hung mount can't stall the backup forever. without one it runs as long as it takes
+# a failed prepare hook aborts the run, the posthooks all get to run
+
+from __future__ import with_statement
+
+import os, re, sys, threading
+
+import scheduler, pump
+
+# the mount table, from /proc/self/mountinfo
+# it is read once per run and shared by all the hooks: nothing here stats the mount points,
+# so a dead network filesystem can't hang the check (symlinks in the checked paths are not resolved either)
+class MountTable( object ):
+    def __init__( self, path = '/proc/self/mountinfo' ):
+        self.path = path
+        self.lock = threading.Lock()
+        self.Reload()
+
+    # after something got mounted
+    def Reload( self ):
+        mounts = []
+        handle = file( self.path )
+        try:
+            for line in handle:
+                fields = line.split()
+                # mount id, parent id, major:minor, root, mount point, options, optional fields .. '-', type, source, super options
+                sep = fields.index( '-', 6 )
+                mounts.append( { 'device' : fields[2], 'mountpoint' : unescape( fields[4] ), 'fstype' : fields[ sep + 1 ], 'source' : unescape( fields[ sep + 2 ] ) } )
+        finally:
+            handle.close()
+        with self.lock:
+            self.mounts = mounts
+
+    def IsMounted( self, path ):
+        path = os.path.normpath( os.path.abspath( path ) )
+        with self.lock:
+            return len( [ m for m in self.mounts if m['mountpoint'] == path ] ) != 0
+
+    # where a block device ( 'major:minor' ) is mounted, None if it isn't
+    def MountPoint( self, device ):
+        with self.lock:
+            for m in self.mounts:
+                if ( m['device'] == device ):
+                    return m['mountpoint']
+        return None
+
+# spaces, tabs, newlines and backslashes are octal escapes in the mount table
+def unescape( s ):
+    return re.sub( r'\\([0-7]{3})', lambda m : chr( int( m.group( 1 ), 8 ) ), s )
+
+def hookName( hook ):
+    return getattr( hook, 'name', hook.__class__.__name__ )
+
+# run func in a thread of its own and wait up to timeout seconds for it
+# the exception it raised is passed on, with its traceback
+def callWithTimeout( func, args, timeout, name ):
+    if ( timeout is None ):
+        return func( *args )
+    outcome = {}
+    def call():
+        try:
+            func( *args )
+        except:
+            outcome['error'] = sys.exc_info()
+    t = threading.Thread( target = call, name = name )
+    t.setDaemon( True )
+    t.start()
+    t.join( timeout )
+    if ( t.isAlive() ):
+        # there is no stopping a thread, it is left behind
+        raise Exception( '%s did not finish in %ds' % ( name, timeout ) )
+    if ( outcome.has_key( 'error' ) ):
+        raise outcome['error'][0], outcome['error'][1], outcome['error'][2]
+
+class HookRunner( object ):
+    # stage is 'prepare' or 'posthook'
+    def __init__( self, backup, stage ):
+        self.backup = backup
+        self.stage = stage
+        self.method = { 'prepare' : 'Prepare', 'posthook' : 'Posthook' }[ stage ]
+
+    def call( self, hook, name ):
+        timeout = getattr( hook, 'timeout', None )
+        if ( timeout is None ):
+            timeout = self.backup.hook_timeout
+        with self.backup.tracer.Span( '%s %s' % ( self.stage, name ), self.stage ):
+            callWithTimeout( getattr( hook, self.method ), ( self.backup, ), timeout, '%s %s' % ( self.stage, name ) )
+
+    def Run( self, hooks ):
+        if ( len( hooks ) == 0 ):
+            return
+        jobs = []
+        for ( i, h ) in enumerate( hooks ):
+            name = hookName( h )
+            # the scheduler's per host limit of 1 is what keeps the hooks of a group in line
+            group = getattr( h, 'hook_group', None )
+            if ( group is None ):
+                group = i
+            jobs.append( ( name, group, lambda h = h, name = name : self.call( h, name ) ) )
+        runner = scheduler.Scheduler( scheduler.SlotPool( self.backup.hook_parallel, 1 ), self.stage, stop_on_failure = ( self.stage == 'prepare' ) )
+        results = runner.Run( jobs )
+        runner.Summary( results )
+        failed = [ r.key for r in results if r.status != 'ok' ]
+        if ( len( failed ) != 0 ):
+            raise Exception( '%s failed: %s' % ( self.stage, ', '.join( failed ) ) )
+
+# check that a filesystem is mounted, mount it if it isn't
+class CheckMount( object ):
+    def __init__( self, directory, timeout = 60 ):
+        self.directory = directory
+        self.timeout = timeout
+        self.name = 'CheckMount %s' % directory
+
+    def Prepare( self, backup ):
+        if ( backup.mounts.IsMounted( self.directory ) ):
+            print '%s is mounted' % self.directory
+            return
+        print '%s is not mounted, mounting it' % self.directory
+        out = pump.OutputPump( prefix = self.name, tracer = backup.tracer )
+        ret = out.Run( [ 'mount', self.directory ], timeout = self.timeout )
+        backup.mounts.Reload()
+        if ( ret != 0 or out.timedout or not backup.mounts.IsMounted( self.directory ) ):
+            raise Exception( 'CheckMount: %s is not mounted' % self.directory )
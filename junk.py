@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# with 'junk' : True (globally or per target), the cache directories in a target are found and left out of the backup:
+# the ones tagged with a CACHEDIR.TAG ( https://bford.info/cachedir/ ), the ones named like a cache ( .cache, __pycache__ ..,
+# plus the 'junk_names'), and the package manager caches. the walk doesn't go into what it finds
+# the list is cached next to the state store and found again every 'junk_rescan' days
+# the excludes (configured and found) are deduplicated, and the plain paths go to duplicity in one --exclude-filelist
+# instead of one argument each. the glob patterns stay --exclude arguments, duplicity reads the lines of a filelist as plain paths
+# ('exclude_filelist' : True does that without the discovery)
+
+import os, time, json
+
+import selection
+from paths import isUnder
+
+cachedir_signature = 'Signature: 8a477f597d28d172789f06886806bc55'
+
+default_names = [ '.cache', '__pycache__', '.pytest_cache', '.mypy_cache', '.ccache', '.thumbnails' ]
+
+default_paths = [ '/var/cache/apt/archives', '/var/cache/yum', '/var/cache/dnf', '/var/cache/pacman/pkg', '/var/cache/zypp/packages' ]
+
+def tagged( path ):
+    try:
+        handle = file( os.path.join( path, 'CACHEDIR.TAG' ) )
+    except IOError:
+        return False
+    try:
+        return handle.read( len( cachedir_signature ) ) == cachedir_signature
+    finally:
+        handle.close()
+
+# a plain path, no wildcards
+def literal( pattern ):
+    return selection.literalPrefix( pattern ) == pattern.rstrip( '/' )
+
+# the excludes without duplicates, and without the ones under a path that is excluded already
+def merge( patterns ):
+    literals = [ p.rstrip( '/' ) for p in patterns if literal( p ) ]
+    ret = []
+    for p in patterns:
+        if ( p in ret ):
+            continue
+        if ( len( [ l for l in literals if l != p.rstrip( '/' ) and isUnder( p, l ) ] ) != 0 ):
+            continue
+        ret.append( p )
+    return ret
+
+class JunkFinder( object ):
+    def __init__( self, backup, target ):
+        self.backup = backup
+        self.target = target
+        self.cache_file = backup.TargetFile( target, 'junk' )
+        self.names = set( default_names + target.Setting( backup, 'junk_names', [] ) )
+        self.rescan = target.Setting( backup, 'junk_rescan', 7 )
+
+    def Enabled( self ):
+        return bool( self.target.Setting( self.backup, 'junk', False ) )
+
+    def junk( self, path ):
+        return ( os.path.basename( path ) in self.names or path in default_paths or tagged( path ) )
+
+    def discover( self ):
+        found = []
+        def prune( path ):
+            if ( self.junk( path ) ):
+                found.append( path )
+                return True
+            return False
+        t = self.target
+        one_filesystem = '--exclude-other-filesystems' in self.backup.config.get( 'duplicity_args', [] )
+        for entry in selection.Selection( t.root, t.exclude, t.include, one_filesystem ).Walk( prune ):
+            pass
+        return found
+
+    # the cached list, None if there is none or it's too old
+    def load( self ):
+        if ( not os.path.exists( self.cache_file ) ):
+            return None
+        try:
+            handle = file( self.cache_file )
+            try:
+                cache = json.load( handle )
+            finally:
+                handle.close()
+        except ValueError, e:
+            print 'ignoring unreadable junk list %s: %s' % ( self.cache_file, str( e ) )
+            return None
+        if ( cache['root'] != self.target.root or time.time() - cache['scanned'] > self.rescan * 24 * 3600 ):
+            return None
+        return cache['paths']
+
+    # the directories to leave out, discovered again when the cached list is too old
+    def Paths( self, discover = True ):
+        if ( not self.Enabled() ):
+            return []
+        paths = self.load()
+        if ( paths is None ):
+            if ( not discover ):
+                return []
+            start = time.time()
+            paths = self.discover()
+            print '%s: %d cache directories found in %.1fs' % ( self.target.root, len( paths ), time.time() - start )
+            handle = file( self.cache_file, 'w' )
+            try:
+                json.dump( { 'root' : self.target.root, 'scanned' : time.time(), 'paths' : paths }, handle )
+            finally:
+                handle.close()
+        return paths
+
+    # writes the plain paths of the excludes to the filelist, returns ( its path, the glob patterns to pass one by one )
+    # ( None, excludes ) to pass them all one by one as before
+    def Filelist( self, excludes ):
+        if ( not self.Enabled() and not self.target.Setting( self.backup, 'exclude_filelist', False ) ):
+            return ( None, excludes )
+        excludes = merge( excludes )
+        path = self.backup.TargetFile( self.target, 'exclude' )
+        handle = file( path, 'w' )
+        try:
+            for e in excludes:
+                if ( literal( e ) ):
+                    handle.write( e + '\n' )
+        finally:
+            handle.close()
+        return ( path, [ e for e in excludes if not literal( e ) ] )
@@ -21,8 +21,25 @@
 # a class version for easy lock operation based on the portalocker module
 # NOTE: the lock has to be released and does not expire
 # when the object goes out of scope it will try to release
+# the lock itself is a kernel advisory lock (flock) on the lock file: waiters block in the kernel and get
+# the lock as soon as it's released, and the lock goes away with the process that holds it, so a lock left over
+# by a dead process is never in the way
+# the file is kept around, and holds a single line of information about the owner: pid, expiration (seconds since the epoch, or -) and lockinfo
 
-import sys, os, pickle, portalocker, datetime, time, platform, subprocess
+import sys, os, portalocker, datetime, time, platform, subprocess, signal, threading, errno, fcntl
+
+class LockTimeout( Exception ):
+    pass
+
+def alarmHandler( signum, frame ):
+    raise LockTimeout()
+
+# open the lock file so the processes we start don't inherit it: a duplicity or ssh left running
+# after we are gone would keep the lock held
+def openLockFile( path, mode ):
+    handle = file( path, mode )
+    fcntl.fcntl( handle.fileno(), fcntl.F_SETFD, fcntl.fcntl( handle.fileno(), fcntl.F_GETFD ) | fcntl.FD_CLOEXEC )
+    return handle
 
 class lock( object ):
     def __init__( self, lockfile, lockinfo, debug = True ):
@@ -44,19 +61,61 @@ class lock( object ):
                 return False
         raise Exception( 'Need support for checking for process existence on platform %s' % platform.system() )
 
+    # returns ( pid, expire, lockinfo ) as written by the owner, None if there is nothing usable
+    def readInfo( self ):
+        try:
+            handle = file( self.lockfile )
+            try:
+                line = handle.readline().rstrip( '\n' )
+            finally:
+                handle.close()
+        except IOError:
+            return None
+        fields = line.split( ' ', 2 )
+        if ( len( fields ) != 3 ):
+            return None
+        try:
+            lock_pid = int( fields[0] )
+        except ValueError:
+            return None
+        lock_expire = None
+        if ( fields[1] != '-' ):
+            lock_expire = datetime.datetime.fromtimestamp( float( fields[1] ) )
+        return ( lock_pid, lock_expire, fields[2] )
+
+    # try the lock on a separate file description, it conflicts with the owner's even within the same process
+    def isLocked( self ):
+        try:
+            handle = openLockFile( self.lockfile, 'a' )
+        except IOError:
+            return False
+        try:
+            try:
+                portalocker.lock( handle, portalocker.LOCK_EX | portalocker.LOCK_NB )
+            except IOError:
+                return True
+            portalocker.unlock( handle )
+            return False
+        finally:
+            handle.close()
+
     def checkValidLock( self ):
         if ( not os.path.exists( self.lockfile ) ):
             return False
-        handle = file( self.lockfile )
-        lock_pid = pickle.load( handle )
-        lock_expire = pickle.load( handle )
-        lock_info = pickle.load( handle )
-        handle.close()
-        if ( not self.checkProcessExists( lock_pid ) ):
-            if ( self.debug ):
-                print '%s: stale lock, no such pid %d (%s)' % ( self.lockfile, lock_pid, repr( lock_info ) )
-            os.unlink( self.lockfile )
+        info = self.readInfo()
+        if ( not self.isLocked() ):
+            if ( not info is None and self.debug ):
+                ( lock_pid, lock_expire, lock_info ) = info
+                if ( not self.checkProcessExists( lock_pid ) ):
+                    print '%s: stale lock, no such pid %d (%s)' % ( self.lockfile, lock_pid, repr( lock_info ) )
+                else:
+                    print '%s: stale lock, pid %d no longer holds it (%s)' % ( self.lockfile, lock_pid, repr( lock_info ) )
             return False
+        if ( info is None ):
+            if ( self.debug ):
+                print '%s: active lock, owner has not written its information yet' % self.lockfile
+            return True
+        ( lock_pid, lock_expire, lock_info ) = info
         if ( lock_expire is None ):
             if ( self.debug ):
                 print '%s: active lock pid %d, does not expire (%s)' % ( self.lockfile, lock_pid, repr( lock_info ) )
@@ -66,54 +125,88 @@ class lock( object ):
             if ( self.debug ):
                 print '%s: active lock pid %d, expired at %s (%s)' % ( self.lockfile, lock_pid, s_lock_expire, repr( lock_info ) )
             # TODO: what now
-            # we reply that the lock is active however (could recurse a call to checkValidLock again)
-            # if I own the lock however, nuke it now
-            if ( lock_pid == os.getpid() ):
-                print 'my own lock - remove'
-                os.unlink( self.lockfile )
+            # we reply that the lock is active however
             return True
         if ( self.debug ):
             print '%s: active lock pid %d, expires at %s (%s)' % ( self.lockfile, lock_pid, s_lock_expire, repr( lock_info ) )
         return True
 
+    # block on the lock for at most timeout seconds, returns False on timeout
+    # signals can only be used from the main thread, other threads poll every waitInterval seconds
+    def lockTimeout( self, timeout, waitInterval ):
+        if ( isinstance( threading.currentThread(), threading._MainThread ) ):
+            previous = signal.signal( signal.SIGALRM, alarmHandler )
+            signal.setitimer( signal.ITIMER_REAL, timeout )
+            try:
+                try:
+                    portalocker.lock( self.handle, portalocker.LOCK_EX )
+                    return True
+                except LockTimeout:
+                    return False
+                except IOError, e:
+                    if ( e.errno != errno.EINTR ):
+                        raise
+                    return False
+            finally:
+                signal.setitimer( signal.ITIMER_REAL, 0 )
+                signal.signal( signal.SIGALRM, previous )
+        deadline = time.time() + timeout
+        while ( True ):
+            try:
+                portalocker.lock( self.handle, portalocker.LOCK_EX | portalocker.LOCK_NB )
+                return True
+            except IOError:
+                pass
+            if ( time.time() >= deadline ):
+                return False
+            time.sleep( min( waitInterval, max( deadline - time.time(), 0 ) ) )
+
     # pass a total time to wait, 0 for forever, None for abort right away on lock
     # expire indicates when the lock will expire, meaning we allow some other process to steal it, possibly after making sure to kill a stalled AB process
     # pass None as expire for no expiration
     # NOTE: we may need functionality to extend the expiration on an acquired lock
+    # returns the time spent waiting for the lock
     def acquire( self, wait = 5 * 60, waitInterval = 5, expire = 10 * 60 ):
-        waitTotal = 0
-        while ( self.checkValidLock() ):
+        start = time.time()
+        # don't truncate, the owner's information is in there
+        self.handle = openLockFile( self.lockfile, 'a+' )
+        try:
+            portalocker.lock( self.handle, portalocker.LOCK_EX | portalocker.LOCK_NB )
+        except IOError:
+            # report who has it
+            self.checkValidLock()
             if ( wait is None ):
+                self.handle.close()
+                self.handle = None
                 raise Exception( 'lock is busy' )
-            else:
-                if ( wait != 0 ):
-                    waitTotal += waitInterval
-                    if ( self.debug ):
-                        print( 'waitTotal: %d wait: %d waitInterval: %d' % ( waitTotal, wait, waitInterval ) )
-                    if ( waitTotal > wait ):
-                        raise Exception( 'exceeded max wait time on the lock' )
-                    time.sleep( waitInterval )
-
-        # don't want blocking on acquired locks - even with the loop, there is still a possibility of stolen lock and exception here
-        self.handle = file( self.lockfile, 'w' )
-        portalocker.lock( self.handle, portalocker.LOCK_EX | portalocker.LOCK_NB )
+            if ( self.debug ):
+                print '%s: waiting for the lock' % self.lockfile
+            if ( wait == 0 ):
+                portalocker.lock( self.handle, portalocker.LOCK_EX )
+            elif ( not self.lockTimeout( wait, waitInterval ) ):
+                self.handle.close()
+                self.handle = None
+                raise Exception( 'exceeded max wait time on the lock' )
         if ( self.debug ):
             print( 'acquired lock %s' % self.lockfile )
-        pickle.dump( os.getpid(), self.handle )
         if ( expire is None ):
-            expire_time = None
+            expire_time = '-'
         else:
-            expire_time = datetime.datetime.now()
-            expire_time += datetime.timedelta( seconds = expire )
-        pickle.dump( expire_time, self.handle )
-        pickle.dump( self.lockinfo, self.handle )
+            expire_time = '%d' % ( time.time() + expire )
+        self.handle.seek( 0 )
+        self.handle.truncate()
+        self.handle.write( '%d %s %s\n' % ( os.getpid(), expire_time, self.lockinfo ) )
         self.handle.flush()
+        return time.time() - start
 
     def release( self ):
         if ( not self.handle is None ):
-            # possible that some other script would print a message about the lock in between the close and the unlink
+            # the file stays, removing it would let a waiter lock the old inode while a newcomer creates a new file
+            self.handle.seek( 0 )
+            self.handle.truncate()
+            self.handle.flush()
+            portalocker.unlock( self.handle )
             self.handle.close()
-            os.unlink( self.lockfile )
             self.handle = None
 
     # don't rely on this - from the python documentation:
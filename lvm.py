@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# the snapshots of all the LVMBackupTargets of a run, taken together before the first backup starts
+# so the volumes are consistent with each other ('lvm_freeze' : True freezes the filesystems of all
+# the origins while the snapshots are created, for a single point in time across volumes)
+# each snapshot is sized from how fast its origin gets written to and how long its backup is expected
+# to take, a thread watches data_percent and extends the snapshots that are about to fill up,
+# and each snapshot is released as soon as its target is done with it
+
+from __future__ import with_statement
+
+import os, time, threading, subprocess
+
+import sizes
+
+def run( backup, cmd, target = None ):
+    with backup.tracer.Span( ' '.join( [ os.path.basename( cmd[0] ) ] + cmd[1:2] ), 'subprocess', cmd = ' '.join( cmd ), target = target ) as args:
+        p = subprocess.Popen( cmd, stdout = subprocess.PIPE, stderr = subprocess.STDOUT )
+        output = p.communicate()[0]
+        args['exit'] = p.returncode
+    if ( p.returncode != 0 ):
+        raise Exception( '%s failed with exit code %d: %s' % ( repr( cmd ), p.returncode, output.strip() ) )
+    return output
+
+# lvs/vgs report, one dictionary per line
+def report( backup, command, fields, names ):
+    output = run( backup, [ command, '--noheadings', '--nosuffix', '--units', 'b', '--separator', '|', '-o', ','.join( fields ) ] + names )
+    ret = []
+    for line in output.splitlines():
+        values = [ v.strip() for v in line.strip().split( '|' ) ]
+        if ( len( values ) == len( fields ) ):
+            ret.append( dict( zip( fields, values ) ) )
+    return ret
+
+# write counter of a block device, in 512 bytes sectors (field 7 of /sys/block/*/stat)
+def sectorsWritten( path ):
+    st = os.stat( os.path.realpath( path ) )
+    handle = file( '/sys/dev/block/%d:%d/stat' % ( os.major( st.st_rdev ), os.minor( st.st_rdev ) ) )
+    try:
+        return int( handle.read().split()[6] )
+    finally:
+        handle.close()
+
+# where the block device is mounted, None if it isn't
+def mountPoint( mounts, path ):
+    st = os.stat( os.path.realpath( path ) )
+    return mounts.MountPoint( '%d:%d' % ( os.major( st.st_rdev ), os.minor( st.st_rdev ) ) )
+
+class Snapshot( object ):
+    def __init__( self, target ):
+        self.target = target
+        self.size = None
+        self.created = None
+        self.mounted = False
+        # the exception if the snapshot could not be created
+        self.error = None
+        # the snapshot overflowed, what was backed up from it can't be trusted
+        self.invalid = False
+        # last seen fill, percent
+        self.fill = 0.0
+
+class SnapshotManager( object ):
+    def __init__( self, backup, targets ):
+        self.backup = backup
+        self.snapshots = dict( [ ( t.key, Snapshot( t ) ) for t in targets ] )
+        for t in targets:
+            t.snapshots = self
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.monitor = None
+        config = backup.config
+        self.freeze = config.get( 'lvm_freeze', False )
+        # seconds, the filesystems are thawed after that no matter what
+        self.freeze_timeout = config.get( 'lvm_freeze_timeout', 30 )
+        # the expected growth during the backup is multiplied by this
+        self.margin = config.get( 'lvm_snap_margin', 2.0 )
+        self.min_size = sizes.parseSize( config.get( 'lvm_snap_min', '1G' ) )
+        self.interval = config.get( 'lvm_monitor_interval', 30 )
+        # extend by extend_by percent of the current size once the snapshot is extend_at percent full
+        self.extend_at = config.get( 'lvm_extend_at', 80 )
+        self.extend_by = config.get( 'lvm_extend_by', 50 )
+
+    # predicted backup duration times the rate the origin gets written to
+    # without history, the target's snapsize, or a fifth of the origin
+    def size( self, s, origin_size ):
+        t = s.target
+        rates = self.backup.state.LVMRates( t.lvmpath )
+        rate = None
+        if ( not rates is None ):
+            rate = rates['fill_rate'] or rates['write_rate']
+        duration = t.PredictDuration( self.backup, t.PlannedType( self.backup ) )
+        if ( rate is None or duration is None ):
+            if ( not t.snapsize in [ None, 'auto' ] ):
+                return ( sizes.parseSize( t.snapsize ), 'configured' )
+            return ( max( self.min_size, origin_size / 5 ), 'a fifth of the origin, no history' )
+        size = int( rate * duration * self.margin )
+        # a snapshot never holds more than a full copy of its origin
+        size = min( max( size, self.min_size ), origin_size + self.min_size )
+        return ( size, '%s/s for %.0fs, margin %.1f' % ( sizes.formatSize( rate ), duration, self.margin ) )
+
+    def plan( self ):
+        wanted = {}
+        for s in [ s for s in self.snapshots.values() if s.error is None ]:
+            try:
+                o = report( self.backup, 'lvs', [ 'vg_name', 'lv_size' ], [ s.target.lvmpath ] )[0]
+            except Exception, e:
+                s.error = e
+                continue
+            ( s.size, why ) = self.size( s, int( o['lv_size'] ) )
+            print '%s: snapshot of %s, %s (%s)' % ( s.target.root, s.target.lvmpath, sizes.formatSize( s.size ), why )
+            wanted.setdefault( o['vg_name'], [] ).append( s )
+        # scale down to what the volume groups can hold, the monitor will try to extend later
+        for ( vg, group ) in wanted.items():
+            free = int( report( self.backup, 'vgs', [ 'vg_free' ], [ vg ] )[0]['vg_free'] )
+            total = sum( [ s.size for s in group ] )
+            if ( total > free ):
+                print 'WARNING: volume group %s has %s free, %s of snapshots wanted, scaling down' % ( vg, sizes.formatSize( free ), sizes.formatSize( total ) )
+                for s in group:
+                    s.size = int( s.size * 0.95 * free / total )
+
+    def thaw( self, mounts ):
+        for m in mounts:
+            # fails if it wasn't frozen (the watchdog got there first), that's fine
+            subprocess.call( [ 'fsfreeze', '-u', m ] )
+
+    # create all the snapshots, as close together as possible, then mount them
+    def Create( self ):
+        if ( len( self.snapshots ) == 0 ):
+            return
+        snapshots = [ s for s in self.snapshots.values() if s.error is None ]
+        if ( self.backup.dry_run ):
+            for s in snapshots:
+                print 'dry run: lvcreate -s -n %s %s, mount on %s' % ( s.target.snapshot_name, s.target.lvmpath, s.target.root )
+            return
+        for s in snapshots:
+            try:
+                self.backup.state.SampleWrites( s.target.lvmpath, sectorsWritten( s.target.lvmpath ) )
+            except Exception, e:
+                print 'can\'t sample the writes to %s: %s' % ( s.target.lvmpath, str( e ) )
+        self.plan()
+        snapshots = [ s for s in snapshots if s.error is None ]
+        mounts = []
+        if ( self.freeze ):
+            mounts = sorted( set( [ m for m in [ mountPoint( self.backup.mounts, s.target.lvmpath ) for s in snapshots ] if not m is None ] ) )
+        watchdog = threading.Timer( self.freeze_timeout, self.thaw, [ mounts ] )
+        watchdog.setDaemon( True )
+        frozen = []
+        start = time.time()
+        try:
+            for m in mounts:
+                self.backup.CheckCall( [ 'fsfreeze', '-f', m ] )
+                frozen.append( m )
+            if ( len( frozen ) != 0 ):
+                watchdog.start()
+            for s in snapshots:
+                cmd = [ 'lvcreate', '-s', '-L', '%dk' % ( ( s.size + 1023 ) / 1024 ), '-n', s.target.snapshot_name ]
+                if ( len( frozen ) != 0 ):
+                    # don't write the metadata backups while the filesystems are frozen, /etc may be one of them
+                    cmd += [ '--autobackup', 'n', '--config', 'backup { archive = 0 }' ]
+                try:
+                    self.backup.CheckCall( cmd + [ s.target.lvmpath ], s.target.root )
+                    s.created = time.time()
+                except Exception, e:
+                    s.error = e
+        finally:
+            watchdog.cancel()
+            self.thaw( frozen )
+        if ( len( frozen ) != 0 ):
+            print 'snapshots taken with %d filesystems frozen for %.1fs' % ( len( frozen ), time.time() - start )
+        for s in snapshots:
+            if ( s.created is None ):
+                continue
+            try:
+                self.backup.CheckCall( [ 'mount', '-t', 'auto', s.target.snapshot_path, s.target.root ], s.target.root )
+                s.mounted = True
+            except Exception, e:
+                s.error = e
+                self.remove( s )
+        self.monitor = threading.Thread( target = self.watch, name = 'lvm monitor' )
+        self.monitor.setDaemon( True )
+        self.monitor.start()
+
+    def watch( self ):
+        while ( not self.stop.isSet() ):
+            self.stop.wait( self.interval )
+            if ( self.stop.isSet() ):
+                break
+            try:
+                self.Check()
+            except Exception, e:
+                print 'snapshot monitor: %s' % str( e )
+
+    # look at how full the live snapshots are, extend the ones that get close
+    def Check( self ):
+        with self.lock:
+            live = dict( [ ( os.path.normpath( s.target.snapshot_path ), s ) for s in self.snapshots.values() if not s.created is None ] )
+        if ( len( live ) == 0 ):
+            return
+        for r in report( self.backup, 'lvs', [ 'lv_path', 'lv_attr', 'lv_size', 'data_percent' ], live.keys() ):
+            s = live.get( r['lv_path'] )
+            if ( s is None ):
+                continue
+            if ( len( r['lv_attr'] ) > 4 and r['lv_attr'][4] == 'I' ):
+                if ( not s.invalid ):
+                    print 'ERROR: snapshot %s overflowed, the backup of %s is not consistent' % ( r['lv_path'], s.target.root )
+                s.invalid = True
+                continue
+            if ( r['data_percent'] == '' ):
+                continue
+            s.fill = float( r['data_percent'] )
+            if ( s.fill < self.extend_at ):
+                continue
+            grow = int( int( r['lv_size'] ) * self.extend_by / 100 )
+            print 'snapshot %s is %.0f%% full, extending by %s' % ( r['lv_path'], s.fill, sizes.formatSize( grow ) )
+            try:
+                self.backup.CheckCall( [ 'lvextend', '-L', '+%dk' % ( ( grow + 1023 ) / 1024 ), r['lv_path'] ], s.target.root )
+            except Exception, e:
+                print 'WARNING: could not extend %s: %s' % ( r['lv_path'], str( e ) )
+
+    # raises if the target's snapshot could not be set up
+    def Ready( self, target ):
+        s = self.snapshots[ target.key ]
+        if ( not s.error is None ):
+            raise Exception( 'no snapshot of %s: %s' % ( target.lvmpath, str( s.error ) ) )
+
+    def remove( self, s ):
+        with self.lock:
+            if ( s.created is None ):
+                return
+            created = s.created
+            s.created = None
+        # how fast the snapshot filled up, to size the next one
+        try:
+            r = report( self.backup, 'lvs', [ 'lv_attr', 'lv_size', 'data_percent' ], [ s.target.snapshot_path ] )[0]
+            if ( len( r['lv_attr'] ) > 4 and r['lv_attr'][4] == 'I' ):
+                s.invalid = True
+            elif ( r['data_percent'] != '' and time.time() > created ):
+                self.backup.state.RecordFill( s.target.lvmpath, float( r['data_percent'] ) / 100 * int( r['lv_size'] ) / ( time.time() - created ) )
+        except Exception, e:
+            print 'can\'t get the final fill of %s: %s' % ( s.target.snapshot_path, str( e ) )
+        try:
+            if ( s.mounted ):
+                self.backup.CheckCall( [ 'umount', s.target.root ], s.target.root )
+                s.mounted = False
+        finally:
+            self.backup.CheckCall( [ 'lvremove', '-f', s.target.snapshot_path ], s.target.root )
+
+    # the target is done with its snapshot, returns False if it overflowed while in use
+    def Release( self, target ):
+        s = self.snapshots[ target.key ]
+        self.remove( s )
+        return not s.invalid
+
+    # release whatever is left (targets that were not started, errors), and stop the monitor
+    def ReleaseAll( self ):
+        self.stop.set()
+        if ( not self.monitor is None ):
+            self.monitor.join()
+        for s in self.snapshots.values():
+            try:
+                self.remove( s )
+            except Exception, e:
+                print 'ERROR: releasing the snapshot of %s: %s' % ( s.target.lvmpath, str( e ) )
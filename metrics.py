@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# machine readable metrics for each target and phase
+# duplicity's backup statistics block is picked out of the output as it streams by
+# records are appended to a JSON lines file ('metrics_jsonl'), and a Prometheus textfile collector
+# file ('metrics_prom') is rewritten at the end of the run from the latest run of every target
+
+from __future__ import with_statement
+
+import os, re, time, threading, json
+
+statistics = [ 'StartTime', 'EndTime', 'ElapsedTime', 'SourceFiles', 'SourceFileSize', 'NewFiles', 'NewFileSize', 'DeletedFiles', 'ChangedFiles', 'ChangedFileSize', 'ChangedDeltaSize', 'DeltaEntries', 'RawDeltaSize', 'TotalDestinationSizeChange', 'Errors' ]
+
+# collects the statistics block from the output of a duplicity backup
+class BackupStatistics( object ):
+    def __init__( self ):
+        self.values = {}
+
+    def Attach( self, out ):
+        out.addPattern( r'^(%s) (-?[\d.]+)' % '|'.join( statistics ), self.match )
+
+    def match( self, m ):
+        value = float( m.group( 2 ) )
+        if ( value == int( value ) and m.group( 1 ) not in [ 'StartTime', 'EndTime', 'ElapsedTime' ] ):
+            value = int( value )
+        self.values[ m.group( 1 ) ] = value
+
+    def get( self, name ):
+        return self.values.get( name )
+
+    # the numbers we care about, computed from the raw statistics
+    def Derived( self ):
+        ret = {}
+        elapsed = self.values.get( 'ElapsedTime' )
+        sent = self.values.get( 'TotalDestinationSizeChange' )
+        if ( elapsed and not sent is None ):
+            ret['throughput_mb_s'] = float( sent ) / elapsed / ( 1024 * 1024 )
+        source = self.values.get( 'SourceFileSize' )
+        raw = self.values.get( 'RawDeltaSize' )
+        if ( source and not raw is None ):
+            # how much of the source went into the delta
+            ret['delta_ratio'] = float( raw ) / source
+        if ( raw and not sent is None ):
+            # what compression and encryption made of the delta
+            ret['compression_ratio'] = float( sent ) / raw
+        return ret
+
+def promEscape( s ):
+    return s.replace( '\\', '\\\\' ).replace( '"', '\\"' ).replace( '\n', '\\n' )
+
+class Metrics( object ):
+    def __init__( self, jsonl = None, prom = None ):
+        self.jsonl = jsonl
+        self.prom = prom
+        self.lock = threading.Lock()
+        # latest phase durations of this run: ( target key, phase ) -> ( duration, status )
+        self.phases = {}
+
+    # phase is one of prescan, backup, cleanup, remove-older, status ..
+    def Record( self, target, phase, duration, status = 'ok', backup_type = None, stats = None ):
+        record = { 'time' : time.time(), 'target' : target.root, 'destination' : target.destination, 'phase' : phase, 'duration' : duration, 'status' : status }
+        if ( not backup_type is None ):
+            record['backup_type'] = backup_type
+        if ( not stats is None ):
+            record['stats'] = stats.values
+            record.update( stats.Derived() )
+        with self.lock:
+            self.phases[ ( target.key, phase ) ] = ( duration, status )
+            if ( not self.jsonl is None ):
+                handle = file( self.jsonl, 'a' )
+                handle.write( json.dumps( record, sort_keys = True ) + '\n' )
+                handle.close()
+
+    # rewrite the textfile collector file, backup numbers come from the latest run of each target in the state store
+    def WriteProm( self, backup, targets ):
+        if ( self.prom is None ):
+            return
+        lines = []
+        def gauge( name, help, samples ):
+            if ( len( samples ) == 0 ):
+                return
+            lines.append( '# HELP dupinanny_%s %s' % ( name, help ) )
+            lines.append( '# TYPE dupinanny_%s gauge' % name )
+            for ( labels, value ) in samples:
+                lines.append( 'dupinanny_%s{%s} %s' % ( name, ','.join( [ '%s="%s"' % ( k, promEscape( v ) ) for ( k, v ) in labels ] ), repr( float( value ) ) ) )
+        last_success = []
+        last_duration = []
+        sent = []
+        stat_samples = {}
+        derived_samples = {}
+        for t in targets:
+            labels = [ ( 'target', t.root ), ( 'destination', t.destination ) ]
+            ok = backup.state.LastRun( t.key, status = 'ok' )
+            if ( not ok is None ):
+                last_success.append( ( labels, ok['finished'] ) )
+            run = backup.state.LastWrite( t.key )
+            if ( run is None ):
+                continue
+            labels = labels + [ ( 'type', run['backup_type'] ) ]
+            last_duration.append( ( labels, run['duration'] ) )
+            if ( not run['bytes_sent'] is None ):
+                sent.append( ( labels, run['bytes_sent'] ) )
+            if ( run['stats'] is None ):
+                continue
+            stats = BackupStatistics()
+            stats.values = json.loads( run['stats'] )
+            for ( k, v ) in stats.values.items():
+                stat_samples.setdefault( k, [] ).append( ( labels, v ) )
+            for ( k, v ) in stats.Derived().items():
+                derived_samples.setdefault( k, [] ).append( ( labels, v ) )
+        gauge( 'last_success_timestamp_seconds', 'end of the last successful run of the target', last_success )
+        gauge( 'backup_duration_seconds', 'duration of the last backup that wrote to the destination', last_duration )
+        gauge( 'backup_sent_bytes', 'TotalDestinationSizeChange of the last backup', sent )
+        for k in statistics:
+            if ( stat_samples.has_key( k ) ):
+                gauge( 'duplicity_%s' % re.sub( r'(?<!^)([A-Z])', r'_\1', k ).lower(), 'duplicity statistic %s of the last backup' % k, stat_samples[ k ] )
+        for k in sorted( derived_samples.keys() ):
+            gauge( k, '%s of the last backup' % k, derived_samples[ k ] )
+        with self.lock:
+            phases = [ ( [ ( 'target', t.root ), ( 'phase', phase ), ( 'status', self.phases[ ( t.key, phase ) ][1] ) ], self.phases[ ( t.key, phase ) ][0] ) for t in targets for phase in [ 'prescan', 'backup', 'cleanup', 'remove-older', 'status' ] if self.phases.has_key( ( t.key, phase ) ) ]
+        gauge( 'phase_duration_seconds', 'duration of each phase in the last dupinanny run', phases )
+        tmp = '%s.tmp' % self.prom
+        handle = file( tmp, 'w' )
+        handle.write( '\n'.join( lines ) + '\n' )
+        handle.close()
+        os.rename( tmp, self.prom )
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# break a large root into BackupTarget pieces of roughly piece_size each
+# the tree is cut at directory boundaries: a piece is a directory, minus the pieces cut below it,
+# so every file belongs to exactly one piece (the one of its deepest cut ancestor)
+# the cuts are cached, and only recomputed when the piece sizes drift too far from when they were made
+
+import os, stat, time, pickle
+
+import selection
+from sizes import parseSize, formatSize
+from paths import isUnder
+
+class Partitioner( object ):
+    # extra keyword arguments are passed on to each target (shortFilenames, prescan ..)
+    def __init__( self, root, destination, piece_size, exclude = [], include = [], cache_file = None, drift = 0.25, rescan_every = 7, one_filesystem = True, target_class = None, **kwargs ):
+        self.root = os.path.normpath( root )
+        self.destination = destination.rstrip( '/' )
+        self.piece_size = parseSize( piece_size )
+        self.exclude = list( exclude )
+        self.include = list( include )
+        self.cache_file = cache_file
+        # fraction of piece_size a piece can grow or shrink by before the cuts are recomputed
+        self.drift = drift
+        # days between two scans of the tree, the cached cuts are used as-is in between
+        self.rescan_every = rescan_every
+        self.one_filesystem = one_filesystem
+        self.target_class = target_class
+        self.kwargs = kwargs
+
+    # disk usage of the selected tree: ( own, children ) dictionaries
+    # own[ dir ] is the size of the files directly in dir, children[ dir ] the selected subdirectories
+    def scan( self ):
+        own = {}
+        children = {}
+        sel = selection.Selection( self.root, self.exclude, self.include, self.one_filesystem )
+        for ( dirpath, dirstat, entries ) in sel.Walk():
+            size = 0
+            subdirs = []
+            for ( name, st ) in entries:
+                if ( stat.S_ISDIR( st.st_mode ) ):
+                    subdirs.append( os.path.join( dirpath, name ) )
+                else:
+                    size += st.st_blocks * 512
+            own[ dirpath ] = size
+            children[ dirpath ] = subdirs
+        # subdirectories on other filesystems were listed but not walked
+        for d in children.keys():
+            children[ d ] = [ c for c in children[ d ] if own.has_key( c ) ]
+        return ( own, children )
+
+    # post order traversal of the scanned tree
+    def postOrder( self, children ):
+        order = []
+        stack = [ ( self.root, False ) ]
+        while ( len( stack ) != 0 ):
+            ( d, visited ) = stack.pop()
+            if ( visited ):
+                order.append( d )
+                continue
+            stack.append( ( d, True ) )
+            for c in children.get( d, [] ):
+                stack.append( ( c, False ) )
+        return order
+
+    # size of each piece for a given set of cuts, returns a dictionary piece -> size
+    def pieceSizes( self, own, children, cuts ):
+        residual = {}
+        for d in self.postOrder( children ):
+            residual[ d ] = own.get( d, 0 ) + sum( [ residual[ c ] for c in children.get( d, [] ) if not c in cuts ] )
+        sizes = {}
+        for c in cuts:
+            sizes[ c ] = residual.get( c, 0 )
+        sizes[ self.root ] = residual.get( self.root, 0 )
+        return sizes
+
+    # bottom up: when a directory is larger than a piece, cut its largest subdirectories off until it fits
+    def cut( self, own, children ):
+        cuts = set()
+        residual = {}
+        for d in self.postOrder( children ):
+            kids = [ c for c in children.get( d, [] ) ]
+            residual[ d ] = own.get( d, 0 ) + sum( [ residual[ c ] for c in kids ] )
+            kids.sort( lambda a, b : cmp( residual[ b ], residual[ a ] ) )
+            for c in kids:
+                if ( residual[ d ] <= self.piece_size ):
+                    break
+                cuts.add( c )
+                residual[ d ] -= residual[ c ]
+        return cuts
+
+    def loadCache( self ):
+        if ( self.cache_file is None or not os.path.exists( self.cache_file ) ):
+            return None
+        try:
+            handle = file( self.cache_file, 'rb' )
+            try:
+                cache = pickle.load( handle )
+            finally:
+                handle.close()
+        except Exception, e:
+            print 'ignoring unreadable partition cache %s: %s' % ( self.cache_file, str( e ) )
+            return None
+        # a different setup invalidates the cache
+        if ( cache['root'] != self.root or cache['piece_size'] != self.piece_size or cache['exclude'] != self.exclude or cache['include'] != self.include ):
+            return None
+        return cache
+
+    def saveCache( self, sizes, scanned ):
+        if ( self.cache_file is None ):
+            return
+        cache = { 'root' : self.root, 'piece_size' : self.piece_size, 'exclude' : self.exclude, 'include' : self.include, 'sizes' : sizes, 'scanned' : scanned }
+        tmp = '%s.tmp' % self.cache_file
+        handle = file( tmp, 'wb' )
+        pickle.dump( cache, handle )
+        handle.close()
+        os.rename( tmp, self.cache_file )
+
+    def drifted( self, old, new ):
+        for ( piece, size ) in new.items():
+            if ( not old.has_key( piece ) ):
+                return True
+            if ( abs( size - old[ piece ] ) > self.drift * self.piece_size ):
+                return True
+            if ( piece != self.root and size > ( 1 + self.drift ) * self.piece_size ):
+                return True
+        return False
+
+    # returns a dictionary piece -> size
+    def Pieces( self ):
+        cache = self.loadCache()
+        if ( not cache is None and time.time() - cache['scanned'] < self.rescan_every * 24 * 3600 ):
+            return cache['sizes']
+        print 'Partitioner: scanning %s' % self.root
+        ( own, children ) = self.scan()
+        if ( not cache is None ):
+            cuts = set( cache['sizes'].keys() )
+            cuts.discard( self.root )
+            if ( len( [ c for c in cuts if not own.has_key( c ) ] ) == 0 ):
+                sizes = self.pieceSizes( own, children, cuts )
+                if ( not self.drifted( cache['sizes'], sizes ) ):
+                    self.saveCache( sizes, time.time() )
+                    return sizes
+            print 'Partitioner: piece sizes drifted, rebalancing %s' % self.root
+        sizes = self.pieceSizes( own, children, self.cut( own, children ) )
+        self.saveCache( sizes, time.time() )
+        return sizes
+
+    # the exclude and include patterns that apply inside a piece
+    def patternsFor( self, piece, pieces, patterns ):
+        ret = []
+        for p in patterns:
+            prefix = selection.literalPrefix( p )
+            # patterns that are not anchored on a path apply everywhere
+            if ( not prefix.startswith( '/' ) or isUnder( piece, prefix ) ):
+                ret.append( p )
+                continue
+            # otherwise it goes to the deepest piece that contains it
+            owners = [ q for q in pieces if isUnder( prefix, q ) ]
+            if ( len( owners ) != 0 and max( owners, key = len ) == piece ):
+                ret.append( p )
+        return ret
+
+    def Targets( self ):
+        if ( self.target_class is None ):
+            from backup import BackupTarget
+            target_class = BackupTarget
+        else:
+            target_class = self.target_class
+        sizes = self.Pieces()
+        pieces = sizes.keys()
+        pieces.sort()
+        targets = []
+        for piece in pieces:
+            # cut off the pieces directly below this one
+            below = [ p for p in pieces if p != piece and isUnder( p, piece ) ]
+            nearest = [ p for p in below if len( [ q for q in below if q != p and isUnder( p, q ) ] ) == 0 ]
+            exclude = self.patternsFor( piece, pieces, self.exclude ) + nearest
+            include = self.patternsFor( piece, pieces, self.include )
+            if ( piece == self.root ):
+                destination = self.destination
+            elif ( self.root == '/' ):
+                destination = self.destination + piece
+            else:
+                destination = self.destination + piece[ len( self.root ): ]
+            print 'Partitioner: %s (%s) -> %s' % ( piece, formatSize( sizes[ piece ] ), destination )
+            targets.append( target_class( root = piece, destination = destination, exclude = exclude, include = include, **self.kwargs ) )
+        return targets
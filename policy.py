@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# when a target needs a new full backup
+# three limits, each one optional and settable per target:
+#   full_max_chain   incrementals in the current chain
+#   full_max_ratio   size of those incrementals compared to the full they build on
+#   full_every       age of the last full, in days
+# the chain comes from the cached collection-status when there is one, the rest from the run history
+# a target at or over one of its limits is due. one that is at least 'full_soft' of the way to a limit
+# goes early if tonight is its night: each target gets one night out of 'full_spread', from a hash of
+# its destination, so the fulls of different targets land on different nights
+# 'full_max_per_run' caps how many targets go full in one run, the ones furthest over their limits first
+
+import os, time, datetime, zlib
+
+import status
+
+class Decision( object ):
+    def __init__( self, target ):
+        self.target = target
+        self.full = False
+        # how far along the limits the target is, 1.0 is due
+        self.score = 0.0
+        self.reason = None
+        self.details = []
+
+class FullPolicy( object ):
+    def __init__( self, backup, targets ):
+        self.backup = backup
+        self.soft = backup.config.get( 'full_soft', 0.75 )
+        self.spread = max( backup.config.get( 'full_spread', 7 ), 1 )
+        self.cap = backup.config.get( 'full_max_per_run' )
+        self.today = datetime.date.today().toordinal()
+        self.decisions = {}
+        for t in targets:
+            self.decisions[ t.key ] = self.evaluate( t )
+        # the targets already flagged for a full take their share of the cap
+        self.applyCap( len( [ t for t in targets if os.path.exists( t.fullFileFlag ) and not self.decisions[ t.key ].full ] ) )
+
+    # the incrementals since the last full, from the run history, and that full
+    def history( self, t ):
+        full = self.backup.state.LastRun( t.key, status = 'ok', backup_type = 'full' )
+        sql = 'select count(*) as count, sum( bytes_sent ) as sent from runs where target = ? and status = \'ok\' and backup_type = \'incremental\''
+        args = [ t.key ]
+        if ( not full is None ):
+            sql += ' and started > ?'
+            args.append( full['started'] )
+        incrementals = self.backup.state.query( sql, args )[0]
+        return ( full, incrementals['count'], incrementals['sent'] )
+
+    def Slot( self, t ):
+        return zlib.crc32( t.key ) % self.spread
+
+    def evaluate( self, t ):
+        d = Decision( t )
+        max_chain = t.Setting( self.backup, 'full_max_chain' )
+        max_ratio = t.Setting( self.backup, 'full_max_ratio' )
+        every = t.Setting( self.backup, 'full_every' )
+        if ( max_chain is None and max_ratio is None and every is None ):
+            return d
+        ( full, count, sent ) = self.history( t )
+        model = None
+        cached = self.backup.state.CachedStatus( t.destination, None )
+        if ( not cached is None ):
+            model = status.CollectionStatus( cached[1] )
+        scores = []
+        if ( not max_chain is None ):
+            chain = count
+            if ( not model is None and model.ChainLength() != 0 ):
+                # the backend knows better, the history may not go back to the start of the chain
+                chain = max( model.ChainLength() - 1, count )
+            scores.append( ( float( chain ) / max( max_chain, 1 ), 'chain of %d incrementals (limit %d)' % ( chain, max_chain ) ) )
+        if ( not max_ratio is None and not full is None and full['bytes_sent'] and not sent is None ):
+            ratio = float( sent ) / full['bytes_sent']
+            scores.append( ( ratio / max_ratio, 'incrementals at %d%% of the full (limit %d%%)' % ( ratio * 100, max_ratio * 100 ) ) )
+        if ( not every is None ):
+            since = None
+            if ( not model is None and not model.last_full is None ):
+                since = model.last_full
+            if ( not full is None ):
+                since = max( since, full['finished'] )
+            if ( since is None ):
+                # never recorded a full backup, count from the first run we know about
+                first = self.backup.state.FirstRun( t.key )
+                if ( not first is None ):
+                    since = first['started']
+            if ( not since is None ):
+                age = ( time.time() - since ) / ( 24 * 3600 )
+                scores.append( ( age / every, 'last full %.1f days ago (limit %d)' % ( age, every ) ) )
+        if ( len( scores ) == 0 ):
+            return d
+        d.details = [ s[1] for s in scores ]
+        ( d.score, worst ) = max( scores )
+        if ( d.score >= 1.0 ):
+            d.full = True
+            d.reason = worst
+        elif ( d.score >= self.soft and self.today % self.spread == self.Slot( t ) ):
+            d.full = True
+            d.reason = '%s, early on this target\'s night' % worst
+        return d
+
+    def applyCap( self, flagged ):
+        if ( self.cap is None ):
+            return
+        wanted = sorted( [ d for d in self.decisions.values() if d.full ], key = lambda d : -d.score )
+        for d in wanted[ max( self.cap - flagged, 0 ): ]:
+            d.full = False
+            d.reason = 'deferred, full_max_per_run %d reached (%s)' % ( self.cap, d.reason )
+
+    def Decision( self, t ):
+        d = self.decisions.get( t.key )
+        if ( d is None ):
+            # not one of the targets the policy was set up with
+            d = self.evaluate( t )
+            self.decisions[ t.key ] = d
+        return d
+
+    def Full( self, t ):
+        return self.Decision( t ).full
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# change detection for a backup target, so an incremental with nothing to send can skip duplicity
+# the index holds one entry per selected directory: the directory's mtime and inode, and a digest
+# over the name, inode, size, mtime and ctime of everything in it
+# it is only written once the backup went through, otherwise a failed backup would hide the changes
+
+import os, marshal, zlib, hashlib
+
+class ChangeScanner( object ):
+    def __init__( self, selection, index_path ):
+        self.selection = selection
+        self.index_path = index_path
+        self.pending = None
+
+    def load( self ):
+        if ( not os.path.exists( self.index_path ) ):
+            return None
+        try:
+            handle = file( self.index_path, 'rb' )
+            try:
+                return marshal.loads( zlib.decompress( handle.read() ) )
+            finally:
+                handle.close()
+        except Exception, e:
+            print 'ignoring unreadable change index %s: %s' % ( self.index_path, str( e ) )
+            return None
+
+    def scan( self ):
+        index = {}
+        for ( dirpath, dirstat, entries ) in self.selection.Walk():
+            digest = hashlib.md5()
+            for ( name, st ) in entries:
+                digest.update( '%s\0%d\0%d\0%d\0%d\0%d\n' % ( name, st.st_ino, st.st_size, st.st_mode, int( st.st_mtime * 1000 ), int( st.st_ctime * 1000 ) ) )
+            index[ dirpath ] = ( int( dirstat.st_mtime * 1000 ), dirstat.st_ino, digest.digest() )
+        return index
+
+    # walk the tree and compare it with the index of the last successful backup
+    # returns True if anything changed (or if there is no index yet)
+    def Changed( self ):
+        self.pending = self.scan()
+        previous = self.load()
+        if ( previous is None ):
+            return True
+        return previous != self.pending
+
+    # record the index from the last Changed call, after a successful backup
+    def Commit( self ):
+        if ( self.pending is None ):
+            return
+        tmp = '%s.tmp' % self.index_path
+        handle = file( tmp, 'wb' )
+        handle.write( zlib.compress( marshal.dumps( self.pending ) ) )
+        handle.close()
+        os.rename( tmp, self.index_path )
+        self.pending = None
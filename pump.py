@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# line oriented output pump for the duplicity subprocesses
+# output is forwarded as it arrives, one line at a time, to any number of sinks
+# patterns are matched per line, so memory use does not depend on how much the process prints
+# only the last few lines are kept around for error reporting
+
+from __future__ import with_statement
+
+import os, sys, re, time, signal, threading, subprocess, collections
+
+# don't let a runaway line without a newline eat up memory
+MAX_LINE = 64 * 1024
+
+# serializes the writes from the pumps running in parallel so lines don't get mixed up
+# reentrant, the pumps write to a LineWriter that takes it too
+write_lock = threading.RLock()
+
+# stdout and stderr for a process with threads: the print statement writes a line in pieces, this holds on to them
+# (per thread) until the line is complete, then writes it in one go under write_lock, so the lines printed by the jobs
+# running in parallel don't run into each other
+class LineWriter( object ):
+    def __init__( self, stream ):
+        self.stream = stream
+        self.pending = threading.local()
+
+    def write( self, s ):
+        text = getattr( self.pending, 'text', '' ) + s
+        end = text.rfind( '\n' ) + 1
+        self.pending.text = text[end:]
+        if ( end == 0 ):
+            return
+        with write_lock:
+            self.stream.write( text[:end] )
+            self.stream.flush()
+
+    def flush( self ):
+        text = getattr( self.pending, 'text', '' )
+        self.pending.text = ''
+        with write_lock:
+            if ( text != '' ):
+                self.stream.write( text )
+            self.stream.flush()
+
+    def __getattr__( self, name ):
+        return getattr( self.stream, name )
+
+# route the console output of the whole process through LineWriters
+def SerializeOutput():
+    if ( not isinstance( sys.stdout, LineWriter ) ):
+        sys.stdout = LineWriter( sys.stdout )
+    if ( not isinstance( sys.stderr, LineWriter ) ):
+        sys.stderr = LineWriter( sys.stderr )
+
+# a sink that keeps the output, for the commands with small outputs that get parsed
+# it only gets the lines of the process, not the pump's own messages (exit code ..)
+class LineBuffer( object ):
+    capture = True
+
+    def __init__( self ):
+        self.lines = []
+
+    def write( self, s ):
+        self.lines.append( s )
+
+    def flush( self ):
+        pass
+
+    def Text( self ):
+        return ''.join( self.lines )
+
+class OutputPump( object ):
+    # with a tracing.Tracer, each command gets a span with the command line and the exit code
+    # label names the target in the span, the prefix by default
+    def __init__( self, sinks = None, prefix = None, timestamps = True, tail = 50, tracer = None, label = None ):
+        if ( sinks is None ):
+            sinks = [ sys.stdout ]
+        self.sinks = sinks
+        self.prefix = prefix
+        self.timestamps = timestamps
+        self.patterns = []
+        self.tail = collections.deque( maxlen = tail )
+        self.fatal = None
+        self.process = None
+        self.timedout = False
+        self.tracer = tracer
+        self.label = label
+        if ( label is None ):
+            self.label = prefix
+        # run the process in a process group of its own, so Pause and Resume reach whatever it started (gpg, ssh ..)
+        # it is then out of the terminal's group as well, and doesn't see a ^C
+        self.group = False
+        self.paused = False
+        # told when the process starts and exits, see windows.WindowGuard
+        self.guard = None
+        # what the command is started through ( nice, ionice .. ), each one execs the next so the pid stays the same
+        # (no preexec_fn: the pumps run in several threads, and python code between fork and exec isn't safe then)
+        self.launcher = []
+
+    # callback is called with the match object when a line matches
+    # a fatal pattern terminates the process right away
+    def addPattern( self, pattern, callback = None, fatal = False ):
+        self.patterns.append( ( re.compile( pattern ), callback, fatal ) )
+
+    def emit( self, line, note = False ):
+        header = ''
+        if ( self.timestamps ):
+            header += time.strftime( '%Y-%m-%d %H:%M:%S ' )
+        if ( not self.prefix is None ):
+            header += '[%s] ' % self.prefix
+        if ( not line.endswith( '\n' ) ):
+            line += '\n'
+        with write_lock:
+            for s in self.sinks:
+                if ( note and getattr( s, 'capture', False ) ):
+                    continue
+                s.write( header + line )
+                s.flush()
+
+    # the pump's own messages, for the console and the log only
+    def note( self, line ):
+        self.emit( line, note = True )
+
+    def match( self, line ):
+        for ( regex, callback, fatal ) in self.patterns:
+            m = regex.search( line )
+            if ( m is None ):
+                continue
+            if ( not callback is None ):
+                callback( m )
+            if ( fatal and self.fatal is None ):
+                self.fatal = line.rstrip( '\n' )
+                self.note( 'fatal output, terminating process %d' % self.process.pid )
+                self.terminate()
+
+    def expire( self ):
+        self.timedout = True
+        self.note( 'out of time, terminating process %d' % self.process.pid )
+        self.terminate()
+
+    def terminate( self ):
+        try:
+            # the whole group when there is one, the children (gpg, ssh ..) hold the output pipe open too
+            self.kill( signal.SIGTERM )
+            # a stopped process only gets the signal once it runs again
+            if ( self.paused ):
+                self.Resume()
+        except OSError:
+            # already gone
+            pass
+
+    def kill( self, signum ):
+        if ( self.group ):
+            os.killpg( self.process.pid, signum )
+        else:
+            self.process.send_signal( signum )
+
+    def Pause( self ):
+        self.kill( signal.SIGSTOP )
+        self.paused = True
+        self.note( 'process %d paused' % self.process.pid )
+
+    def Resume( self ):
+        self.kill( signal.SIGCONT )
+        self.paused = False
+        self.note( 'process %d resumed' % self.process.pid )
+
+    # run cmd to completion, returns the exit code
+    # with a timeout (seconds), the process is terminated if it runs longer and self.timedout is set
+    def Run( self, cmd, timeout = None, **kwargs ):
+        if ( self.tracer is None ):
+            return self.run( cmd, timeout, **kwargs )
+        with self.tracer.Span( ' '.join( [ os.path.basename( cmd[0] ) ] + cmd[1:2] ), 'subprocess', cmd = ' '.join( cmd ), target = self.label ) as args:
+            ret = self.run( cmd, timeout, **kwargs )
+            args['exit'] = ret
+            if ( not self.fatal is None ):
+                args['fatal'] = self.fatal
+            if ( self.timedout ):
+                args['timedout'] = True
+        return ret
+
+    def run( self, cmd, timeout, **kwargs ):
+        launcher = self.launcher
+        if ( self.group ):
+            # a child of ours never leads a group, so setsid execs the command without forking
+            launcher = [ 'setsid' ] + launcher
+        self.process = subprocess.Popen( launcher + cmd, stdin = None, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, shell = False, **kwargs )
+        timer = None
+        if ( not timeout is None ):
+            timer = threading.Timer( max( timeout, 0 ), self.expire )
+            timer.setDaemon( True )
+            timer.start()
+        try:
+            if ( not self.guard is None ):
+                self.guard.Register( self )
+            try:
+                self.pump()
+            finally:
+                if ( not self.guard is None ):
+                    self.guard.Unregister( self )
+        finally:
+            if ( not timer is None ):
+                timer.cancel()
+        ret = self.process.wait()
+        self.note( 'exit code %d' % ret )
+        return ret
+
+    def pump( self ):
+        while ( True ):
+            line = self.process.stdout.readline( MAX_LINE )
+            if ( len( line ) == 0 ):
+                break
+            self.tail.append( line )
+            self.emit( line )
+            self.match( line )
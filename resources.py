@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# what the duplicity processes of a target are allowed to use, set globally or per target:
+#   nice            nice value
+#   ionice          I/O class: 'idle', 'best-effort' or 'realtime', with a level: 'best-effort:7'
+#   cpu_affinity    the CPUs to run on, taskset style: '0-3', '0,2', or a list
+#   cgroup_memory   memory limit ( bytes, '2G' ..), through a cgroup v2 group per target under 'cgroup_root'
+#   cgroup_cpu      CPU limit, in CPUs ( 0.5 is half of one ), through the same group
+# the processes are started through nice, ionice and taskset, and a shell that moves them to their group before it execs
+#
+# the throttle watches the host: load per CPU and the PSI pressure of cpu and io ( avg10, in % )
+# over 'throttle_load' or 'throttle_psi', the running processes drop to nice 19 and the idle I/O class
+# over 'throttle_pause_load' or 'throttle_pause_psi', they are paused (see windows.WindowGuard)
+# things go back to normal once the measures are 20% under the thresholds
+
+from __future__ import with_statement
+
+import os, re, time, threading, subprocess
+
+import sizes
+
+ionice_classes = { 'none' : 0, 'realtime' : 1, 'best-effort' : 2, 'idle' : 3 }
+
+throttle_keys = [ 'throttle_load', 'throttle_psi', 'throttle_pause_load', 'throttle_pause_psi' ]
+
+def ioniceArgs( spec ):
+    m = re.match( r'^\s*([a-z-]+)\s*(:\s*(\d))?\s*$', spec )
+    if ( m is None or not ionice_classes.has_key( m.group( 1 ) ) ):
+        raise Exception( 'bad ionice %s, expected \'idle\', \'best-effort[:level]\' or \'realtime[:level]\'' % repr( spec ) )
+    args = [ '-c', str( ionice_classes[ m.group( 1 ) ] ) ]
+    if ( not m.group( 3 ) is None ):
+        args += [ '-n', m.group( 3 ) ]
+    return args
+
+# helper commands, their output only matters when they fail
+def call( cmd ):
+    p = subprocess.Popen( cmd, stdout = subprocess.PIPE, stderr = subprocess.STDOUT )
+    output = p.communicate()[0]
+    if ( p.returncode != 0 ):
+        print '%s failed: %s' % ( ' '.join( cmd ), output.strip() )
+    return p.returncode
+
+def writeFile( path, value ):
+    handle = file( path, 'w' )
+    try:
+        handle.write( value )
+    finally:
+        handle.close()
+
+class Limits( object ):
+    def __init__( self, backup, target ):
+        self.backup = backup
+        self.target = target
+        self.nice = target.Setting( backup, 'nice' )
+        self.ionice = target.Setting( backup, 'ionice' )
+        self.cpus = target.Setting( backup, 'cpu_affinity' )
+        if ( isinstance( self.cpus, ( list, tuple ) ) ):
+            self.cpus = ','.join( [ str( c ) for c in self.cpus ] )
+        self.memory = target.Setting( backup, 'cgroup_memory' )
+        self.cpu = target.Setting( backup, 'cgroup_cpu' )
+
+    # what the command is started through
+    def Launcher( self ):
+        launcher = []
+        if ( not self.nice is None ):
+            launcher += [ 'nice', '-n', str( self.nice ) ]
+        if ( not self.ionice is None ):
+            launcher += [ 'ionice' ] + ioniceArgs( self.ionice )
+        if ( not self.cpus is None ):
+            launcher += [ 'taskset', '-c', str( self.cpus ) ]
+        return launcher
+
+    # set up the target's group, returns its path, None when there are no cgroup limits
+    def Cgroup( self ):
+        if ( self.memory is None and self.cpu is None ):
+            return None
+        root = self.backup.config.get( 'cgroup_root', '/sys/fs/cgroup/dupinanny' )
+        path = os.path.join( root, re.sub( r'[^\w.-]', '_', self.target.key ) )
+        try:
+            if ( not os.path.isdir( root ) ):
+                os.mkdir( root )
+            # the controllers have to be enabled for the children of the root group
+            controllers = []
+            if ( not self.memory is None ):
+                controllers.append( '+memory' )
+            if ( not self.cpu is None ):
+                controllers.append( '+cpu' )
+            writeFile( os.path.join( root, 'cgroup.subtree_control' ), ' '.join( controllers ) )
+            if ( not os.path.isdir( path ) ):
+                os.mkdir( path )
+            if ( not self.memory is None ):
+                writeFile( os.path.join( path, 'memory.max' ), str( sizes.parseSize( self.memory ) ) )
+            if ( not self.cpu is None ):
+                writeFile( os.path.join( path, 'cpu.max' ), '%d 100000' % int( self.cpu * 100000 ) )
+        except ( IOError, OSError ), e:
+            raise Exception( 'can\'t set up cgroup %s (is %s a cgroup v2 hierarchy?): %s' % ( path, os.path.dirname( root ), str( e ) ) )
+        return path
+
+    # sets up a pump.OutputPump for the target
+    def Apply( self, out ):
+        out.launcher = self.Launcher()
+        path = self.Cgroup()
+        if ( not path is None ):
+            out.launcher = [ 'sh', '-c', 'echo $$ > "$0" && exec "$@"', os.path.join( path, 'cgroup.procs' ) ] + out.launcher
+
+# None for the measures that aren't available
+def hostLoad():
+    load = os.getloadavg()[0] / max( os.sysconf( 'SC_NPROCESSORS_ONLN' ), 1 )
+    psi = None
+    for resource in [ 'cpu', 'io' ]:
+        try:
+            handle = file( '/proc/pressure/%s' % resource )
+            try:
+                m = re.search( r'^some avg10=([\d.]+)', handle.read(), re.MULTILINE )
+            finally:
+                handle.close()
+        except IOError:
+            continue
+        if ( not m is None ):
+            psi = max( psi, float( m.group( 1 ) ) )
+    return ( load, psi )
+
+class Throttle( object ):
+    def __init__( self, backup ):
+        self.backup = backup
+        self.guard = backup.windows
+        self.interval = backup.config.get( 'throttle_interval', 10 )
+        # ( level, load threshold, psi threshold )
+        self.levels = [ ( 1, backup.config.get( 'throttle_load' ), backup.config.get( 'throttle_psi' ) ), ( 2, backup.config.get( 'throttle_pause_load' ), backup.config.get( 'throttle_pause_psi' ) ) ]
+        # 0 normal, 1 lowered priority, 2 paused
+        self.level = 0
+        self.why = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    # the level the measures call for, with some slack on the way down so it doesn't flap
+    def evaluate( self, load, psi ):
+        level = 0
+        why = None
+        for ( l, load_limit, psi_limit ) in self.levels:
+            slack = 1.0
+            if ( self.level >= l ):
+                slack = 0.8
+            if ( not load_limit is None and load >= load_limit * slack ):
+                ( level, why ) = ( l, 'load %.2f per CPU' % load )
+            elif ( not psi_limit is None and not psi is None and psi >= psi_limit * slack ):
+                ( level, why ) = ( l, 'pressure %.1f%%' % psi )
+        return ( level, why )
+
+    def lower( self, out ):
+        pgid = str( out.process.pid )
+        call( [ 'renice', '-n', '19', '-g', pgid ] )
+        call( [ 'ionice', '-c', '3', '-P', pgid ] )
+
+    def restore( self, out ):
+        limits = Limits( self.backup, out.target )
+        pgid = str( out.process.pid )
+        call( [ 'renice', '-n', str( limits.nice or 0 ), '-g', pgid ] )
+        call( [ 'ionice' ] + ioniceArgs( limits.ionice or 'none' ) + [ '-P', pgid ] )
+
+    # windows.WindowGuard calls these
+    def Registered( self, out ):
+        with self.lock:
+            if ( self.thread is None ):
+                self.thread = threading.Thread( target = self.watch, name = 'throttle' )
+                self.thread.setDaemon( True )
+                self.thread.start()
+            level = self.level
+        if ( level >= 1 ):
+            self.lower( out )
+
+    def Hold( self, out ):
+        if ( self.level >= 2 ):
+            return 'host under pressure (%s)' % self.why
+        return None
+
+    def watch( self ):
+        while ( True ):
+            time.sleep( self.interval )
+            with self.lock:
+                pumps = self.guard.Pumps()
+                if ( len( pumps ) == 0 ):
+                    self.thread = None
+                    self.level = 0
+                    return
+            ( load, psi ) = hostLoad()
+            ( level, why ) = self.evaluate( load, psi )
+            if ( level == self.level ):
+                continue
+            print 'throttle: level %d -> %d (%s)' % ( self.level, level, why or 'load %.2f per CPU' % load )
+            with self.lock:
+                old = self.level
+                self.level = level
+                self.why = why
+            for out in pumps:
+                try:
+                    if ( level >= 1 and old == 0 ):
+                        self.lower( out )
+                    elif ( level == 0 ):
+                        self.restore( out )
+                except OSError:
+                    # gone
+                    pass
+            # pause or resume
+            self.guard.CheckAll()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# --restore: find the targets that hold the requested paths and run the duplicity restores in parallel
+# a path belongs to the target with the deepest root whose selection (excludes, includes) takes it,
+# the targets rooted below the path are restored whole along with it
+# everything lands under --restore-to, at its original path: --restore-to /srv/restore --restore /var/lib
+# gives /srv/restore/var/lib. the targets nested in others are restored after them, on top of what's there
+# the restores share the 'restore_parallel' and max_per_host limits, --time picks the backup to restore from
+
+from __future__ import with_statement
+
+import os, time
+
+import scheduler, sizes
+from paths import isUnder
+
+# a duplicity restore: path is the absolute path to restore, under the target's root
+class RestoreJob( object ):
+    def __init__( self, target, path ):
+        self.target = target
+        self.path = path
+        # restores over what a target with a shallower root put there
+        self.force = False
+        self.size = None
+        self.elapsed = None
+
+    def Relative( self ):
+        return os.path.relpath( self.path, self.target.root )
+
+    def Depth( self ):
+        return len( [ p for p in self.target.root.split( '/' ) if p != '' ] )
+
+class RestoreIndex( object ):
+    def __init__( self, backup, targets ):
+        self.entries = []
+        for t in targets:
+            t.backup = backup
+            self.entries.append( ( os.path.normpath( t.root ), t, t.Selection() ) )
+
+    # the jobs that restore path, raises if no target holds it
+    def Resolve( self, path ):
+        path = os.path.normpath( os.path.abspath( path ) )
+        owner = None
+        for ( root, t, sel ) in self.entries:
+            if ( sel.Contains( path ) and ( owner is None or len( root ) > len( owner[0] ) ) ):
+                owner = ( root, t )
+        jobs = []
+        if ( not owner is None ):
+            jobs.append( RestoreJob( owner[1], path ) )
+        for ( root, t, sel ) in self.entries:
+            if ( not owner is None and t is owner[1] ):
+                continue
+            if ( root != path and isUnder( root, path ) ):
+                jobs.append( RestoreJob( t, root ) )
+        if ( len( jobs ) == 0 ):
+            raise Exception( '%s is not in any backup target' % path )
+        return jobs
+
+def treeSize( path ):
+    if ( not os.path.isdir( path ) ):
+        try:
+            return os.lstat( path ).st_size
+        except OSError:
+            return 0
+    size = 0
+    for ( dirpath, dirnames, filenames ) in os.walk( path ):
+        for f in filenames:
+            try:
+                size += os.lstat( os.path.join( dirpath, f ) ).st_size
+            except OSError:
+                pass
+    return size
+
+class Restore( object ):
+    def __init__( self, backup ):
+        self.backup = backup
+        self.parallel = backup.config.get( 'restore_parallel', backup.max_parallel )
+
+    def command( self, job, local ):
+        t = job.target
+        cmd = [ self.backup.duplicity, 'restore' ]
+        if ( job.Relative() != '.' ):
+            cmd += [ '--file-to-restore', job.Relative() ]
+        if ( not self.backup.restore_time is None ):
+            cmd += [ '--time', self.backup.restore_time ]
+        if ( job.force ):
+            cmd.append( '--force' )
+        if ( t.shortFilenames ):
+            cmd.append( '--short-filenames' )
+        if ( self.backup.config.has_key( 'duplicity_args' ) ):
+            cmd += self.backup.config['duplicity_args']
+        ( tempdir, explicit ) = t.TempDir()
+        if ( explicit ):
+            cmd += [ '--tempdir', tempdir ]
+        cmd.append( t.destination )
+        cmd.append( local )
+        return cmd
+
+    def run( self, job ):
+        local = os.path.join( self.backup.restore_to, job.path.lstrip( '/' ) )
+        cmd = self.command( job, local )
+        print repr( cmd )
+        if ( self.backup.dry_run ):
+            return
+        if ( not os.path.isdir( os.path.dirname( local ) ) ):
+            os.makedirs( os.path.dirname( local ) )
+        out = self.backup.OutputPump( job.target.root )
+        start = time.time()
+        ret = out.Run( cmd )
+        job.elapsed = time.time() - start
+        self.backup.metrics.Record( job.target, 'restore', job.elapsed, { True : 'ok', False : 'failed' }[ ret == 0 ] )
+        if ( ret != 0 ):
+            raise Exception( 'restore of %s from %s failed' % ( job.path, job.target.destination ) )
+        job.size = treeSize( local )
+
+    def Run( self, paths ):
+        if ( self.backup.restore_to is None ):
+            raise Exception( '--restore needs --restore-to, the directory to restore into' )
+        if ( self.backup.config.has_key( 'password' ) ):
+            os.environ['PASSPHRASE'] = self.backup.config['password']
+        index = RestoreIndex( self.backup, self.backup.dupi.get( 'items', [] ) )
+        candidates = []
+        for p in paths:
+            candidates += index.Resolve( p )
+        # the requested paths can overlap, drop what another job of the same target restores already
+        jobs = []
+        for j in sorted( candidates, key = lambda j : len( j.path ) ):
+            if ( len( [ k for k in jobs if k.target is j.target and isUnder( j.path, k.path ) ] ) == 0 ):
+                jobs.append( j )
+        print '###########################################################################'
+        print 'restore into %s' % self.backup.restore_to
+        print '###########################################################################'
+        for j in jobs:
+            print '%s from %s' % ( j.path, j.target.destination )
+        # one wave per root depth, so the nested targets go over what the outer ones restored
+        slots = scheduler.SlotPool( self.parallel, self.backup.max_per_host )
+        start = time.time()
+        results = []
+        for depth in sorted( set( [ j.Depth() for j in jobs ] ) ):
+            wave = [ j for j in jobs if j.Depth() == depth ]
+            for j in wave:
+                j.force = ( len( [ k for k in jobs if k.Depth() < depth and isUnder( j.path, k.path ) ] ) != 0 )
+            runner = scheduler.Scheduler( slots, 'restore', stop_on_failure = False )
+            results += runner.Run( [ ( '%s %s' % ( j.target.root, j.path ), scheduler.destinationHost( j.target.destination ), lambda j = j : self.run( j ) ) for j in wave ] )
+        elapsed = time.time() - start
+        runner.Summary( results )
+        self.report( jobs, elapsed )
+        if ( len( [ r for r in results if r.status != 'ok' ] ) != 0 ):
+            raise Exception( 'restore failed' )
+
+    def report( self, jobs, elapsed ):
+        done = [ j for j in jobs if not j.size is None ]
+        if ( len( done ) == 0 ):
+            return
+        for j in done:
+            print '%-40s %10s in %7.1fs, %s/s' % ( j.path, sizes.formatSize( j.size ), j.elapsed, sizes.formatSize( j.size / max( j.elapsed, 0.001 ) ) )
+        total = sum( [ j.size for j in done ] )
+        print 'restored %s in %.1fs, %s/s' % ( sizes.formatSize( total ), elapsed, sizes.formatSize( total / max( elapsed, 0.001 ) ) )
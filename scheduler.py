@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# run backup jobs concurrently with a global limit and a per destination host limit
+# the jobs are started in the order they are given, a job that can't get a slot for
+# its host is passed over until a slot frees up, so the order is kept as much as possible
+
+from __future__ import with_statement
+
+import re, threading, time, traceback
+
+# extract the host part of a duplicity url:
+# rsync://@my_host::my_backup_path, rsync://user@my_host/path, s3+http://my_bucket, scp://user@host:22/path ..
+# local destinations (file:///path) all map to 'localhost'
+def destinationHost( destination ):
+    m = re.match( r'^[\w+.-]+://([^@/]*@)?([^/:]*)', destination )
+    if ( m is None or m.group( 2 ) == '' ):
+        return 'localhost'
+    return m.group( 2 )
+
+# predict when each job starts and ends, following the same rules as Scheduler.Run
+# jobs is a list of ( key, host, duration ), returns a list of ( key, start, end ) in seconds from now
+def simulate( max_parallel, max_per_host, jobs ):
+    pool = SlotPool( max_parallel, max_per_host )
+    pending = range( len( jobs ) )
+    running = []
+    plan = [ None ] * len( jobs )
+    now = 0.0
+    while ( len( pending ) != 0 ):
+        launched = None
+        for i in pending:
+            if ( pool.available( jobs[i][1] ) ):
+                launched = i
+                break
+        if ( not launched is None ):
+            pending.remove( launched )
+            pool.take( jobs[launched][1] )
+            end = now + jobs[launched][2]
+            plan[launched] = ( jobs[launched][0], now, end )
+            running.append( ( end, launched ) )
+            continue
+        # wait for the next job to finish
+        running.sort()
+        ( now, i ) = running.pop( 0 )
+        pool.give( jobs[i][1] )
+    return plan
+
+# the slot accounting, shared by all the Scheduler instances that work for the same Backup
+class SlotPool( object ):
+    def __init__( self, max_parallel = 1, max_per_host = None ):
+        self.max_parallel = max_parallel
+        # None means no per host limit beyond the global one
+        self.max_per_host = max_per_host
+        self.running = 0
+        self.hosts = {}
+        self.cond = threading.Condition()
+
+    # NOTE: the methods below expect self.cond to be held by the caller
+    def available( self, host ):
+        if ( self.running >= self.max_parallel ):
+            return False
+        if ( not self.max_per_host is None and self.hosts.get( host, 0 ) >= self.max_per_host ):
+            return False
+        return True
+
+    def take( self, host ):
+        self.running += 1
+        self.hosts[ host ] = self.hosts.get( host, 0 ) + 1
+
+    def give( self, host ):
+        self.running -= 1
+        self.hosts[ host ] -= 1
+        if ( self.hosts[ host ] == 0 ):
+            del self.hosts[ host ]
+
+class JobResult( object ):
+    def __init__( self, key, host ):
+        self.key = key
+        self.host = host
+        self.status = 'skipped'
+        self.start = None
+        self.end = None
+        self.error = None
+
+    def elapsed( self ):
+        if ( self.start is None or self.end is None ):
+            return 0.0
+        return self.end - self.start
+
+class Scheduler( object ):
+    def __init__( self, pool, name = 'run', stop_on_failure = True, deadline = None, admit = None ):
+        self.pool = pool
+        self.name = name
+        # when a job fails, don't start any new ones (the jobs already running are waited on)
+        self.stop_on_failure = stop_on_failure
+        # a time.time() value after which no new jobs are started
+        self.deadline = deadline
+        # called with the key of a job about to start, returns None to start it, or the reason it is skipped
+        self.admit = admit
+
+    def worker( self, job, result ):
+        ( key, host, func ) = job
+        result.start = time.time()
+        try:
+            try:
+                func()
+                result.status = 'ok'
+            except Exception, e:
+                result.status = 'failed'
+                result.error = e
+                print '%s %s failed:' % ( self.name, key )
+                traceback.print_exc()
+        finally:
+            # always give the slot back, or the scheduler waits forever
+            if ( result.status == 'running' ):
+                result.status = 'failed'
+            result.end = time.time()
+            with self.pool.cond:
+                self.pool.give( host )
+                self.pool.cond.notifyAll()
+
+    # jobs is a list of ( key, host, callable ) tuples
+    # returns a list of JobResult in the same order
+    def Run( self, jobs ):
+        results = [ JobResult( job[0], job[1] ) for job in jobs ]
+        pending = range( len( jobs ) )
+        threads = []
+        stop = False
+        with self.pool.cond:
+            while ( True ):
+                if ( not stop and self.stop_on_failure ):
+                    for r in results:
+                        if ( r.status == 'failed' ):
+                            print '%s: %s failed, not starting any new jobs' % ( self.name, r.key )
+                            stop = True
+                            break
+                if ( not stop and not self.deadline is None and time.time() >= self.deadline and len( pending ) != 0 ):
+                    print '%s: out of time, not starting any new jobs' % self.name
+                    stop = True
+                if ( stop ):
+                    pending = []
+                launched = None
+                for i in pending:
+                    if ( self.pool.available( jobs[i][1] ) ):
+                        launched = i
+                        break
+                if ( not launched is None and not self.admit is None ):
+                    reason = self.admit( jobs[launched][0] )
+                    if ( not reason is None ):
+                        print '%s: not starting %s, %s' % ( self.name, jobs[launched][0], reason )
+                        pending.remove( launched )
+                        results[launched].error = reason
+                        continue
+                if ( not launched is None ):
+                    pending.remove( launched )
+                    self.pool.take( jobs[launched][1] )
+                    # mark it so the loop doesn't consider it done before the thread gets going
+                    results[launched].status = 'running'
+                    t = threading.Thread( target = self.worker, args = ( jobs[launched], results[launched] ), name = '%s %s' % ( self.name, jobs[launched][0] ) )
+                    t.setDaemon( True )
+                    t.start()
+                    threads.append( t )
+                    continue
+                if ( len( pending ) == 0 and len( [ r for r in results if r.status == 'running' ] ) == 0 ):
+                    break
+                if ( self.deadline is None ):
+                    self.pool.cond.wait()
+                else:
+                    self.pool.cond.wait( max( self.deadline - time.time(), 0 ) + 0.1 )
+        for t in threads:
+            t.join()
+        return results
+
+    def Summary( self, results ):
+        print '###########################################################################'
+        print '%s summary' % self.name
+        print '###########################################################################'
+        for r in results:
+            line = '%-8s %8.1fs  %s' % ( r.status, r.elapsed(), r.key )
+            if ( not r.error is None ):
+                line += ' (%s)' % str( r.error )
+            print line
+        total = 0.0
+        starts = [ r.start for r in results if not r.start is None ]
+        ends = [ r.end for r in results if not r.end is None ]
+        if ( len( starts ) != 0 and len( ends ) != 0 ):
+            total = max( ends ) - min( starts )
+        print '%d ok, %d failed, %d skipped, %.1fs total' % ( len( [ r for r in results if r.status == 'ok' ] ), len( [ r for r in results if r.status == 'failed' ] ), len( [ r for r in results if r.status == 'skipped' ] ), total )
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# local approximation of duplicity's file selection, for the code that walks a target's tree
+# the rules are checked in the order they are given on the duplicity command line (excludes first, then includes)
+# and the first one that matches decides, anything that no rule matches is included
+# glob patterns follow duplicity: * and ? stop at /, ** matches anything, a pattern also matches everything below it
+
+import os, re, stat
+
+def globToRegex( pattern ):
+    pattern = pattern.rstrip( '/' )
+    if ( pattern == '' ):
+        pattern = '/'
+    out = ''
+    i = 0
+    while ( i < len( pattern ) ):
+        c = pattern[i]
+        if ( pattern.startswith( '**', i ) ):
+            out += '.*'
+            i += 2
+            continue
+        if ( c == '*' ):
+            out += '[^/]*'
+        elif ( c == '?' ):
+            out += '[^/]'
+        elif ( c == '[' and pattern.find( ']', i + 1 ) != -1 ):
+            end = pattern.find( ']', i + 1 )
+            out += '[%s]' % pattern[i+1:end].replace( '\\', '\\\\' )
+            i = end
+        else:
+            out += re.escape( c )
+        i += 1
+    if ( pattern == '/' ):
+        return re.compile( '^/.*$' )
+    return re.compile( '^%s(/.*)?$' % out )
+
+# the part of the pattern before the first wildcard
+def literalPrefix( pattern ):
+    m = re.search( r'[*?\[]', pattern )
+    if ( m is None ):
+        return pattern.rstrip( '/' )
+    return pattern[:m.start()]
+
+class Selection( object ):
+    def __init__( self, root, exclude = [], include = [], one_filesystem = False ):
+        self.root = os.path.normpath( root )
+        self.exclude = list( exclude )
+        self.include = list( include )
+        self.one_filesystem = one_filesystem
+        self.rules = [ ( False, globToRegex( e ), literalPrefix( e ) ) for e in self.exclude ]
+        self.rules += [ ( True, globToRegex( i ), literalPrefix( i ) ) for i in self.include ]
+
+    # True if duplicity would back up path (an absolute path under the root)
+    # directories that lead to an included path are selected as well, so they get walked
+    def Included( self, path, isdir = False ):
+        for ( include, regex, prefix ) in self.rules:
+            if ( regex.match( path ) ):
+                return include
+            if ( include and isdir and ( prefix.startswith( path.rstrip( '/' ) + '/' ) ) ):
+                return True
+        return True
+
+    def Contains( self, path ):
+        path = os.path.normpath( path )
+        if ( self.root != '/' and path != self.root and not path.startswith( self.root + '/' ) ):
+            return False
+        return self.Included( path )
+
+    # walk the selected tree, yields ( dirpath, dirstat, entries ) for each selected directory
+    # entries is a list of ( name, lstat ) for the selected entries of the directory
+    # errors (permission denied, files vanishing) are skipped over, duplicity will report them
+    # prune( path ) returning True keeps the walk out of a selected directory, it is still listed in its parent's entries
+    def Walk( self, prune = None ):
+        try:
+            rootstat = os.lstat( self.root )
+        except OSError:
+            return
+        stack = [ ( self.root, rootstat ) ]
+        while ( len( stack ) != 0 ):
+            ( dirpath, dirstat ) = stack.pop()
+            try:
+                names = os.listdir( dirpath )
+            except OSError:
+                continue
+            names.sort()
+            entries = []
+            subdirs = []
+            for name in names:
+                path = os.path.join( dirpath, name )
+                try:
+                    st = os.lstat( path )
+                except OSError:
+                    continue
+                isdir = stat.S_ISDIR( st.st_mode )
+                if ( not self.Included( path, isdir ) ):
+                    continue
+                entries.append( ( name, st ) )
+                if ( isdir and ( not self.one_filesystem or st.st_dev == rootstat.st_dev ) and ( prune is None or not prune( path ) ) ):
+                    subdirs.append( ( path, st ) )
+            yield ( dirpath, dirstat, entries )
+            subdirs.reverse()
+            stack += subdirs
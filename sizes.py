@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# sizes in bytes, as written in the config ( '20G', '500M' ..) and as printed
+
+import re
+
+units = { '' : 1, 'K' : 1024, 'M' : 1024 ** 2, 'G' : 1024 ** 3, 'T' : 1024 ** 4 }
+
+# '20G', '500M', or a number of bytes
+def parseSize( size ):
+    if ( isinstance( size, ( int, long ) ) ):
+        return size
+    m = re.match( r'^\s*(\d+(\.\d+)?)\s*([KMGT]?)B?\s*$', size, re.IGNORECASE )
+    if ( m is None ):
+        raise Exception( 'can\'t parse size %s' % repr( size ) )
+    return int( float( m.group( 1 ) ) * units[ m.group( 3 ).upper() ] )
+
+def formatSize( size ):
+    for u in [ 'T', 'G', 'M', 'K' ]:
+        if ( abs( size ) >= units[ u ] ):
+            return '%.1f%s' % ( float( size ) / units[ u ], u )
+    return '%d' % size
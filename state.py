@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# durable per target run history, kept in a sqlite database next to the lock file
+# every backup attempt is a row in the runs table, keyed by the target's destination
+# the cycles and cycle_done tables are the run journal: a cycle stays open until every target
+# completed in it, so an interrupted invocation resumes with the targets that are left
+
+from __future__ import with_statement
+
+import sqlite3, threading, time, json
+
+def decayingPeak( old, new, decay = 0.8 ):
+    if ( old is None ):
+        return new
+    return max( new, old * decay )
+
+class StateStore( object ):
+    def __init__( self, path ):
+        self.path = path
+        # the connection is shared by the scheduler threads, serialize access to it
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect( path, timeout = 60, check_same_thread = False )
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.execute( 'create table if not exists runs ( id integer primary key, target text not null, backup_type text, started real not null, finished real, duration real, status text not null, bytes_sent integer, stats text )' )
+            self.conn.execute( 'create index if not exists runs_target on runs ( target, started )' )
+            self.conn.execute( 'create table if not exists maintenance ( target text primary key, last real not null )' )
+            self.conn.execute( 'create table if not exists status_cache ( destination text primary key, fetched real not null, output text not null )' )
+            self.conn.execute( 'create table if not exists cycles ( id integer primary key, started real not null, finished real )' )
+            self.conn.execute( 'create table if not exists cycle_done ( cycle integer not null, target text not null, finished real not null, primary key ( cycle, target ) )' )
+            # the times a run was paused (outside its window, host under pressure ..), resumed is null while it's paused
+            self.conn.execute( 'create table if not exists pauses ( id integer primary key, target text not null, run_id integer, paused real not null, resumed real, reason text )' )
+            self.conn.execute( 'create index if not exists pauses_run on pauses ( run_id )' )
+            # sampled verification, see verify.py: bucket out of buckets, status is ok, differences, failed or timeout
+            self.conn.execute( 'create table if not exists verify_runs ( id integer primary key, target text not null, started real not null, finished real not null, bucket integer not null, buckets integer not null, files integer, bytes integer, differences integer, status text not null )' )
+            self.conn.execute( 'create index if not exists verify_runs_target on verify_runs ( target, started )' )
+            # LVM origins: the last sample of the device's write counter, the write rate derived from it,
+            # and the rate at which the snapshots of that origin filled up during the backups (bytes/s)
+            self.conn.execute( 'create table if not exists lvm_rates ( origin text primary key, sampled real, sectors integer, write_rate real, fill_rate real )' )
+            self.conn.commit()
+
+    def execute( self, sql, args = () ):
+        with self.lock:
+            c = self.conn.execute( sql, args )
+            self.conn.commit()
+            return c
+
+    def query( self, sql, args = () ):
+        with self.lock:
+            return [ dict( zip( r.keys(), r ) ) for r in self.conn.execute( sql, args ).fetchall() ]
+
+    # returns the run id to pass to FinishRun
+    def StartRun( self, target, backup_type ):
+        return self.execute( 'insert into runs ( target, backup_type, started, status ) values ( ?, ?, ?, ? )', ( target, backup_type, time.time(), 'running' ) ).lastrowid
+
+    def FinishRun( self, run_id, status, bytes_sent = None, stats = None ):
+        now = time.time()
+        if ( not stats is None ):
+            stats = json.dumps( stats, sort_keys = True )
+        self.execute( 'update runs set finished = ?, duration = ? - started, status = ?, bytes_sent = ?, stats = ? where id = ?', ( now, now, status, bytes_sent, stats, run_id ) )
+
+    # most recent run for the target, optionally restricted to a status and a backup type
+    # returns a dictionary, or None if there is no such run
+    def LastRun( self, target, status = None, backup_type = None ):
+        sql = 'select * from runs where target = ?'
+        args = [ target ]
+        if ( not status is None ):
+            sql += ' and status = ?'
+            args.append( status )
+        if ( not backup_type is None ):
+            sql += ' and backup_type = ?'
+            args.append( backup_type )
+        sql += ' order by started desc limit 1'
+        rows = self.query( sql, args )
+        if ( len( rows ) == 0 ):
+            return None
+        return rows[0]
+
+    # most recent successful run that wrote to the destination
+    def LastWrite( self, target ):
+        rows = self.query( 'select * from runs where target = ? and status = \'ok\' and backup_type in ( \'full\', \'incremental\' ) order by started desc limit 1', ( target, ) )
+        if ( len( rows ) == 0 ):
+            return None
+        return rows[0]
+
+    def LastMaintenance( self, target ):
+        rows = self.query( 'select last from maintenance where target = ?', ( target, ) )
+        if ( len( rows ) == 0 ):
+            return None
+        return rows[0]['last']
+
+    def MarkMaintained( self, target ):
+        self.execute( 'insert or replace into maintenance ( target, last ) values ( ?, ? )', ( target, time.time() ) )
+
+    # cached collection-status output: ( fetched, output ), None if there is none or if it's older than ttl seconds
+    def CachedStatus( self, destination, ttl ):
+        rows = self.query( 'select fetched, output from status_cache where destination = ?', ( destination, ) )
+        if ( len( rows ) == 0 ):
+            return None
+        if ( not ttl is None and time.time() - rows[0]['fetched'] > ttl ):
+            return None
+        return ( rows[0]['fetched'], rows[0]['output'] )
+
+    def StoreStatus( self, destination, output ):
+        self.execute( 'insert or replace into status_cache ( destination, fetched, output ) values ( ?, ?, ? )', ( destination, time.time(), output ) )
+
+    # we wrote to the destination, the cached status is no good anymore
+    def InvalidateStatus( self, destination ):
+        self.execute( 'delete from status_cache where destination = ?', ( destination, ) )
+
+    def FirstRun( self, target ):
+        rows = self.query( 'select * from runs where target = ? order by started asc limit 1', ( target, ) )
+        if ( len( rows ) == 0 ):
+            return None
+        return rows[0]
+
+    # most recent runs first, paused is the time the run spent paused
+    def History( self, target, limit = 30, status = None, backup_type = None ):
+        sql = 'select runs.*, ( select sum( resumed - paused ) from pauses where run_id = runs.id ) as paused from runs where target = ?'
+        args = [ target ]
+        if ( not status is None ):
+            sql += ' and status = ?'
+            args.append( status )
+        if ( not backup_type is None ):
+            sql += ' and backup_type = ?'
+            args.append( backup_type )
+        sql += ' order by started desc limit ?'
+        args.append( limit )
+        return self.query( sql, args )
+
+    def Targets( self ):
+        return [ r['target'] for r in self.query( 'select distinct target from runs order by target' ) ]
+
+    # returns the id of the open cycle, starts a new one if there is none or if fresh is set
+    def OpenCycle( self, fresh = False ):
+        if ( fresh ):
+            self.execute( 'update cycles set finished = ? where finished is null', ( time.time(), ) )
+        cycle = self.CurrentCycle()
+        if ( not cycle is None ):
+            return cycle
+        return self.execute( 'insert into cycles ( started ) values ( ? )', ( time.time(), ) ).lastrowid
+
+    # the open cycle, None if there is none
+    def CurrentCycle( self ):
+        rows = self.query( 'select id from cycles where finished is null order by id desc limit 1' )
+        if ( len( rows ) == 0 ):
+            return None
+        return rows[0]['id']
+
+    def CloseCycle( self, cycle ):
+        self.execute( 'update cycles set finished = ? where id = ?', ( time.time(), cycle ) )
+
+    def MarkDone( self, cycle, target ):
+        self.execute( 'insert or replace into cycle_done ( cycle, target, finished ) values ( ?, ?, ? )', ( cycle, target, time.time() ) )
+
+    # the set of targets completed in the cycle
+    def CycleDone( self, cycle ):
+        return set( [ r['target'] for r in self.query( 'select target from cycle_done where cycle = ?', ( cycle, ) ) ] )
+
+    def RecordVerify( self, target, started, bucket, buckets, files, bytes, differences, status ):
+        self.execute( 'insert into verify_runs ( target, started, finished, bucket, buckets, files, bytes, differences, status ) values ( ?, ?, ?, ?, ?, ?, ?, ?, ? )', ( target, started, time.time(), bucket, buckets, files, bytes, differences, status ) )
+
+    # the set of buckets verified without problems since the given time, for that bucket count
+    def VerifiedBuckets( self, target, buckets, since ):
+        return set( [ r['bucket'] for r in self.query( 'select distinct bucket from verify_runs where target = ? and buckets = ? and status = \'ok\' and started >= ?', ( target, buckets, since ) ) ] )
+
+    # the rates are decaying peaks: they follow an increase right away and go down slowly
+    # a snapshot that is too large wastes some space, one that is too small ruins the backup
+    def LVMRates( self, origin ):
+        rows = self.query( 'select * from lvm_rates where origin = ?', ( origin, ) )
+        if ( len( rows ) == 0 ):
+            return None
+        return rows[0]
+
+    # sectors is the write counter of the origin device, from /sys/dev/block/*/stat
+    def SampleWrites( self, origin, sectors ):
+        now = time.time()
+        old = self.LVMRates( origin )
+        if ( old is None ):
+            self.execute( 'insert into lvm_rates ( origin, sampled, sectors ) values ( ?, ?, ? )', ( origin, now, sectors ) )
+            return
+        rate = old['write_rate']
+        # the counter starts over at each boot
+        if ( not old['sectors'] is None and sectors >= old['sectors'] and now > old['sampled'] ):
+            rate = decayingPeak( rate, ( sectors - old['sectors'] ) * 512.0 / ( now - old['sampled'] ) )
+        self.execute( 'update lvm_rates set sampled = ?, sectors = ?, write_rate = ? where origin = ?', ( now, sectors, rate, origin ) )
+
+    def RecordFill( self, origin, rate ):
+        old = self.LVMRates( origin )
+        if ( old is None ):
+            self.execute( 'insert into lvm_rates ( origin, fill_rate ) values ( ?, ? )', ( origin, rate ) )
+            return
+        self.execute( 'update lvm_rates set fill_rate = ? where origin = ?', ( decayingPeak( old['fill_rate'], rate ), origin ) )
+
+    # run_id may be None, for the commands that aren't part of a recorded run (maintenance ..)
+    def StartPause( self, target, run_id, reason = None ):
+        return self.execute( 'insert into pauses ( target, run_id, paused, reason ) values ( ?, ?, ?, ? )', ( target, run_id, time.time(), reason ) ).lastrowid
+
+    def EndPause( self, pause_id ):
+        self.execute( 'update pauses set resumed = ? where id = ?', ( time.time(), pause_id ) )
+
+    def close( self ):
+        with self.lock:
+            self.conn.close()
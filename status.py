@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# a parsed model of duplicity's collection-status output
+# the raw output is what gets cached (see state.StateStore.CachedStatus), parsing is cheap
+
+import re, time
+
+def parseTime( s ):
+    try:
+        return time.mktime( time.strptime( ' '.join( s.split() ), '%a %b %d %H:%M:%S %Y' ) )
+    except ValueError:
+        return None
+
+class BackupSet( object ):
+    def __init__( self, kind, when, volumes ):
+        # 'full' or 'incremental'
+        self.kind = kind
+        self.time = when
+        self.volumes = volumes
+
+class Chain( object ):
+    def __init__( self, primary ):
+        self.primary = primary
+        self.start = None
+        self.end = None
+        self.sets = []
+
+    def Volumes( self ):
+        return sum( [ s.volumes for s in self.sets ] )
+
+class CollectionStatus( object ):
+    def __init__( self, output ):
+        self.output = output
+        self.chains = []
+        self.last_full = None
+        self.orphaned = False
+        self.parse( output )
+
+    def parse( self, output ):
+        chain = None
+        for line in output.splitlines():
+            line = line.strip()
+            m = re.match( r'^Last full backup date:\s*(.*)$', line )
+            if ( not m is None ):
+                self.last_full = parseTime( m.group( 1 ) )
+                continue
+            if ( re.match( r'^Found primary backup chain', line ) ):
+                chain = Chain( True )
+                self.chains.append( chain )
+                continue
+            if ( re.match( r'^Secondary chain \d+ of \d+', line ) ):
+                chain = Chain( False )
+                self.chains.append( chain )
+                continue
+            if ( re.match( r'^Also found .* orphaned|^Found \d+ orphaned|incomplete backup set', line ) and not line.startswith( 'No orphaned' ) ):
+                self.orphaned = True
+                continue
+            if ( chain is None ):
+                continue
+            m = re.match( r'^Chain start time:\s*(.*)$', line )
+            if ( not m is None ):
+                chain.start = parseTime( m.group( 1 ) )
+                continue
+            m = re.match( r'^Chain end time:\s*(.*)$', line )
+            if ( not m is None ):
+                chain.end = parseTime( m.group( 1 ) )
+                continue
+            m = re.match( r'^(Full|Incremental)\s+(.*\d{4})\s+(\d+)$', line )
+            if ( not m is None ):
+                chain.sets.append( BackupSet( m.group( 1 ).lower(), parseTime( m.group( 2 ) ), int( m.group( 3 ) ) ) )
+                continue
+
+    def Primary( self ):
+        for c in self.chains:
+            if ( c.primary ):
+                return c
+        return None
+
+    # number of backup sets in the primary chain, the full included
+    def ChainLength( self ):
+        p = self.Primary()
+        if ( p is None ):
+            return 0
+        return len( p.sets )
+
+    def Summary( self ):
+        p = self.Primary()
+        if ( p is None ):
+            return 'no primary backup chain'
+        last_full = 'unknown'
+        if ( not self.last_full is None ):
+            last_full = time.ctime( self.last_full )
+        ret = 'primary chain: %d sets, %d volumes, last full %s, %d older chains' % ( len( p.sets ), p.Volumes(), last_full, len( self.chains ) - 1 )
+        if ( self.orphaned ):
+            ret += ', orphaned or incomplete sets present'
+        return ret
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# spans around the phases of a run and around every subprocess
+# exported in the Chrome trace event format (chrome://tracing, Perfetto ..), one row per thread
+
+from __future__ import with_statement
+from contextlib import contextmanager
+
+import os, time, threading, json
+
+class Tracer( object ):
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.spans = []
+        self.threads = {}
+
+    def threadId( self ):
+        t = threading.currentThread()
+        with self.lock:
+            if ( not self.threads.has_key( t.ident ) ):
+                self.threads[ t.ident ] = ( len( self.threads ) + 1, t.getName() )
+            return self.threads[ t.ident ][0]
+
+    # the body can add to the yielded dictionary, it ends up in the span's args (exit code ..)
+    @contextmanager
+    def Span( self, name, category = 'phase', **args ):
+        tid = self.threadId()
+        start = time.time()
+        try:
+            try:
+                yield args
+            except Exception, e:
+                args['error'] = str( e )
+                raise
+        finally:
+            end = time.time()
+            with self.lock:
+                self.spans.append( { 'name' : name, 'cat' : category, 'start' : start, 'end' : end, 'tid' : tid, 'args' : args } )
+
+    def Export( self, path ):
+        with self.lock:
+            events = []
+            for ( ident, ( tid, tname ) ) in self.threads.items():
+                events.append( { 'name' : 'thread_name', 'ph' : 'M', 'pid' : os.getpid(), 'tid' : tid, 'args' : { 'name' : tname } } )
+            for s in self.spans:
+                events.append( { 'name' : s['name'], 'cat' : s['cat'], 'ph' : 'X', 'ts' : int( s['start'] * 1000000 ), 'dur' : int( ( s['end'] - s['start'] ) * 1000000 ), 'pid' : os.getpid(), 'tid' : s['tid'], 'args' : s['args'] } )
+        handle = file( path, 'w' )
+        json.dump( { 'traceEvents' : events, 'displayTimeUnit' : 'ms' }, handle )
+        handle.close()
+
+    def Slowest( self, count = 10 ):
+        print '###########################################################################'
+        print 'slowest phases'
+        print '###########################################################################'
+        with self.lock:
+            spans = sorted( self.spans, key = lambda s : s['start'] - s['end'] )[:count]
+        for s in spans:
+            detail = ''
+            if ( s['args'].has_key( 'target' ) ):
+                detail = ' %s' % s['args']['target']
+            if ( s['args'].has_key( 'exit' ) ):
+                detail += ' (exit %d)' % s['args']['exit']
+            print '%10.1fs  %-12s %s%s' % ( s['end'] - s['start'], s['cat'], s['name'], detail )
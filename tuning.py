@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# --volsize and the temporary directory of a target's backup
+# 'volsize' : n passes --volsize n (MB), 'volsize' : 'auto' works it out from the run history:
+# a volume should take about 'volsize_seconds' to upload at the throughput of the recent backups,
+# and the more of them failed, the smaller the volumes (less to send again). it stays between
+# 'volsize_min' and 'volsize_max', without history duplicity's default is kept
+# with 'volsize' or 'tempdir_free' set, the temporary directory needs room for a few volumes ( 'tempdir_free', bytes or '5G',
+# by default 3 volumes ), when it doesn't have it the first of the 'tempdirs' that does is used instead
+
+import os
+
+import sizes
+
+# duplicity's default, in MB
+default_volsize = 25
+
+def freeSpace( path ):
+    st = os.statvfs( path )
+    return st.f_bavail * st.f_frsize
+
+# the recent backups that sent something: ( bytes per second, failure rate ), None for the throughput without history
+def history( backup, target, runs = 10 ):
+    rows = [ r for r in target.History( backup, runs * 2 ) if r['backup_type'] in [ 'full', 'incremental' ] and r['status'] in [ 'ok', 'failed' ] ][:runs]
+    if ( len( rows ) == 0 ):
+        return ( None, 0.0 )
+    failures = len( [ r for r in rows if r['status'] == 'failed' ] ) / float( len( rows ) )
+    sent = 0
+    elapsed = 0.0
+    for r in rows:
+        if ( r['status'] != 'ok' or not r['bytes_sent'] or not r['duration'] ):
+            continue
+        sent += r['bytes_sent']
+        elapsed += r['duration'] - ( r['paused'] or 0 )
+    if ( sent == 0 or elapsed <= 0 ):
+        return ( None, failures )
+    # totals rather than an average of rates, so the small incrementals (mostly overhead) don't drag it down
+    return ( sent / elapsed, failures )
+
+# ( MB, why ), None for duplicity's default
+def VolumeSize( backup, target ):
+    setting = target.Setting( backup, 'volsize' )
+    if ( setting is None ):
+        return ( None, 'default' )
+    if ( setting != 'auto' ):
+        return ( int( setting ), 'configured' )
+    ( rate, failures ) = history( backup, target )
+    if ( rate is None ):
+        return ( None, 'no history yet' )
+    size = rate * target.Setting( backup, 'volsize_seconds', 60 ) / ( 1024 * 1024 )
+    size /= 1 + 4 * failures
+    size = int( min( max( size, target.Setting( backup, 'volsize_min', 25 ) ), target.Setting( backup, 'volsize_max', 1000 ) ) )
+    return ( size, '%s/s upload, %d%% of the recent backups failed' % ( sizes.formatSize( rate ), failures * 100 ) )
+
+# ( path, explicit ), see BackupTarget.TempDir. raises when none of the places has enough room
+def PickTempDir( backup, target, volsize ):
+    ( tempdir, explicit ) = target.DefaultTempDir()
+    needed = target.Setting( backup, 'tempdir_free' )
+    if ( needed is None and target.Setting( backup, 'volsize' ) is None ):
+        return ( tempdir, explicit )
+    if ( needed is None ):
+        needed = 3 * ( volsize or default_volsize ) * 1024 * 1024
+    needed = sizes.parseSize( needed )
+    candidates = [ ( tempdir, explicit ) ] + [ ( t, True ) for t in backup.config.get( 'tempdirs', [] ) ]
+    free = []
+    for ( path, explicit ) in candidates:
+        try:
+            available = freeSpace( path )
+        except OSError, e:
+            print '%s: temporary directory %s: %s' % ( target.root, path, str( e ) )
+            free.append( '%s unusable' % path )
+            continue
+        if ( available >= needed ):
+            if ( path != tempdir ):
+                print '%s: %s needed for temporary files (%s), using %s' % ( target.root, sizes.formatSize( needed ), ', '.join( free ), path )
+            return ( path, explicit )
+        free.append( '%s has %s free' % ( path, sizes.formatSize( available ) ) )
+    raise Exception( 'not enough room for temporary files, %s needed: %s' % ( sizes.formatSize( needed ), ', '.join( free ) ) )
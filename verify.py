@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# sampled verification: with 'verify_days' set (globally or per target), the files of a target are spread
+# over that many buckets by a hash of their path, and each night one bucket is checked with
+# duplicity verify --compare-data, so the whole target gets checked over verify_days nights
+# the bucket of the night is offset per target, so the targets don't all walk the same part of the rotation
+# files modified since the last backup started are left out, they are expected to differ
+# the stage has its own concurrency ('verify_parallel') and time budget ('verify_budget', in seconds)
+# the results go to the state store, the coverage is the part of the buckets checked in the last verify_days days
+# LVM targets are not verified: their snapshot is gone by the time the stage runs
+# a verify that finds differences is 'corrupt', one that fails otherwise (backend error ..) is classified like a backup
+# failure, see failures.py, and one cut short by the budget counts as failed
+
+from __future__ import with_statement
+
+import os, stat, time, datetime, zlib
+
+import scheduler, sizes, failures
+
+class Verifier( object ):
+    def __init__( self, backup ):
+        self.backup = backup
+        self.parallel = backup.config.get( 'verify_parallel', backup.max_parallel )
+        self.budget = backup.config.get( 'verify_budget' )
+
+    # None when the target isn't verified (verify_days unset, or 0 and below)
+    def Buckets( self, t ):
+        buckets = t.Setting( self.backup, 'verify_days' )
+        if ( buckets is None or buckets <= 0 ):
+            return None
+        return buckets
+
+    # tonight's bucket
+    def Bucket( self, t, buckets ):
+        return ( datetime.date.today().toordinal() + ( zlib.crc32( t.key ) & 0xffffffff ) ) % buckets
+
+    # the files of the bucket: absolute paths, and their total size
+    def sample( self, t, buckets, bucket ):
+        cutoff = None
+        last = self.backup.state.LastWrite( t.key )
+        if ( not last is None ):
+            cutoff = last['started']
+        paths = []
+        size = 0
+        for ( dirpath, dirstat, entries ) in t.Selection().Walk():
+            for ( name, st ) in entries:
+                # a directory in the filelist brings its whole subtree in, duplicity goes through the parents of the files on its own
+                if ( stat.S_ISDIR( st.st_mode ) ):
+                    continue
+                path = os.path.join( dirpath, name )
+                if ( ( zlib.crc32( path ) & 0xffffffff ) % buckets != bucket ):
+                    continue
+                if ( not cutoff is None and max( st.st_mtime, st.st_ctime ) >= cutoff ):
+                    continue
+                paths.append( path )
+                size += st.st_size
+        return ( paths, size )
+
+    def verify( self, t, deadline ):
+        buckets = self.Buckets( t )
+        bucket = self.Bucket( t, buckets )
+        start = time.time()
+        with self.backup.tracer.Span( 'sample', 'verify', target = t.root ):
+            ( paths, size ) = self.sample( t, buckets, bucket )
+        print '%s: verifying bucket %d of %d, %d files, %s' % ( t.root, bucket, buckets, len( paths ), sizes.formatSize( size ) )
+        if ( len( paths ) == 0 ):
+            self.backup.state.RecordVerify( t.key, start, bucket, buckets, 0, 0, 0, 'ok' )
+            return
+        filelist = self.backup.TargetFile( t, 'verify' )
+        handle = file( filelist, 'w' )
+        try:
+            for p in paths:
+                handle.write( p + '\n' )
+        finally:
+            handle.close()
+
+        cmd = [ self.backup.duplicity, 'verify', '--compare-data', '--include-filelist', filelist, '--exclude', '**' ]
+        if ( t.shortFilenames ):
+            cmd.append( '--short-filenames' )
+        if ( self.backup.config.has_key( 'duplicity_args' ) ):
+            cmd += self.backup.config['duplicity_args']
+        ( tempdir, explicit ) = t.TempDir()
+        if ( explicit ):
+            cmd += [ '--tempdir', tempdir ]
+        cmd.append( t.destination )
+        cmd.append( t.root )
+        print repr( cmd )
+
+        result = { 'compared' : None, 'differences' : None }
+        def complete( m ):
+            result['compared'] = int( m.group( 1 ) )
+            result['differences'] = int( m.group( 2 ) )
+        out = self.backup.OutputPump( t.root, t )
+        classifier = failures.Classifier( self.backup, out )
+        out.addPattern( r'Verify complete: (\d+) files? compared, (\d+) differences? found', complete )
+        timeout = None
+        if ( not deadline is None ):
+            timeout = deadline - time.time()
+        ret = out.Run( cmd, timeout = timeout )
+        status = 'ok'
+        if ( out.timedout ):
+            status = 'timeout'
+        elif ( result['differences'] ):
+            status = 'differences'
+        elif ( ret != 0 ):
+            status = 'failed'
+        self.backup.state.RecordVerify( t.key, start, bucket, buckets, result['compared'] or 0, size, result['differences'] or 0, status )
+        self.backup.metrics.Record( t, 'verify', time.time() - start, status )
+        if ( status == 'differences' ):
+            raise failures.BackupFailure( 'corrupt', '%d differences found, the backup may be corrupt' % result['differences'] )
+        if ( status == 'timeout' ):
+            raise failures.BackupFailure( 'failed', 'verify ran out of time' )
+        if ( status == 'failed' ):
+            failure = classifier.Failure( ret )
+            raise failures.BackupFailure( failure.kind, 'verify failed: %s' % str( failure ) )
+
+    def Coverage( self, t ):
+        buckets = self.Buckets( t )
+        return ( len( self.backup.state.VerifiedBuckets( t.key, buckets, time.time() - buckets * 24 * 3600 ) ), buckets )
+
+    # returns ( key, kind ) for the targets that failed verification, kind 'corrupt' when differences were found
+    def Run( self, items ):
+        items = [ t for t in items if not self.Buckets( t ) is None ]
+        for t in [ t for t in items if hasattr( t, 'lvmpath' ) ]:
+            print '%s: LVM target, not verified' % t.root
+        items = [ t for t in items if not hasattr( t, 'lvmpath' ) ]
+        if ( len( items ) == 0 or self.backup.dry_run ):
+            return []
+        deadline = None
+        if ( not self.budget is None ):
+            deadline = time.time() + self.budget
+        jobs = []
+        for t in items:
+            jobs.append( ( t.root, scheduler.destinationHost( t.destination ), lambda t = t : self.verify( t, deadline ) ) )
+        runner = scheduler.Scheduler( scheduler.SlotPool( self.parallel, self.backup.max_per_host ), 'verify', stop_on_failure = False, deadline = deadline )
+        results = runner.Run( jobs )
+        runner.Summary( results )
+        for t in items:
+            ( verified, buckets ) = self.Coverage( t )
+            print '%s: %d of %d buckets verified in the last %d days (%d%%)' % ( t.root, verified, buckets, buckets, verified * 100 / buckets )
+        return [ ( r.key, failures.Kind( r ) ) for r in results if r.status == 'failed' ]
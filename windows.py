@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+##########################################################################
+#    dupinanny backup scripts for duplicity
+#    Copyright (C) 2008 Timothee Besset
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# backup windows: when the duplicity processes of a target are allowed to run
+# 'window' in the config, or the window argument of a target: one spec or a list of specs, open when any of them is
+# a spec is 'HH:MM-HH:MM', optionally preceded by the days it opens on: 'mon-fri 22:00-06:00', 'sat,sun 00:00-24:00'
+# a window that ends before it starts runs past midnight
+# outside its window, the duplicity processes of a target are stopped (SIGSTOP), they continue when it opens again (SIGCONT)
+# a target doesn't start late in its window, when its predicted duration would fit in the window but not in what is left of it
+# a target that doesn't fit in its window at all starts when it opens, and is paused and resumed across several windows
+# the pauses go to the state store, with the run they interrupted
+
+from __future__ import with_statement
+
+import re, time, datetime, threading
+
+days = [ 'mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun' ]
+
+class Window( object ):
+    def __init__( self, spec ):
+        self.spec = spec
+        m = re.match( r'^\s*(([a-z,-]+)\s+)?(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$', spec.lower() )
+        if ( m is None ):
+            raise Exception( 'bad window %s, expected \'[days] HH:MM-HH:MM\'' % repr( spec ) )
+        self.days = set( range( 7 ) )
+        if ( not m.group( 2 ) is None ):
+            self.days = self.parseDays( m.group( 2 ) )
+        # minutes since midnight
+        self.start = int( m.group( 3 ) ) * 60 + int( m.group( 4 ) )
+        self.end = int( m.group( 5 ) ) * 60 + int( m.group( 6 ) )
+        if ( self.start >= 24 * 60 or self.end > 24 * 60 ):
+            raise Exception( 'bad window %s, times go from 00:00 to 24:00' % repr( spec ) )
+
+    def parseDays( self, s ):
+        ret = set()
+        for part in s.split( ',' ):
+            bounds = part.split( '-' )
+            try:
+                first = days.index( bounds[0][:3] )
+                last = days.index( bounds[-1][:3] )
+            except ValueError:
+                raise Exception( 'bad days %s in window %s' % ( repr( part ), repr( self.spec ) ) )
+            # 'fri-mon' wraps around the week
+            i = first
+            ret.add( i )
+            while ( i != last ):
+                i = ( i + 1 ) % 7
+                ret.add( i )
+        return ret
+
+    # the ( start, end ) of the period opening on that date, None if it doesn't open that day
+    def Period( self, date ):
+        if ( not date.weekday() in self.days ):
+            return None
+        midnight = datetime.datetime.combine( date, datetime.time() )
+        end = self.end
+        if ( end <= self.start ):
+            end += 24 * 60
+        return ( time.mktime( ( midnight + datetime.timedelta( minutes = self.start ) ).timetuple() ), time.mktime( ( midnight + datetime.timedelta( minutes = end ) ).timetuple() ) )
+
+class Windows( object ):
+    def __init__( self, specs ):
+        if ( isinstance( specs, basestring ) ):
+            specs = [ specs ]
+        self.windows = [ Window( s ) for s in specs ]
+
+    # the open periods from the day before to a week ahead, sorted, the ones that touch or overlap merged
+    def periods( self, now ):
+        first = datetime.date.fromtimestamp( now ) - datetime.timedelta( days = 1 )
+        periods = []
+        for i in range( 9 ):
+            for w in self.windows:
+                p = w.Period( first + datetime.timedelta( days = i ) )
+                if ( not p is None ):
+                    periods.append( p )
+        periods.sort()
+        merged = []
+        for ( start, end ) in periods:
+            if ( len( merged ) != 0 and start <= merged[-1][1] ):
+                merged[-1] = ( merged[-1][0], max( merged[-1][1], end ) )
+            else:
+                merged.append( ( start, end ) )
+        return merged
+
+    def current( self, now ):
+        for p in self.periods( now ):
+            if ( p[0] <= now and now < p[1] ):
+                return p
+        return None
+
+    def IsOpen( self, now ):
+        return ( not self.current( now ) is None )
+
+    # when the window that is open now closes, None if it's closed
+    # (an always open window closes a week or so from now, as far as this can tell)
+    def ClosesAt( self, now ):
+        p = self.current( now )
+        if ( p is None ):
+            return None
+        return p[1]
+
+    # when the window that is open now opened, None if it's closed
+    def OpenedAt( self, now ):
+        p = self.current( now )
+        if ( p is None ):
+            return None
+        return p[0]
+
+    # now if the window is open, the time it opens next otherwise, None if it never does
+    def NextOpen( self, now ):
+        for ( start, end ) in self.periods( now ):
+            if ( now < end ):
+                return max( start, now )
+        return None
+
+    def __str__( self ):
+        return ', '.join( [ w.spec for w in self.windows ] )
+
+# pauses and resumes the running duplicity processes as their windows close and open
+# Backup.OutputPump hands over the pumps of the targets that have a window, they are checked every 'window_check' seconds
+# the holds are other reasons to pause, see resources.Throttle
+class WindowGuard( object ):
+    def __init__( self, backup ):
+        self.backup = backup
+        self.interval = backup.config.get( 'window_check', 60 )
+        self.lock = threading.Lock()
+        # pump -> id of the pause in the state store, None while running
+        self.pumps = {}
+        self.thread = None
+        self.cache = {}
+        # objects with Registered( out ), called for each new pump, and Hold( out ), the reason to pause it or None
+        self.holds = []
+
+    # the target's windows.Windows, None if it has no window
+    def Window( self, target ):
+        spec = target.Setting( self.backup, 'window' )
+        if ( spec is None ):
+            return None
+        key = repr( spec )
+        if ( not self.cache.has_key( key ) ):
+            self.cache[ key ] = Windows( spec )
+        return self.cache[ key ]
+
+    # None if the target can start now, otherwise ( why not, when to try again )
+    def Check( self, target, duration ):
+        w = self.Window( target )
+        if ( w is None ):
+            return None
+        now = time.time()
+        closes = w.ClosesAt( now )
+        if ( closes is None ):
+            return ( 'outside its window (%s)' % w, w.NextOpen( now ) )
+        if ( not duration is None and now + duration > closes ):
+            if ( w.OpenedAt( now ) + duration <= closes ):
+                return ( 'predicted %ds won\'t fit before the window closes at %s' % ( duration, time.strftime( '%a %H:%M', time.localtime( closes ) ) ), w.NextOpen( closes ) )
+            print 'WARNING: %s: predicted %ds is longer than its window (%s), it will span several windows' % ( target.root, duration, w )
+        return None
+
+    # pump.OutputPump calls these when its process starts and exits
+    def Register( self, out ):
+        with self.lock:
+            self.pumps[ out ] = None
+            if ( self.thread is None ):
+                self.thread = threading.Thread( target = self.watch, name = 'window guard' )
+                self.thread.setDaemon( True )
+                self.thread.start()
+        for h in self.holds:
+            h.Registered( out )
+        # started as the window closed
+        self.check( out )
+
+    def Unregister( self, out ):
+        with self.lock:
+            pause = self.pumps.pop( out, None )
+        if ( not pause is None ):
+            self.backup.state.EndPause( pause )
+
+    # why the pump should be paused, None if it can run
+    def hold( self, out ):
+        w = self.Window( out.target )
+        if ( not w is None and not w.IsOpen( time.time() ) ):
+            return 'outside its window (%s), until %s' % ( w, time.ctime( w.NextOpen( time.time() ) or 0 ) )
+        for h in self.holds:
+            reason = h.Hold( out )
+            if ( not reason is None ):
+                return reason
+        return None
+
+    def check( self, out ):
+        reason = self.hold( out )
+        with self.lock:
+            if ( not self.pumps.has_key( out ) ):
+                # exited in the meantime
+                return
+            try:
+                if ( not reason is None and not out.paused ):
+                    out.Pause()
+                    self.pumps[ out ] = self.backup.state.StartPause( out.target.key, out.run_id, reason )
+                    print '%s: paused, %s' % ( out.target.root, reason )
+                elif ( reason is None and out.paused ):
+                    out.Resume()
+                    self.backup.state.EndPause( self.pumps[ out ] )
+                    self.pumps[ out ] = None
+                    print '%s: resumed' % out.target.root
+            except OSError:
+                # the process is gone
+                pass
+
+    def Pumps( self ):
+        with self.lock:
+            return self.pumps.keys()
+
+    def CheckAll( self ):
+        for out in self.Pumps():
+            self.check( out )
+
+    def watch( self ):
+        while ( True ):
+            time.sleep( self.interval )
+            with self.lock:
+                if ( len( self.pumps ) == 0 ):
+                    self.thread = None
+                    return
+            self.CheckAll()
+
+    def Paused( self, target ):
+        with self.lock:
+            return len( [ out for out in self.pumps.keys() if out.target.key == target.key and out.paused ] ) != 0
+
+    # on the way out, don't leave stopped processes behind
+    def ResumeAll( self ):
+        with self.lock:
+            for ( out, pause ) in self.pumps.items():
+                if ( not out.paused ):
+                    continue
+                try:
+                    out.Resume()
+                except OSError:
+                    pass
+                self.backup.state.EndPause( pause )
+                self.pumps[ out ] = None